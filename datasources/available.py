@@ -6,26 +6,209 @@ except ImportError:
 
 import certifi
 import re
+import os
+import pickle
+import threading
+import atexit
+import time
+import logging
 import numpy as np
 from datetime import datetime, timedelta
 
+## Every available/availableat function goes through one cache, keyed by
+## (kind, source, outlet, cycle), where kind is 'available' or 'availableat'.
+## Entries are kept for a time-to-live that depends on the source, and the
+## station lists for cycles more than ARCHIVE_AGE old are kept much longer,
+## since archives don't change.  The cache is saved to disk every SAVE_EVERY
+## misses and when the program exits, so the next session can start from it.
+
 cache_len = timedelta(minutes=5)
 
+CACHE_FN = os.path.join(os.path.expanduser("~"), ".sharppy", "cache", "available.pkl")
+
+# Seconds to keep listings for each source
+SOURCE_TTLS = {
+    'spc': 300,
+    'sharp': 300,
+    'psu': 300,
+    'stc': 300,
+    'ou_pecan': 300,
+    'iem': 3600,
+}
+
+ARCHIVE_AGE = timedelta(days=2)
+ARCHIVE_TTL = 30 * 86400
+
+# Number of new entries to get before the cache is saved
+SAVE_EVERY = 20
+
+class AvailabilityCache(object):
+    """
+    AvailabilityCache: A thread-safe cache of the results of the availability
+    functions that persists across sessions.
+    """
+    def __init__(self, cache_fn=CACHE_FN, ttls=SOURCE_TTLS, default_ttl=cache_len.total_seconds(), save_every=SAVE_EVERY):
+        """
+        cache_fn:   The file to save the cache to (None to keep it in memory only).
+        ttls:   A dictionary of the seconds to keep the entries for each source.
+        default_ttl:    Seconds to keep entries for sources that aren't in ttls.
+        save_every: The number of new entries to get before saving the cache. The
+            rest are saved by save().
+        """
+        self._cache_fn = cache_fn
+        self._ttls = dict(ttls)
+        self._default_ttl = default_ttl
+        self._save_every = save_every
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._unsaved = 0
+
+        self.load()
+
+    def getTTL(self, key):
+        """
+        Returns the number of seconds to keep an entry.
+        """
+        kind, source, outlet, cycle = key
+        if kind == 'availableat' and cycle is not None and cycle < datetime.utcnow() - ARCHIVE_AGE:
+            return ARCHIVE_TTL
+        return self._ttls.get(source, self._default_ttl)
+
+    def get(self, key, func):
+        """
+        Returns the cached value for the key if it hasn't expired. Otherwise, calls
+        func() to get the value and caches it.
+        key:    A (kind, source, outlet, cycle) tuple. cycle is a datetime or None.
+        func:   The function that gets the value.
+        """
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                stored, value = self._entries[key]
+                if 0 <= now - stored < self.getTTL(key):
+                    self._hits += 1
+                    return value
+            self._misses += 1
+
+        value = func()
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._unsaved += 1
+            if self._unsaved >= self._save_every:
+                self.save()
+        return value
+
+    def getStats(self):
+        """
+        Returns a dictionary with the number of hits and misses.
+        """
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'entries': len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._unsaved += 1
+            self.save()
+
+    def load(self):
+        """
+        Reads the entries that haven't expired from the cache file.
+        """
+        if self._cache_fn is None or not os.path.exists(self._cache_fn):
+            return
+
+        try:
+            with open(self._cache_fn, 'rb') as f:
+                entries = pickle.load(f)
+        except Exception as e:
+            logging.exception(e)
+            logging.debug("Couldn't read the availability cache, starting a new one.")
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, (stored, value) in entries.items():
+                if 0 <= now - stored < self.getTTL(key):
+                    self._entries[key] = (stored, value)
+
+    def save(self):
+        """
+        Writes the entries to the cache file, if there's anything new.
+        """
+        if self._cache_fn is None:
+            return
+
+        with self._lock:
+            if self._unsaved == 0:
+                return
+
+            try:
+                dirname = os.path.dirname(self._cache_fn)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+
+                # Write to a temporary file first so a half-written cache is never read
+                tmp_fn = "%s.%d.tmp" % (self._cache_fn, os.getpid())
+                with open(tmp_fn, 'wb') as f:
+                    pickle.dump(self._entries, f, protocol=2)
+                os.replace(tmp_fn, self._cache_fn)
+                self._unsaved = 0
+            except (IOError, OSError) as e:
+                logging.exception(e)
+                logging.debug("Couldn't save the availability cache.")
+
+_avail_cache = None
+_avail_cache_lock = threading.Lock()
+
+def get_avail_cache():
+    """
+    Returns the shared AvailabilityCache, reading it from CACHE_FN the first time.
+    It's saved when the program exits.
+    """
+    global _avail_cache
+    with _avail_cache_lock:
+        if _avail_cache is None:
+            _avail_cache = AvailabilityCache(cache_fn=CACHE_FN)
+            atexit.register(_avail_cache.save)
+        return _avail_cache
+
+def _cycle_key(dt):
+    # The cycle part of a cache key. dt may be a datetime or a QDate from the calendar.
+    if dt is None:
+        return None
+    try:
+        return datetime(dt.year(), dt.month(), dt.day())
+    except TypeError:
+        return datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute)
+
+def _cached_available(source, outlet, func):
+    def available(dt=None):
+        key = ('available', source, outlet, _cycle_key(dt))
+        return get_avail_cache().get(key, lambda: func(dt=dt))
+    return available
+
+def _cached_availableat(source, outlet, func):
+    def availableat(dt):
+        key = ('availableat', source, outlet, _cycle_key(dt))
+        return get_avail_cache().get(key, lambda: func(dt))
+    return availableat
+
+def _download(url):
+    url_obj = urlopen(url, cafile=certifi.where())
+    try:
+        return url_obj.read().decode('utf-8')
+    finally:
+        url_obj.close()
+
 
 goes_base_url = "http://sharp.weather.ou.edu/soundings/goes/"
-goes_text = ""
-goes_time = None
 
 # SHARP OBSERVED AVAILBILITY
 def _download_goes():
-    global goes_time, goes_text
-    now = datetime.utcnow()
-    if goes_time is None or goes_time < now - cache_len:
-        url_obj = urlopen(goes_base_url, cafile=certifi.where())
-        goes_text = url_obj.read().decode('utf-8')
-        goes_time = now
-
-    return goes_text
+    return _download(goes_base_url)
 
 def _available_goes(dt=None):
     '''
@@ -60,40 +243,24 @@ def _availableat_goes(dt):
             An array that contains all of the three letter station identfiers.
     '''
     recent_url = "%s%s/available.txt" % (goes_base_url, dt.strftime('%Y%m%d%H'))
-    text = urlopen(recent_url, cafile=certifi.where()).read().decode('utf-8')
+    text = _download(recent_url)
     matches = re.findall("(.+).txt", text)
     return matches
 
 
 sharp_base_url = "http://sharp.weather.ou.edu/soundings/obs/"
-sharp_text = ""
-sharp_time = None
-sharp_archive_text = ""
-sharp_archive_time = None
 
 # SHARP OBSERVED AVAILBILITY
 def _download_sharp():
-    global sharp_time, sharp_text
-    now = datetime.utcnow()
-    if sharp_time is None or sharp_time < now - cache_len:
-        url_obj = urlopen(sharp_base_url, cafile=certifi.where())
-        sharp_text = url_obj.read().decode('utf-8')
-        sharp_time = now
-    return sharp_text
+    return _download(sharp_base_url)
 
 def _download_sharp_archive(dt):
-    global sharp_time, sharp_text
-    now = datetime.utcnow()
     base_url = 'http://sharp.weather.ou.edu/soundings/archive/%Y/%m/%d/'
     try:
         dt = datetime(dt.year(), dt.month(), dt.day(), 0,0,0)
     except:
         dt = dt
-    if sharp_archive_time is None or sharp_archive_time < now - cache_len:
-        url_obj = urlopen(dt.strftime(base_url), cafile=certifi.where())
-        sharp_archive_text = url_obj.read().decode('utf-8')
-        sharp_time = now
-    return sharp_archive_text, dt
+    return _download(dt.strftime(base_url)), dt
 
 def _available_sharp(dt=None):
     '''
@@ -135,7 +302,7 @@ def _availableat_sharp(dt):
     #text = urlopen(recent_url).read().decode('utf-8')
     #matches = re.findall("a href=\"(.+).txt\"", text)
     recent_url = 'http://sharp.weather.ou.edu/soundings/archive/%Y/%m/%d/%H/'
-    text = urlopen(dt.strftime(recent_url), cafile=certifi.where()).read().decode('utf-8')
+    text = _download(dt.strftime(recent_url))
     matches = re.findall("a href=\"(.+).txt\"", text)
     return matches
 
@@ -150,14 +317,11 @@ nucaps_conus_m02_url = "https://geo.nsstc.nasa.gov/SPoRT/jpss-pg/nucaps/gridded/
 nucaps_conus_m03_url = "https://geo.nsstc.nasa.gov/SPoRT/jpss-pg/nucaps/gridded/conus/sharppy/m03/txt/"
 nucaps_caribbean_j01_url = "https://geo.nsstc.nasa.gov/SPoRT/jpss-pg/nucaps/gridded/caribbean/sharppy/j01/txt/"
 nucaps_alaska_j01_url = "https://geo.nsstc.nasa.gov/SPoRT/jpss-pg/nucaps/gridded/alaska/sharppy/j01/txt/"
-nucaps_text = ""
 
 ##################################
 # Retrieve the obs times for CONUS NOAA-20.
 def _download_nucaps_conus_j01():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_conus_j01_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_conus_j01_url)
 
 def _available_nucaps_conus_j01(dt=None):
     '''
@@ -179,9 +343,7 @@ def _available_nucaps_conus_j01(dt=None):
 ##################################
 # Retrieve the obs times for CONUS Aqua.
 def _download_nucaps_conus_aq0():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_conus_aq0_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_conus_aq0_url)
 
 def _available_nucaps_conus_aq0(dt=None):
     '''
@@ -203,9 +365,7 @@ def _available_nucaps_conus_aq0(dt=None):
 #################################
 # Retrieve the obs times for CONUS MetOp-B.
 def _download_nucaps_conus_m01():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_conus_m01_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_conus_m01_url)
 
 def _available_nucaps_conus_m01(dt=None):
     '''
@@ -227,9 +387,7 @@ def _available_nucaps_conus_m01(dt=None):
 #################################
 # Retrieve the obs times for CONUS MetOp-A.
 def _download_nucaps_conus_m02():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_conus_m02_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_conus_m02_url)
 
 def _available_nucaps_conus_m02(dt=None):
     '''
@@ -251,9 +409,7 @@ def _available_nucaps_conus_m02(dt=None):
 #################################
 # Retrieve the obs times for CONUS MetOp-C.
 def _download_nucaps_conus_m03():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_conus_m03_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_conus_m03_url)
 
 def _available_nucaps_conus_m03(dt=None):
     '''
@@ -275,9 +431,7 @@ def _available_nucaps_conus_m03(dt=None):
 #################################
 # Retrieve the obs times for Caribbean NOAA-20.
 def _download_nucaps_caribbean_j01():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_caribbean_j01_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_caribbean_j01_url)
 
 def _available_nucaps_caribbean_j01(dt=None):
     '''
@@ -299,9 +453,7 @@ def _available_nucaps_caribbean_j01(dt=None):
 #################################
 # Retrieve the obs times for Alaska NOAA-20.
 def _download_nucaps_alaska_j01():
-    global nucaps_text
-    nucaps_text = urlopen(nucaps_alaska_j01_url, cafile=certifi.where()).read().decode('utf-8')
-    return nucaps_text
+    return _download(nucaps_alaska_j01_url)
 
 def _available_nucaps_alaska_j01(dt=None):
     '''
@@ -325,19 +477,9 @@ def _available_nucaps_alaska_j01(dt=None):
 
 # SPC DATA AVAILABLILY
 spc_base_url = "http://www.spc.noaa.gov/exper/soundings/"
-spc_text = ""
-spc_time = None
 
 def _download_spc():
-    global spc_time, spc_text
-    now = datetime.utcnow()
-    if spc_time is None or spc_time < now - cache_len:
-        url_obj = urlopen(spc_base_url, cafile=certifi.where())
-        spc_text = url_obj.read().decode('utf-8')
-
-        spc_time = now
-
-    return spc_text
+    return _download(spc_base_url)
 
 def _available_spc(dt=None):
     '''
@@ -371,19 +513,12 @@ def _availableat_spc(dt):
             An array that contains all of the three letter station identfiers.
     '''
     recent_url = "%s%s/" % (spc_base_url, dt.strftime('%y%m%d%H_OBS'))
-    text = urlopen(recent_url, cafile=certifi.where()).read().decode('utf-8')
+    text = _download(recent_url)
     matches = re.findall("show_soundings\(\"([\w]{3}|[\d]{5})\"\)", text)
     return matches
 
-### IEM BUFKIT ARCHIVE CODE
-iem_base_url = "http://mtarchive.geol.iastate.edu/%Y/%m/%d/bufkit/%H/"
-iem_text = ""
-iem_time = None
-
 ### PSU CODE
 psu_base_url = "ftp://ftp.meteo.psu.edu/pub/bufkit/"
-psu_text = ""
-psu_time = None
 
 def _download_psu():
     '''
@@ -397,15 +532,7 @@ def _download_psu():
         psu_text : string
             Lists the files within the PSU FTP site.
     '''
-    global psu_time, psu_text
-    now = datetime.utcnow()
-    if psu_time is None or psu_time < now - cache_len:
-        url_obj = urlopen(psu_base_url, cafile=certifi.where())
-        psu_text = url_obj.read().decode('utf-8')
-
-        psu_time = now
-
-    return psu_text
+    return _download(psu_base_url)
 
 def _availableat_psu(model, dt):
     '''
@@ -426,8 +553,7 @@ def _availableat_psu(model, dt):
 
     cycle = dt.hour
     url = "%s%s/%02d/" % (psu_base_url, model.upper(), cycle)
-    url_obj = urlopen(url, cafile=certifi.where())
-    text = url_obj.read().decode('utf-8')
+    text = _download(url)
 
     stns = re.findall("%s_(.+)\.buf" % _repl[model], text)
     return stns
@@ -461,29 +587,6 @@ def _available_psu(model, dt=None):
 
 ### IEM CODE
 iem_base_url = "http://mtarchive.geol.iastate.edu/%Y/%m/%d/bufkit/%H/MODEL/"
-iem_text = ""
-iem_time = None
-
-def _download_iem():
-    '''
-        _download_iem()
-
-        Downloads the IEM directory webpage that lists all the
-        files available.
-
-        Returns
-        -------
-        iem_text : string
-            Lists the files within the IEM site.
-    '''
-    global iem_time, iem_text
-    now = datetime.utcnow()
-    if iem_time is None or iem_time < now - cache_len:
-        iem_obj = urlopen(iem_base_url, cafile=certifi.where())
-        psu_text = url_obj.read().decode('utf-8')
-        iem_time = now
-
-    return iem_text
 
 def _availableat_iem(model, dt):
     '''
@@ -504,8 +607,7 @@ def _availableat_iem(model, dt):
 
     cycle = dt.hour
     url = dt.strftime(iem_base_url).replace("MODEL", model.lower())
-    url_obj = urlopen(url, cafile=certifi.where())
-    text = url_obj.read().decode('utf-8')
+    text = _download(url)
 
     stns = re.findall("%s_(.+)\.buf\">" % _repl[model], text)
 
@@ -582,15 +684,14 @@ pecan_base_url = 'http://weather.ou.edu/~map/real_time_data/PECAN/'
 #http://weather.ou.edu/~map/real_time_data/PECAN/2015061112/soundings/TOP_2015061113.txt
 
 def _available_oupecan(**kwargs):
-    text = urlopen(pecan_base_url, cafile=certifi.where()).read().decode('utf-8')
+    text = _download(pecan_base_url)
     matches = sorted(list(set(re.findall("([\d]{10})", text))))
     return [ datetime.strptime(m, "%Y%m%d%H") for m in matches ]
 
 def _availableat_oupecan(dt):
     dt_string = datetime.strftime(dt, '%Y%m%d%H')
     url = "%s%s/soundings/" % (pecan_base_url, dt_string)
-    url_obj = urlopen(url, cafile=certifi.where())
-    text = url_obj.read().decode('utf-8')
+    text = _download(url)
     dt_string = datetime.strftime(dt, '%Y%m%d%H')
     stns = re.findall("([\w]{3})_%s.txt" % dt_string, text)
     return np.unique(stns)
@@ -599,7 +700,7 @@ def _availableat_oupecan(dt):
 ncarens_base_url = 'http://sharp.weather.ou.edu/soundings/ncarens/'
 
 def _available_ncarens(dt=None):
-    text = urlopen(ncarens_base_url, cafile=certifi.where()).read().decode('utf-8')
+    text = _download(ncarens_base_url)
 
     matches = sorted(list(set(re.findall("([\d]{8}_[\d]{2})", text))))
     return [ datetime.strptime(m, '%Y%m%d_%H') for m in matches ]
@@ -607,8 +708,7 @@ def _available_ncarens(dt=None):
 def _availableat_ncarens(dt):
     dt_string = datetime.strftime(dt, '%Y%m%d_%H')
     url = "%s%s/" % (ncarens_base_url, dt_string)
-    url_obj = urlopen(url, cafile=certifi.where())
-    text = url_obj.read().decode('utf-8')
+    text = _download(url)
 
     stns = re.findall("(N[\w]{2}.[\w]{2}W.[\w]{2,3}.[\w]{2}).txt", text)
     stns2 = re.findall("([\w]{3}).txt", text)
@@ -657,6 +757,18 @@ for model in [ 'gfs', 'nam', 'rap', 'ruc', 'nam nest','hrrr' ]:
     available['iem'][model] = (lambda m: lambda dt=None: _available_iem(m, dt=dt))(model)
     availableat['iem'][model] = (lambda m: lambda dt: _availableat_iem(m, dt))(model)
 
+# Send everything through the availability cache. The local sources take a file name
+# instead of a time, so they aren't cached.
+for source in available.keys():
+    if source == 'local':
+        continue
+    for outlet, func in list(available[source].items()):
+        available[source][outlet] = _cached_available(source, outlet, func)
+
+for source in availableat.keys():
+    for outlet, func in list(availableat[source].items()):
+        availableat[source][outlet] = _cached_availableat(source, outlet, func)
+
 if __name__ == "__main__":
 
     dt = datetime.utcnow()
@@ -3,22 +3,29 @@ import xml.etree.ElementTree as ET
 import glob, os, sys, shutil
 from datetime import datetime, timedelta
 try:
-    from urllib2 import urlopen, URLError
+    from urllib2 import urlopen, URLError, HTTPError
     from urllib import quote
     from urlparse import urlparse, urlunsplit
 except ImportError:
     from urllib.request import urlopen
-    from urllib.error import URLError
+    from urllib.error import URLError, HTTPError
     from urllib.parse import quote, urlparse, urlunsplit
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import certifi
 import platform, subprocess, re
-import imp
+import importlib.util
+import filecmp
+import pickle
 import socket
+import threading
+import time
 import logging
 import traceback
 
 import sharppy.io.decoder as decoder
+import sharppy.io.http_cache as http_cache
 from sharppy.io.csv import loadCSV
 from sharppy.io.csv import loadNUCAPS_CSV
 
@@ -38,17 +45,127 @@ if frozenutils.isFrozen():
     from . import available
 else:
     avail_loc = os.path.join(HOME_DIR, 'available.py')
-    if not os.path.exists(avail_loc):
-        pkg_avail_loc = os.path.join(os.path.dirname(__file__), 'available.py')
+    pkg_avail_loc = os.path.join(os.path.dirname(__file__), 'available.py')
+    # Copy the packaged module over when it's newer than the copy (e.g. after an upgrade), keeping
+    # the old copy in case it was edited
+    if not os.path.exists(avail_loc) or os.path.getmtime(pkg_avail_loc) > os.path.getmtime(avail_loc):
+        if os.path.exists(avail_loc) and not filecmp.cmp(pkg_avail_loc, avail_loc, shallow=False):
+            shutil.copy(avail_loc, avail_loc + '.bak')
         shutil.copy(pkg_avail_loc, avail_loc)
 
-    available = imp.load_source('available', avail_loc)
+    spec = importlib.util.spec_from_file_location('available', avail_loc)
+    available = importlib.util.module_from_spec(spec)
+    sys.modules['available'] = available
+    spec.loader.exec_module(available)
 
 # TAS: Comment this file and available.py
 
+## The station tables are parsed from the CSV files once, and then kept in a
+## pickled index in ~/.sharppy/cache, so later sessions can load them without
+## parsing the CSVs again.  An entry is used as long as the CSV file's mtime
+## and size haven't changed.
+
+STATION_CACHE_FN = os.path.join(os.path.expanduser("~"), ".sharppy", "cache", "stations.pkl")
+STATION_CACHE_VERSION = 1
+
+_station_tables = None
+_station_lock = threading.Lock()
+
+def _convert_points(points):
+    for pnt in points:
+        pnt['lat'] = float(pnt['lat'])
+        pnt['lon'] = float(pnt['lon'])
+        pnt['elev'] = int(pnt['elev'])
+
+def _read_station_cache():
+    try:
+        with open(STATION_CACHE_FN, 'rb') as f:
+            index = pickle.load(f)
+    except Exception:
+        return {}
+
+    if not isinstance(index, dict) or index.get('version') != STATION_CACHE_VERSION:
+        return {}
+    return index['tables']
+
+def _write_station_cache(tables):
+    # Don't keep tables for CSV files that are gone
+    tables = dict( (fn, tbl) for fn, tbl in tables.items() if os.path.exists(fn) )
+    try:
+        dirname = os.path.dirname(STATION_CACHE_FN)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmp_fn = "%s.%d.tmp" % (STATION_CACHE_FN, os.getpid())
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump({'version': STATION_CACHE_VERSION, 'tables': tables}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fn, STATION_CACHE_FN)
+    except (IOError, OSError) as e:
+        logging.exception(e)
+        logging.debug("Couldn't save the station cache.")
+
+def load_station_table(csv_fn):
+    """
+    Returns the fields and the points in a station CSV file, with the lat, lon
+    and elev converted to numbers. The points are shared by every outlet that
+    uses the file, so they shouldn't be modified.
+    """
+    global _station_tables
+    csv_fn = os.path.abspath(csv_fn)
+    stat = os.stat(csv_fn)
+
+    with _station_lock:
+        if _station_tables is None:
+            _station_tables = _read_station_cache()
+
+        entry = _station_tables.get(csv_fn)
+        if entry is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            return entry[2], entry[3]
+
+        logging.debug("Parsing the station file '%s'." % csv_fn)
+        csv_fields, points = loadCSV(csv_fn)
+        _convert_points(points)
+        _station_tables[csv_fn] = (stat.st_mtime, stat.st_size, csv_fields, points)
+        _write_station_cache(_station_tables)
+    return csv_fields, points
+
+# Seconds the outlets remember which times and stations are available, and which
+# outlet has a station's profile
+AVAIL_CACHE_TTL = 300
+
 class DataSourceError(Exception):
     pass
 
+class _TTLCache(object):
+    # A small dictionary cache whose entries expire after a number of seconds
+    def __init__(self, ttl=AVAIL_CACHE_TTL):
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, func, keep=None):
+        # keep is a function that says whether a value should be remembered
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                stored, value = self._entries[key]
+                if 0 <= now - stored < self._ttl:
+                    return value
+
+        value = func()
+        if keep is None or keep(value):
+            with self._lock:
+                self._entries[key] = (now, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+
+def _station_key(stn):
+    # A hashable key for a station point
+    return tuple( stn.get(field, '') for field in ('srcid', 'icao', 'iata', 'synop') )
+
 def loadDataSources(ds_dir=HOME_DIR):
     """
     Load the data source information from the XML files.
@@ -83,39 +200,105 @@ def loadDataSources(ds_dir=HOME_DIR):
                 print("This data source may not be loaded then.")
     return ds
 
+# Seconds to remember whether a host could be reached
+PING_TTL = 60
+
+_reachable = {}
+_reachable_lock = threading.Lock()
+_ping_executor = None
+
 def _pingURL(hostname, timeout=1):
     try:
-        urlopen(hostname, timeout=timeout, cafile=certifi.where())
+        urlopen(hostname, timeout=timeout, cafile=certifi.where()).close()
+    except HTTPError:
+        # The server answered, even if it didn't like the request
+        return True
     except URLError:
         return False
-    except socket.timeout as e:
+    except (socket.timeout, socket.error, ValueError) as e:
         return False
 
     return True
 
-def pingURLs(ds_dict):
+def _cachedPingURL(hostname, timeout=1):
+    now = time.time()
+    with _reachable_lock:
+        if hostname in _reachable:
+            stored, reachable = _reachable[hostname]
+            if 0 <= now - stored < PING_TTL:
+                return reachable
+
+    reachable = _pingURL(hostname, timeout=timeout)
+    with _reachable_lock:
+        _reachable[hostname] = (time.time(), reachable)
+    return reachable
+
+def pingHosts(urls, timeout=1, deadline=3, first_only=True):
     """
-    Try to ping all the URLs in any XML file.
-    Takes a dictionary associating data source names to DataSource objects.
-    Returns a dictionary associating URLs with a boolean specifying whether or not they were reachable.
+    Ping a list of URLs at the same time.
+    timeout:    Seconds to wait on each host.
+    deadline:   Seconds to wait for all the pings (None waits for all of them). DNS
+        lookups aren't covered by the timeout, so this bounds how long it takes.
+    first_only: If True, return as soon as any of the hosts answers.
+    Returns a dictionary associating the URLs with True or False if they were reachable
+    or not, or None if the ping didn't finish (or wasn't needed).
+    Results are remembered for PING_TTL seconds.
     """
-    urls = {}
+    urls = list(urls)
+    results = dict( (url, None) for url in urls )
+    if len(urls) == 0:
+        return results
 
+    pool = ThreadPoolExecutor(max_workers=min(len(urls), 16))
+    futures = dict( (pool.submit(_cachedPingURL, url, timeout), url) for url in urls )
+    try:
+        for fut in as_completed(futures, timeout=deadline):
+            url = futures[fut]
+            results[url] = fut.result()
+            if first_only and results[url]:
+                break
+    except FuturesTimeoutError:
+        logging.debug("Not every host answered the ping before the deadline.")
+    finally:
+        # Don't wait on the hosts that haven't answered
+        pool.shutdown(wait=False)
+    return results
+
+def _getBaseURLs(ds_dict):
+    urls = {}
     for ds in list(ds_dict.values()):
         ds_urls = ds.getURLList()
         for url in ds_urls:
             urlp = urlparse(url)
             base_url = urlunsplit((urlp.scheme, urlp.netloc, '', '', ''))
             urls[base_url] = None
+    return list(urls.keys())
 
-    for url in urls.keys():
-        urls[url] = _pingURL(url)
+def pingURLs(ds_dict, timeout=1, deadline=3):
+    """
+    Try to ping all the URLs in any XML file.
+    Takes a dictionary associating data source names to DataSource objects.
+    Returns a dictionary associating URLs with a boolean specifying whether or not they were reachable.
+    """
+    # Since we're only using this to check for an Internet connection, we can stop once one answers.
+    return pingHosts(_getBaseURLs(ds_dict), timeout=timeout, deadline=deadline, first_only=True)
 
-        if urls[url]:
-            # A bit of a hack. Since we're only using this to check for an Internet connection, we don't need to check
-            # any more if we find one.
-            break
-    return urls
+def pingURLsAsync(ds_dict, callback=None, timeout=1, deadline=3):
+    """
+    Like pingURLs(), but the pings happen in the background. Returns a
+    concurrent.futures.Future for the dictionary. If callback is given, it's
+    called with the dictionary when the pings are done (on the background thread).
+    """
+    global _ping_executor
+    if _ping_executor is None:
+        _ping_executor = ThreadPoolExecutor(max_workers=1)
+
+    # Get the URLs now, so the data sources aren't used from another thread
+    urls = _getBaseURLs(ds_dict)
+    fut = _ping_executor.submit(pingHosts, urls, timeout=timeout, deadline=deadline, first_only=True)
+    if callback is not None:
+        fut.add_done_callback(lambda f: callback(f.result()))
+    return fut
 
 class Outlet(object):
     """
@@ -128,12 +311,22 @@ class Outlet(object):
         self._url = config.get('url')
         self._format = config.get('format')
         self._time = config.find('time')
+
+        # Downloads from this outlet are served from the cache for this many seconds
+        # before the server is asked whether they've changed.
+        ttl = config.get('ttl')
+        if ttl is not None and self._url is not None:
+            http_cache.get_cache().setTTL(self._url.split('{')[0], int(ttl))
         point_csv = config.find('points')
         #self.start, self.end = self.getTimeSpan()
 
         # JTS - Parse remote CSVs from FTP site for NUCAPS data sources.
         # Read the NUCAPS data source, region, satellite ID, year, month, day and time info
         # from the temporary file and assign to local variables.
+        # The points themselves aren't loaded until they're needed, but the file is read
+        # now, since it's removed once the data sources have been reloaded.
+        self._points_csv = os.path.join(HOME_DIR, point_csv.get("csv"))
+        self._remote_csv = None
         if os.path.isfile(NUCAPS_times_file):
             file = open(NUCAPS_times_file)
             line = file.readlines()
@@ -151,22 +344,16 @@ class Outlet(object):
                 DAY = str(line.split(',')[5])
                 TIME = str(line.split(',')[6])
 
-                remote_csv = f'https://geo.nsstc.nasa.gov/SPoRT/jpss-pg/nucaps/gridded/{region}/sharppy/{satID}/csv/{YEAR}{MONTH}{DAY}{TIME}/{satID}_{region}.csv'
-                self._csv_fields, self._points = loadNUCAPS_CSV(remote_csv)
-            else:
-                # Do nothing if data source name in xml does not match the selected data source.
-                self._csv_fields, self._points = loadCSV(os.path.join(HOME_DIR, point_csv.get("csv")))
-        else:
-            # Parse local CSVs stored in ~/.sharppy/datasources for non-NUCAPS data sources.
-            self._csv_fields, self._points = loadCSV(os.path.join(HOME_DIR, point_csv.get("csv")))
+                self._remote_csv = f'https://geo.nsstc.nasa.gov/SPoRT/jpss-pg/nucaps/gridded/{region}/sharppy/{satID}/csv/{YEAR}{MONTH}{DAY}{TIME}/{satID}_{region}.csv'
+            # Otherwise, do nothing if data source name in xml does not match the selected data source.
 
-        for idx in range(len(self._points)):
-            self._points[idx]['lat'] = float(self._points[idx]['lat'])
-            self._points[idx]['lon'] = float(self._points[idx]['lon'])
-            self._points[idx]['elev'] = int(self._points[idx]['elev'])
+        self._csv_fields = None
+        self._points = None
+        self._point_idx = None
 
         self._custom_avail = self._name.lower() in available.available and self._ds_name.lower() in available.available[self._name.lower()]
         self._is_available = True
+        self._avail_cache = _TTLCache()
 
     def getTimeSpan(self):
         """
@@ -290,15 +477,9 @@ class Outlet(object):
             #avail = available.availableat[self._name.lower()][self._ds_name.lower()](dt)
             try:
                 avail = available.availableat[self._name.lower()][self._ds_name.lower()](dt)
-                stns_avail = []
-                points = self.getPoints()
-                srcids = [ p['srcid'] for p in points ]
-                for stn in avail:
-                    try:
-                        idx = srcids.index(stn)
-                        stns_avail.append(points[idx])
-                    except ValueError:
-                        pass
+                self._loadPoints()
+                srcid_idx = self._point_idx['srcid']
+                stns_avail = [ srcid_idx[stn] for stn in avail if stn in srcid_idx ]
 
                 self._is_available = True
 
@@ -346,26 +527,72 @@ class Outlet(object):
     def getDecoder(self):
         return decoder.getDecoder(self._format)
 
+    def _getStationIds(self, cycle):
+        # The sets of the station IDs available at a cycle
+        stns = self.getAvailableAtTime(dt=cycle)
+        return dict( (field, set( s.get(field, '') for s in stns )) for field in ('icao', 'iata', 'synop') )
+
     def hasProfile(self, point, cycle):
         logging.debug("Calling outlet.hasProfile() ")
-        times = self.getAvailableTimes(dt=cycle)
+        # The available times and stations are remembered for a few minutes, since
+        # resolving the outlet for one sounding asks about the same cycle several times.
+        times = self._avail_cache.get(('times', cycle), lambda: set(self.getAvailableTimes(dt=cycle)))
         has_prof = cycle in times
 
         if has_prof:
-            stns = self.getAvailableAtTime(dt=cycle)
-            if point['icao'] != '':
-                has_prof = point['icao'] in [ s['icao'] for s in stns ]
-            elif point['iata'] != '':
-                has_prof = point['iata'] in [ s['iata'] for s in stns ]
-            else:
-                has_prof = point['synop'] in [ s['synop'] for s in stns ]
+            stn_ids = self._avail_cache.get(('stns', cycle), lambda: self._getStationIds(cycle))
+            for field in ('icao', 'iata', 'synop'):
+                if point.get(field, '') != '' or field == 'synop':
+                    has_prof = point.get(field, '') in stn_ids[field]
+                    break
         return has_prof
 
+    def invalidate(self):
+        """
+        Forget the available times and stations, so they're looked up again.
+        """
+        self._avail_cache.invalidate()
+
+    def _loadPoints(self):
+        if self._points is not None:
+            return
+
+        if self._remote_csv is not None:
+            csv_fields, points = loadNUCAPS_CSV(self._remote_csv)
+            _convert_points(points)
+        else:
+            # Parse local CSVs stored in ~/.sharppy/datasources for non-NUCAPS data sources.
+            csv_fields, points = load_station_table(self._points_csv)
+
+        # Index the points by each kind of ID, so looking up stations doesn't mean
+        # scanning the whole list. The first point with an ID wins, like list.index().
+        point_idx = dict( (field, {}) for field in ('srcid', 'icao', 'iata', 'synop') )
+        for pnt in points:
+            for field, idx in point_idx.items():
+                stn_id = pnt.get(field, '')
+                if stn_id != '':
+                    idx.setdefault(stn_id, pnt)
+
+        self._csv_fields, self._point_idx = csv_fields, point_idx
+        self._points = points
+
     def getPoints(self):
+        self._loadPoints()
         points = self._points
         return points
 
+    def findPoint(self, stn_id):
+        """
+        Returns the point whose srcid, ICAO, IATA or SYNOP ID is stn_id, or None.
+        """
+        self._loadPoints()
+        for field in ('icao', 'iata', 'srcid', 'synop'):
+            if stn_id in self._point_idx[field]:
+                return self._point_idx[field][stn_id]
+        return None
+
     def getFields(self):
+        self._loadPoints()
         return self._csv_fields
 
     def isAvailable(self):
@@ -378,6 +605,7 @@ class DataSource(object):
         self._ensemble = config.get('ensemble').lower() == "true"
         self._observed = config.get('observed').lower() == "true"
         self._outlets = dict( (c.get('name'), Outlet(self._name, c)) for c in config )
+        self._outlet_cache = _TTLCache()
 
     def _get(self, name, outlet_num=None, flatten=True, **kwargs):
         prop = None
@@ -398,7 +626,10 @@ class DataSource(object):
 
     def _getOutletWithProfile(self, stn, cycle_dt, outlet_num=0):
         logging.debug("_getOutletWithProfile: " + str(stn) + ' ' + str(cycle_dt))
-        use_outlets = [ out for out, cfg in self._outlets.items() if cfg.hasProfile(stn, cycle_dt) ]
+        # Don't remember that no outlet has the profile, since it may just not be up yet
+        use_outlets = self._outlet_cache.get((_station_key(stn), cycle_dt),
+            lambda: [ out for out, cfg in self._outlets.items() if cfg.hasProfile(stn, cycle_dt) ],
+            keep=lambda outlets: len(outlets) > 0)
         try:
             outlet = use_outlets[outlet_num]
         except IndexError:
@@ -438,14 +669,22 @@ class DataSource(object):
         points = self._get('getAvailableAtTime', outlet_num=outlet_num, flatten=False, dt=dt)
 
         flatten_pts = []
-        flatten_coords = []
+        flatten_coords = set()
         for pt_list in points:
             for pt in pt_list:
                 if (pt['lat'], pt['lon']) not in flatten_coords:
-                    flatten_coords.append((pt['lat'], pt['lon']))
+                    flatten_coords.add((pt['lat'], pt['lon']))
                     flatten_pts.append(pt)
         return flatten_pts
 
+    def invalidate(self):
+        """
+        Forget which times, stations and outlets are available, so they're looked up again.
+        """
+        self._outlet_cache.invalidate()
+        for outlet in self._outlets.values():
+            outlet.invalidate()
+
     def getDecoder(self, stn, cycle_dt, outlet_num=0):
         outlet = self._getOutletWithProfile(stn, cycle_dt, outlet_num=outlet_num)
         decoder = self._outlets[outlet].getDecoder()
@@ -506,6 +745,12 @@ class DataSource(object):
         return self._observed
 
     def getPoint(self, stn):
+        for outlet in self._outlets.values():
+            pnt = outlet.findPoint(stn)
+            if pnt is not None:
+                return pnt
+
+        # Fall back on matching part of an ID (e.g. 'OAX' for 'KOAX')
         for outlet in self._outlets.items():
             for pnt in outlet[1].getPoints():
                 if stn in pnt['icao'] or stn in pnt['iata'] or stn in pnt['srcid']:
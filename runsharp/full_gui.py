@@ -18,8 +18,10 @@ from sutils.progress import progress
 from sutils.async_threads import AsyncThreads
 from sutils.ver_updates import check_latest
 from datasources import data_source
-from sharppy.io.arw_decoder import ARWDecoder
-from sharppy.io.decoder import getDecoders
+from sharppy.io.decoder import getDecoders, getDecoder
+import sharppy.io.http_cache as http_cache
+from sharppy.io.prefetch import PrefetchScheduler
+from sharppy.sharptab.prof_collection import shutdown_pools
 import sharppy.sharptab.profile as profile
 from sharppy.viz.preferences import PrefDialog
 from sharppy.viz.SPCWindow import SPCWindow
@@ -213,6 +215,7 @@ class Picker(QWidget):
     run_format = "%d %B %Y / %H%M UTC"
 
     async_obj = AsyncThreads(2, debug)
+    ping_done = Signal(dict)
 
     def __init__(self, config, **kwargs):
         """
@@ -235,8 +238,8 @@ class Picker(QWidget):
         self.all_times = sorted(self.data_sources[self.model].getAvailableTimes())
         self.run = [t for t in self.all_times if t.hour in [0, 12]][-1]
 
-        urls = data_source.pingURLs(self.data_sources)
-        self.has_connection = any(urls.values())
+        # Assume there's a connection until the ping (in the background) says otherwise
+        self.has_connection = True
         self.strictQC = True
 
         # JTS - list all overpass times for the selected day
@@ -245,6 +248,23 @@ class Picker(QWidget):
         # initialize the UI
         self.__initUI()
 
+        # The hosts are pinged at the same time, and the check gives up after a few seconds. The
+        # results come back through a signal, so they're handled on the GUI thread.
+        self.ping_done.connect(self.setConnection)
+        data_source.pingURLsAsync(self.data_sources, callback=self.ping_done.emit, timeout=1, deadline=3)
+
+    def setConnection(self, urls):
+        """
+        Handles the results of the ping of the data source hosts.
+        """
+        self.has_connection = any(urls.values())
+        self.view.hasInternet(self.has_connection)
+        # With no connection, serve whatever has been downloaded before without waiting on the network.
+        # Go back to the network once the ping has expired, in case the connection comes back.
+        http_cache.get_cache().setOffline(not self.has_connection, ttl=data_source.PING_TTL)
+        if self.loc is not None and self.model != "Local WRF-ARW":
+            self.button.setEnabled(self.has_connection)
+
     def __initUI(self):
         """
         Initialize the main user interface.
@@ -401,6 +421,8 @@ class Picker(QWidget):
         Update the dropdown list and the forecast times list if a new date
         is selected in the calendar app.
         """
+        # Look up what's available again, since new data may have come in
+        self.data_sources[self.model].invalidate()
 
         self.update_run_dropdown(updated_model=updated_model)
 
@@ -877,6 +899,10 @@ class Picker(QWidget):
                 logging.info("Data was found and successfully decoded!")
                 prof_collection = ret[0]
 
+                if model != "Local WRF-ARW":
+                    # Start loading what the user is likely to look at next
+                    prefetcher.prefetchAround(self.data_sources[model], self.loc, run, prof_idx)
+
             fhours = ["F%03d" % fh for idx, fh in enumerate(self.data_sources[self.model].getForecastHours()) if
                       idx in prof_idx]
 
@@ -888,10 +914,6 @@ class Picker(QWidget):
             prof_collection.setMeta('fhour', fhours)
             prof_collection.setMeta('observed', observed)
 
-            if not prof_collection.getMeta('observed'):
-                # If it's not an observed profile, then generate profile objects in background.
-                prof_collection.setAsync(Picker.async_obj)
-
             if self.skew is None:
                 logging.debug("Constructing SPCWindow")
                 # If the SPCWindow isn't shown, set it up.
@@ -900,6 +922,11 @@ class Picker(QWidget):
                 self.skew.closed.connect(self.skewAppClosed)
                 self.skew.show()
 
+            if not prof_collection.getMeta('observed'):
+                # If it's not an observed profile, then generate profile objects in background. The
+                # window shows the progress and steps through the times as they're ready.
+                prof_collection.setAsync(Picker.async_obj, *self.skew.conversionHooks())
+
             logging.debug("Focusing on the SkewApp")
             self.focusSkewApp()
             logging.debug("Adding the profile collection to SPCWindow")
@@ -933,9 +960,10 @@ class Picker(QWidget):
         """
         logging.debug(
             "Looping over all decoders to find which one to use to decode User Selected file.")
-        for decname, deccls in getDecoders().items():
+        for decname in getDecoders().keys():
             try:
-                dec = deccls(filename)
+                # Importing the decoder is inside the try, so one broken decoder doesn't stop the loop
+                dec = getDecoder(decname)(filename)
                 break
             except Exception as e:
                 logging.exception(e)
@@ -965,22 +993,42 @@ def loadData(data_source, loc, run, indexes, ntry=0, __text__=None, __prog__=Non
     if __text__ is not None:
         __text__.emit("Decoding File")
 
+    if data_source.getName() != "Local WRF-ARW" and ntry == 0:
+        profs = prefetcher.get(data_source, loc, run, indexes)
+        if profs is not None:
+            logging.info("Using the prefetched profiles")
+            return profs
+
+    profs = _loadCollection(data_source, loc, run, indexes, ntry=ntry, text=__text__)
+    return profs
+
+def _loadCollection(data_source, loc, run, indexes, ntry=0, text=None):
+    """
+    Downloads and decodes the data for a station and run.
+    """
     if data_source.getName() == "Local WRF-ARW":
         url = data_source.getURLList(outlet="Local")[0].replace("file://", "")
-        decoder = ARWDecoder
+        decoder = getDecoder('wrf-arw')
         dec = decoder((url, loc[0], loc[1]))
     else:
         decoder, url = data_source.getDecoderAndURL(loc, run, outlet_num=ntry)
         logging.info("Using decoder: " + str(decoder))
         logging.info("Data URL: " + url)
-        dec = decoder(url)
+        if decoder.supportsLazy():
+            # Only decode the forecast hours that were picked
+            dec = decoder(url, lazy=True)
+        else:
+            dec = decoder(url)
 
-    if __text__ is not None:
-        __text__.emit("Creating Profiles")
+    if text is not None:
+        text.emit("Creating Profiles")
 
     profs = dec.getProfiles(indexes=indexes)
     return profs
 
+# Loads the next runs and nearby stations in the background
+prefetcher = PrefetchScheduler(_loadCollection)
+
 
 class Main(QMainWindow):
     config_changed = Signal(Config)
@@ -1205,6 +1253,10 @@ class Main(QMainWindow):
         if os.path.isfile(NUCAPS_times_file):
             os.remove(NUCAPS_times_file)
 
+        prefetcher.shutdown()
+        logging.debug("Prefetch stats: " + str(prefetcher.getStats()))
+        # Stop the workers that convert the profiles in the background
+        shutdown_pools()
         self.config.toFile()
 
 def newerRelease(latest):
@@ -1 +1 @@
-__all__ = ['sars', 'pwv', 'inset_data', 'sars_cal']
+__all__ = ['sars', 'pwv', 'inset_data', 'sars_cal', 'sars_archive']
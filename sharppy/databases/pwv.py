@@ -31,38 +31,7 @@ def get_mean_pwv(station):
     and Kelton Halbert.
     
     '''
-    ## a rudimentary check to see what type of station identifier
-    ## was passed through
-
-    if station == None:
-        return np.ma.masked
-
-    if len(station) == 4:
-        id_index = 0
-        station = station.upper()
-    elif len(station) == 3:
-        id_index = 2
-        station = station.lower()
-    elif len(station) == 5:
-        id_index = 1
-    else:
-        #print "Invalid station ID"
-        return np.ma.masked
-
-    ## open the file, release the kraken!
-    ## get the arrays of station IDs
-    pwv_means = np.loadtxt(os.path.dirname( __file__) + '/PW-mean-inches.txt', skiprows=0, dtype=str, delimiter=',')
-    sites = pwv_means[1:, id_index]
-    ## get the index of the user supplied station - add 1 to account for the header
-    
-    station_idx = np.where( sites == station )[0]
-    if len(station_idx) == 0:
-        mean_pwv = np.ma.masked
-    else:
-        station_idx = station_idx + 1
-        ## get the PWV
-        mean_pwv = pwv_means[station_idx, 3:][0].astype(np.float)
-    return mean_pwv
+    return get_pw_database().getMean(station)
 
 def get_stdev_pwv(station):
     '''
@@ -85,34 +54,12 @@ def get_stdev_pwv(station):
         and Kelton Halbert.
         
         '''
-    ## a rudimentary check to see what type of station identifier
-    ## was passed through
     if station == None:
         return 0
-    if len(station) == 4:
-        id_index = 0
-        station = station.upper()
-    elif len(station) == 3:
-        id_index = 2
-        station = station.lower()
-    elif len(station) == 5:
-        id_index = 1
-    else:
+    if len(station) not in [3, 4, 5]:
         #print "Invalid station ID"
         return
-    ## open the file, release the kraken!
-    ## get the arrays of station IDs
-    pwv_stdevs = np.loadtxt(os.path.dirname( __file__) + '/PW-stdev-inches.txt', skiprows=0, dtype=str, delimiter=',')
-    sites = pwv_stdevs[1:, id_index]
-    ## get the index of the user supplied station - add 1 to account for the header
-    station_idx = np.where( sites == station )[0]
-    if len(station_idx) == 0:
-        stdev_pwv = np.ma.masked
-    else:
-        station_idx = station_idx + 1
-        ## get the PWV
-        stdev_pwv = pwv_stdevs[station_idx, 3:][0].astype(np.float)
-    return stdev_pwv
+    return get_pw_database().getStdev(station)
 
 def pwv_climo(prof, station, month=None):
     '''
@@ -130,6 +77,10 @@ def pwv_climo(prof, station, month=None):
     If the returned value is x, the PWV lies outside +x standard deviations of the mean
     If the returned value is -x, the PWV lies outside -x standard deviations of the mean
     If the returned value is 0, the PWV lies within 1 standard deviation of the mean
+
+    If the station isn't in the climatology, but the profile has a latitude and
+    longitude, the climatology is interpolated to the profile's location instead
+    (see PWDatabase.getFlags()).
     
     Written by Greg Blumberg
     and Kelton Halbert.
@@ -143,10 +94,12 @@ def pwv_climo(prof, station, month=None):
     # Load in the PWV mean and standard deviations
     pwv_means = get_mean_pwv(station)
     pwv_stds = get_stdev_pwv(station)
-    if pwv_means is np.ma.masked:
-        return 0
-    elif pwv_means is None:
-        return 0
+    if pwv_means is np.ma.masked or pwv_means is None:
+        lat = getattr(prof, 'latitude', np.ma.masked)
+        lon = getattr(prof, 'longitude', np.ma.masked)
+        if any(v is np.ma.masked or v is None for v in [pwv_300, lat, lon]):
+            return 0
+        return int(get_pw_database().getFlags(float(pwv_300), lat, lon, month)[0])
 
     month_mean = float(pwv_means[month-1])
     month_std = float(pwv_stds[month-1])
@@ -155,22 +108,26 @@ def pwv_climo(prof, station, month=None):
     sigma_2 = (month_mean - (2.*month_std), month_mean + (2.*month_std))
     sigma_3 = (month_mean - (3.*month_std), month_mean + (3.*month_std))
 
-    if len(np.where(pwv_300 > sigma_3[1])[0]) > 0:
+    if pwv_300 is np.ma.masked:
+        return 0
+    pwv_300 = float(pwv_300)
+
+    if pwv_300 > sigma_3[1]:
         # Means the PWV value is outside +3 sigma of the distribution
         flag = 3
-    elif len(np.where(pwv_300 < sigma_3[0])[0]) > 0:
+    elif pwv_300 < sigma_3[0]:
         # Means the PWV value is outside -3 sigma of the distribution
         flag = -3
-    elif len(np.where(pwv_300 > sigma_2[1])[0]) > 0:
+    elif pwv_300 > sigma_2[1]:
         # Means the PWV value is outside +2 sigma of the distribution
         flag = 2
-    elif len(np.where(pwv_300 < sigma_2[0])[0]) > 0:
+    elif pwv_300 < sigma_2[0]:
         # Means the PWV value is outside -2 sigma of the distribution
         flag = -2
-    elif len(np.where(pwv_300 > sigma_1[1])[0]) > 0:
+    elif pwv_300 > sigma_1[1]:
         # Means the PWV value is outside +1 sigma of the distribution
         flag = 1
-    elif len(np.where(pwv_300 < sigma_1[0])[0]) > 0:
+    elif pwv_300 < sigma_1[0]:
         # Means the PWV value is outside -1 sigma of the distribution
         flag = -1
     else:
@@ -179,45 +136,282 @@ def pwv_climo(prof, station, month=None):
 
     return flag
 
+def _load_climo(fname):
+    '''
+    Reads one of the PWV climatology files. Returns a list of the (ICAO, WMO,
+    3-letter) IDs of each station and an array of the monthly values.
+    '''
+    ids = []
+    vals = []
+    with open(fname, 'r') as climo_file:
+        climo_file.readline()
+        for line in climo_file:
+            fields = line.strip().split(',')
+            if len(fields) < 15:
+                continue
+            ids.append(tuple(fields[:3]))
+            vals.append([ float(v) for v in fields[3:15] ])
+    return ids, np.array(vals)
+
+def _delaunay(xs, ys):
+    '''
+    Computes the Delaunay triangulation of a set of points using the
+    Bowyer-Watson algorithm. Only meant for the small number of points in
+    the climatology.
+
+    Returns an array of shape (number of triangles, 3) with the indices of the
+    points making up each triangle.
+    '''
+    num_pts = len(xs)
+    span = max(np.ptp(xs), np.ptp(ys))
+    mid_x = 0.5 * (np.min(xs) + np.max(xs))
+    mid_y = 0.5 * (np.min(ys) + np.max(ys))
+
+    # Add a "super triangle" that contains all the points
+    pts_x = list(xs) + [mid_x - 20 * span, mid_x, mid_x + 20 * span]
+    pts_y = list(ys) + [mid_y - span, mid_y + 20 * span, mid_y - span]
+
+    def circumcircle(tri):
+        ax, bx, cx = [ pts_x[i] for i in tri ]
+        ay, by, cy = [ pts_y[i] for i in tri ]
+        d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        ux = ((ax**2 + ay**2) * (by - cy) + (bx**2 + by**2) * (cy - ay) + (cx**2 + cy**2) * (ay - by)) / d
+        uy = ((ax**2 + ay**2) * (cx - bx) + (bx**2 + by**2) * (ax - cx) + (cx**2 + cy**2) * (bx - ax)) / d
+        return ux, uy, (ax - ux)**2 + (ay - uy)**2
+
+    tris = { (num_pts, num_pts + 1, num_pts + 2): circumcircle((num_pts, num_pts + 1, num_pts + 2)) }
+    for idx in range(num_pts):
+        px, py = pts_x[idx], pts_y[idx]
+        bad = [ tri for tri, (ux, uy, r2) in tris.items() if (px - ux)**2 + (py - uy)**2 < r2 ]
+
+        # The boundary of the hole left by the bad triangles is made of the
+        # edges that only belong to one of them.
+        edges = {}
+        for tri in bad:
+            for edge in ((tri[0], tri[1]), (tri[1], tri[2]), (tri[2], tri[0])):
+                key = tuple(sorted(edge))
+                edges[key] = edges.get(key, 0) + 1
+            del tris[tri]
+
+        for (v1, v2), count in edges.items():
+            if count == 1:
+                tri = (v1, v2, idx)
+                tris[tri] = circumcircle(tri)
+
+    tris = [ tri for tri in tris.keys() if max(tri) < num_pts ]
+    return np.array(tris, dtype=int).reshape((-1, 3))
+
 class PWDatabase(object):
+    '''
+    The precipitable water climatology from Matt Bunkers (NWS/UNR). The
+    climatology files are read once, the stations are indexed by all of their
+    identifiers, and the stations with known locations are triangulated so
+    the climatology can be interpolated to any point inside the network.
+    '''
     def __init__(self, data_path=os.path.dirname(__file__)):
-        self._pwv_mn_fields, self._pwv_mn = loadCSV(os.path.join(data_path, 'PW-mean-inches.txt'))
-        self._pwv_st_fields, self._pwv_st = loadCSV(os.path.join(data_path, 'PW-stdev-inches.txt'))
-        stn_fields, stns = loadCSV(os.path.join(os.path.dirname(__file__), '..', '..', 'datasources', 'spc_ua.csv'))
-
-        stn_ids = [ stn['icao'] for stn in stns ]
-        for idx in range(len(self._pwv_mn)):
-            try:
-                stn_idx = stn_ids.index(self._pwv_mn['SITE'])
-
-                self._pwv_mn['lat'] = stns[stn_idx]['lat']
-                self._pwv_mn['lon'] = stns[stn_idx]['lon']
-                self._pwv_st['lat'] = stns[stn_idx]['lat']
-                self._pwv_st['lon'] = stns[stn_idx]['lon']
-            except IndexError as e:
-                logging.exception(e)
-                pass
-
-    def getStddev(self, stddev, loc, month=None):
-        pass
-
-    def getClimo(self, loc, month=None):
-        pass
-
-    def _triangleInterp(self, lat, lon, pt_lats, pt_lons, pt_vals, tris):
-        tri_lats = pt_lats[tris].T
-        tri_lons = pt_lons[tris].T
-        tri_areas = 0.5 * (-tri_lats[1] * tri_lons[2] + tri_lats[0] * (tri_lons[2] - tri_lons[1]) + tri_lons[0] * (tri_lats[1] - tri_lats[2]) + tri_lons[1] * tri_lats[2])
-        s = 1. / (2. * tri_areas) * (tri_lats[0] * tri_lons[2] - tri_lons[0] * tri_lats[2] + (tri_lats[2] - tri_lats[0]) * lon + (tri_lons[0] - tri_lons[2]) * lat)
-        t = 1. / (2. * tri_areas) * (tri_lons[0] * tri_lats[1] - tri_lats[0] * tri_lons[1] + (tri_lats[0] - tri_lats[1]) * lon + (tri_lons[1] - tri_lons[0]) * lat)
-
-        tris_select = np.where((s >= 0) & (t >= 0) & (1 - s - t >= 0))[0]
-
-        if len(tris_select) == 0:
-            val = None
-        else:
-            tri = tris_select[0]
-            tri_vals = pt_vals[tris[tri]]
-            val = s[tri] * tri_vals[1] + t[tri] * tri_vals[2] + (1 - s[tri] - t[tri]) * tri_vals[0]
-
-        return val
+        stn_ids, self._means = _load_climo(os.path.join(data_path, 'PW-mean-inches.txt'))
+        stdev_ids, stdevs = _load_climo(os.path.join(data_path, 'PW-stdev-inches.txt'))
+        stdev_idx = dict( (ids[0], idx) for idx, ids in enumerate(stdev_ids) )
+        self._stdevs = np.array([ stdevs[stdev_idx[ids[0]]] for ids in stn_ids ])
+
+        # Index the stations by the ICAO, WMO, and 3-letter IDs. The 3-letter
+        # IDs are lower case in the file, so they can't collide with the others.
+        self._stn_idx = {}
+        for idx, ids in enumerate(stn_ids):
+            for stn in ids:
+                self._stn_idx.setdefault(stn, idx)
+
+        self._lats = np.ma.masked_all(len(stn_ids))
+        self._lons = np.ma.masked_all(len(stn_ids))
+        try:
+            stn_fields, stns = loadCSV(os.path.join(os.path.dirname(__file__), '..', '..', 'datasources', 'spc_ua.csv'))
+        except IOError as e:
+            logging.exception(e)
+            stns = []
+
+        stn_locs = dict( (stn['icao'], (float(stn['lat']), float(stn['lon']))) for stn in stns )
+        for idx, ids in enumerate(stn_ids):
+            if ids[0] in stn_locs:
+                self._lats[idx], self._lons[idx] = stn_locs[ids[0]]
+
+        self._buildTriangulation()
+
+    def _buildTriangulation(self, num_cells=32):
+        # Triangulate the stations with a known location and precompute the
+        # barycentric coordinate transform for each triangle. Then bin the
+        # triangles into a regular grid of cells so a point only has to be
+        # checked against the few triangles that overlap its cell.
+        self._tri_stns = np.where(~np.ma.getmaskarray(self._lats))[0]
+        lats = np.ma.filled(self._lats[self._tri_stns], np.nan)
+        lons = np.ma.filled(self._lons[self._tri_stns], np.nan)
+
+        if len(self._tri_stns) < 3:
+            self._tris = np.empty((0, 3), dtype=int)
+            self._cells = np.full((1, 1, 1), -1, dtype=int)
+            self._grid = (0., 0., 1., 1.)
+            return
+
+        tris = _delaunay(lons, lats)
+        self._tris = self._tri_stns[tris]
+
+        tri_lons = lons[tris]
+        tri_lats = lats[tris]
+        # Barycentric transform: (s, t) = inv(T) * (pt - vertex 0)
+        dx1 = tri_lons[:, 1] - tri_lons[:, 0]
+        dx2 = tri_lons[:, 2] - tri_lons[:, 0]
+        dy1 = tri_lats[:, 1] - tri_lats[:, 0]
+        dy2 = tri_lats[:, 2] - tri_lats[:, 0]
+        det = dx1 * dy2 - dx2 * dy1
+        self._tri_origin = np.array([tri_lons[:, 0], tri_lats[:, 0]]).T
+        self._tri_inv = np.array([[dy2, -dx2], [-dy1, dx1]]).transpose(2, 0, 1) / det[:, np.newaxis, np.newaxis]
+
+        lon_min, lon_max = lons.min(), lons.max()
+        lat_min, lat_max = lats.min(), lats.max()
+        dlon = (lon_max - lon_min) / num_cells
+        dlat = (lat_max - lat_min) / num_cells
+        self._grid = (lon_min, lat_min, dlon, dlat)
+
+        cells = [ [ [] for i in range(num_cells) ] for j in range(num_cells) ]
+        for tri_idx in range(len(tris)):
+            i_lo, i_hi = np.clip(((tri_lons[tri_idx].min() - lon_min) / dlon, (tri_lons[tri_idx].max() - lon_min) / dlon), 0, num_cells - 1).astype(int)
+            j_lo, j_hi = np.clip(((tri_lats[tri_idx].min() - lat_min) / dlat, (tri_lats[tri_idx].max() - lat_min) / dlat), 0, num_cells - 1).astype(int)
+            for j in range(j_lo, j_hi + 1):
+                for i in range(i_lo, i_hi + 1):
+                    cells[j][i].append(tri_idx)
+
+        max_tris = max(len(cell) for row in cells for cell in row)
+        self._cells = np.full((num_cells, num_cells, max(max_tris, 1)), -1, dtype=int)
+        for j in range(num_cells):
+            for i in range(num_cells):
+                self._cells[j, i, :len(cells[j][i])] = cells[j][i]
+
+    def getStationIndex(self, station):
+        '''
+        Returns the index of a station in the climatology, or None if the
+        station isn't in the climatology.
+
+        station: Can be the 4 letter station ID (i.e. KOUN), 3 letter station
+            ID (i.e. OUN), or the 5 digit WMO ID (i.e. 72357).
+        '''
+        if station is None:
+            return None
+        if len(station) == 4:
+            station = station.upper()
+        elif len(station) == 3:
+            station = station.lower()
+        elif len(station) != 5:
+            return None
+        return self._stn_idx.get(station, None)
+
+    def getMean(self, station):
+        '''
+        Returns the mean PWV (inches) for every month of the year at a station,
+        or np.ma.masked if the station isn't in the climatology.
+        '''
+        idx = self.getStationIndex(station)
+        return np.ma.masked if idx is None else self._means[idx].copy()
+
+    def getStdev(self, station):
+        '''
+        Returns the standard deviation of the PWV (inches) for every month of
+        the year at a station, or np.ma.masked if the station isn't in the
+        climatology.
+        '''
+        idx = self.getStationIndex(station)
+        return np.ma.masked if idx is None else self._stdevs[idx].copy()
+
+    def locate(self, lats, lons):
+        '''
+        Finds the triangles of the station network containing a set of points.
+
+        Returns the triangle index (-1 for points outside the network) and
+        the barycentric coordinates of the points with respect to the
+        vertices of those triangles.
+        '''
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        num_cells = self._cells.shape[0]
+        lon_min, lat_min, dlon, dlat = self._grid
+
+        with np.errstate(invalid='ignore'):
+            i = np.floor((lons - lon_min) / dlon)
+            j = np.floor((lats - lat_min) / dlat)
+        # Points on the far edge of the grid belong to the last cell
+        i = np.where((lons == lon_min + num_cells * dlon), num_cells - 1, i)
+        j = np.where((lats == lat_min + num_cells * dlat), num_cells - 1, j)
+        inside = (i >= 0) & (i < num_cells) & (j >= 0) & (j < num_cells)
+
+        cand = np.full((len(lats), self._cells.shape[2]), -1, dtype=int)
+        cand[inside] = self._cells[j[inside].astype(int), i[inside].astype(int)]
+        cand_tri = np.where(cand >= 0, cand, 0)
+
+        tri_idx = np.full(len(lats), -1, dtype=int)
+        weights = np.zeros((len(lats), 3))
+        if len(self._tris) == 0:
+            return tri_idx, weights
+
+        # Barycentric coordinates of every point for each candidate triangle
+        dpt = np.array([lons, lats]).T[:, np.newaxis, :] - self._tri_origin[cand_tri]
+        st = np.einsum('nkij,nkj->nki', self._tri_inv[cand_tri], dpt)
+        s, t = st[..., 0], st[..., 1]
+        eps = 1e-9
+        valid = (cand >= 0) & (s >= -eps) & (t >= -eps) & (1 - s - t >= -eps)
+
+        found = valid.any(axis=1)
+        first = np.argmax(valid, axis=1)
+        rows = np.arange(len(lats))
+        tri_idx[found] = cand[rows, first][found]
+        s, t = s[rows, first], t[rows, first]
+        weights[found] = np.array([1 - s - t, s, t]).T[found]
+        return tri_idx, weights
+
+    def getClimo(self, lats, lons, months):
+        '''
+        Interpolates the PWV climatology to a set of points.
+
+        lats, lons: The locations of the points (degrees)
+        months: The month (1-12) for each point
+
+        Returns the mean and standard deviation of the PWV (inches) at each
+        point as masked arrays. Points outside of the station network are masked.
+        '''
+        tri_idx, weights = self.locate(lats, lons)
+        months = np.broadcast_to(np.asarray(months, dtype=int), tri_idx.shape) - 1
+
+        found = tri_idx >= 0
+        verts = self._tris[np.where(found, tri_idx, 0)] if len(self._tris) > 0 else np.zeros((len(tri_idx), 3), dtype=int)
+        mean = np.sum(weights * self._means[verts, months[:, np.newaxis]], axis=1)
+        stdev = np.sum(weights * self._stdevs[verts, months[:, np.newaxis]], axis=1)
+        return np.ma.masked_where(~found, mean), np.ma.masked_where(~found, stdev)
+
+    def getFlags(self, pwv, lats, lons, months):
+        '''
+        Computes the location of PWV values with respect to the climatology,
+        like pwv_climo(), but for any number of points at once.
+
+        pwv: The PWV values (inches)
+        lats, lons: The locations of the points (degrees)
+        months: The month (1-12) for each point
+
+        Returns an array of flags between -3 and 3. Points outside of the
+        station network get a flag of 0.
+        '''
+        mean, stdev = self.getClimo(lats, lons, months)
+        pwv = np.ma.asarray(pwv, dtype=float)
+        flags = np.zeros(mean.shape, dtype=int)
+        # Go from the smallest departure to the largest, so the largest one wins
+        for sigma in [1, 2, 3]:
+            flags = np.where(np.ma.filled(pwv < mean - sigma * stdev, False), -sigma, flags)
+            flags = np.where(np.ma.filled(pwv > mean + sigma * stdev, False), sigma, flags)
+        return flags
+
+_pw_database = None
+
+def get_pw_database():
+    '''
+    Returns the process-wide PWDatabase, loading it the first time.
+    '''
+    global _pw_database
+    if _pw_database is None:
+        _pw_database = PWDatabase()
+    return _pw_database
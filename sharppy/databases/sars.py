@@ -1,4 +1,5 @@
 import numpy as np
+import numpy.ma as ma
 import os
 #import sharppy.io.spc_decoder as spc_decoder
 
@@ -9,6 +10,250 @@ import os
 ## Routines implemented in Python by Greg Blumberg - CIMMS and Kelton Halbert (OU SoM)
 ## wblumberg@ou.edu, greg.blumberg@noaa.gov, kelton.halbert@noaa.gov, keltonhalbert@ou.edu
 
+## Columns of the SARS database files used in the matching
+SUPERCELL_COLUMNS = {'category': 1, 'mlcape': 3, 'mllcl': 5, 'srh': 6, 'shr': 7, 'h5temp': 9,
+                     'lr': 11, 'shr3k': 12, 'shr9k': 13, 'srh3': 14}
+HAIL_COLUMNS = {'size': 2, 'mucape': 3, 'mumr': 4, 'h5temp': 5, 'lr': 7, 'shr3': 9,
+                'shr6': 10, 'shr9': 11, 'srh': 12}
+
+## Fixed matching ranges (value +/- range).  The ranges that depend on the
+## sounding's own values are set in supercell_ranges() and hail_ranges().
+SUPERCELL_LOOSE_RANGES = {'mlcape': 1300, # J/kg
+                          'mllcl': 500,   # m
+                          'shr': 14,      # kts
+                          'h5temp': 7,    # C
+                          'lr': 1.0}      # C/km
+SUPERCELL_QUALITY_RANGES = {'mllcl': 200, # m
+                            'shr': 10,    # kts
+                            'h5temp': 5,  # C
+                            'lr': 0.8,    # C/km
+                            'shr3k': 15,  # kts
+                            'shr9k': 25}  # kts
+HAIL_LOOSE_RANGES = {'mumr': 2.0,  # g/kg
+                     'lr': 2.0,    # C/km
+                     'h5temp': 9,  # C
+                     'shr6': 12,   # m/s
+                     'shr9': 22,   # m/s
+                     'shr3': 10}   # m/s
+HAIL_QUALITY_RANGES = {'mumr': 2.0,   # g/kg
+                       'lr': 0.4,     # C/km
+                       'h5temp': 1.5, # C
+                       'shr6': 6,     # m/s
+                       'shr9': 15,    # m/s
+                       'shr3': 8}     # m/s
+
+def _select(cond, if_true, if_false):
+    # Scalars go through a plain if, so a masked condition picks if_false just
+    # like the original if/else chains did.  Arrays use np.where.
+    if np.ndim(cond) == 0:
+        return if_true if cond else if_false
+    return np.where(cond, if_true, if_false)
+
+def supercell_ranges(mlcape, srh, srh3):
+    '''
+    Returns the ranges for the loose and quality supercell matches. Works on
+    scalars or on arrays with one entry per sounding.
+
+    Parameters
+    ----------
+    mlcape - the mixed layer cape (J/kg)
+    srh - the 0-1km storm relative helicity (m^2/s^2)
+    srh3 - the 0-3km storm relative helicity (m^2/s^2)
+
+    Returns
+    -------
+    loose: dict of the ranges for the loose matches
+    quality: dict of the ranges for the quality (tier 1) matches
+    '''
+    loose = dict(SUPERCELL_LOOSE_RANGES)
+    loose['mlcape'] = _select(mlcape == 0, 0., loose['mlcape'])
+    loose['srh'] = _select(np.abs(srh) < 50, 100., srh)
+
+    quality = dict(SUPERCELL_QUALITY_RANGES)
+    quality['mlcape'] = mlcape * 0.25
+    quality['srh'] = _select(np.abs(srh) < 100, 50., np.abs(srh) * 0.30)
+    quality['srh3'] = _select(np.abs(srh3) < 100, 50., np.abs(srh3) * 0.50)
+    return loose, quality
+
+def hail_ranges(mucape, srh):
+    '''
+    Returns the ranges for the loose and quality hail matches. Works on
+    scalars or on arrays with one entry per sounding.
+
+    Parameters
+    ----------
+    mucape - most unstable CAPE (J/kg)
+    srh - 0-3 Storm Relative Helicity (m2/s2)
+
+    Returns
+    -------
+    loose: dict of the ranges for the loose matches
+    quality: dict of the ranges for the quality (tier 1) matches
+    '''
+    loose = dict(HAIL_LOOSE_RANGES)
+    loose['mucape'] = mucape * .30
+
+    quality = dict(HAIL_QUALITY_RANGES)
+    quality['mucape'] = _select(mucape < 500., mucape * .50,
+                                _select(mucape < 2000., mucape * .25, mucape * .20))
+    quality['srh'] = _select(srh < 50, 25., srh * 0.5)
+    return loose, quality
+
+class RangeIndex(object):
+    """
+    A sorted-column index over the numeric columns of an analogue database.
+
+    Every column is argsorted once when the index is built. A query is a set of
+    tolerance boxes (value +/- range) on some of the columns. The candidate rows
+    for each box are found by bisecting the sorted columns, the most selective
+    box is kept, and then all of the boxes are evaluated exactly on those
+    candidates only. The rows returned are therefore identical to (and in the
+    same order as) a brute force search over the whole database.
+    """
+    def __init__(self, columns):
+        '''
+        Parameters
+        ----------
+        columns : dict
+            Mapping of the variable names to 1D arrays of equal length
+        '''
+        self._cols = {}
+        self._order = {}
+        self._sorted = {}
+        self.size = 0
+        for name, col in columns.items():
+            col = np.asarray(col, dtype=float)
+            order = np.argsort(col, kind='mergesort')
+            self._cols[name] = col
+            self._order[name] = order
+            self._sorted[name] = col[order]
+            self.size = len(col)
+
+    def column(self, name):
+        return self._cols[name]
+
+    def _candidates(self, name, value, rng):
+        # Returns the rows that could satisfy a single tolerance box, or None
+        # if the box can't be bisected (e.g. a masked or NaN value).
+        if value is ma.masked or rng is ma.masked:
+            return None
+        try:
+            lo = float(value - rng)
+            hi = float(value + rng)
+        except (TypeError, ValueError):
+            return None
+        if not (np.isfinite(lo) and np.isfinite(hi)):
+            return None
+        if hi < lo:
+            return np.empty(0, dtype=int)
+
+        # Pad the bounds a little so round-off in (value - range) compared to
+        # (col - range) never drops a row.  The exact test is done in query().
+        pad = 1e-6 * max(1., abs(lo), abs(hi))
+        srt = self._sorted[name]
+        start = np.searchsorted(srt, lo - pad, side='left')
+        end = np.searchsorted(srt, hi + pad, side='right')
+        return self._order[name][start:end]
+
+    def query(self, criteria):
+        """
+        Find the rows matching every criterion.
+
+        Parameters
+        ----------
+        criteria : dict
+            Mapping of variable names to (value, range) tuples. A row matches
+            if value >= col - range and value <= col + range for every entry.
+
+        Returns
+        -------
+        1D array of the row indices of the matches, in ascending order
+        """
+        best = None
+        for name, (value, rng) in criteria.items():
+            cand = self._candidates(name, value, rng)
+            if cand is not None and (best is None or len(cand) < len(best)):
+                best = cand
+                if len(best) == 0:
+                    return best
+
+        if best is None:
+            best = np.arange(self.size)
+        else:
+            best = np.sort(best)
+
+        match = np.ones(len(best), dtype=bool)
+        for name, (value, rng) in criteria.items():
+            col = self._cols[name][best]
+            match &= (value >= (col - rng)) & (value <= (col + rng))
+        return best[np.where(match)[0]]
+
+    def query_batch(self, criteria, chunk_size=256):
+        """
+        Find the rows matching every criterion for many queries at once. The
+        tolerance boxes are evaluated against the whole database as a 2D
+        (query x row) mask, a chunk of queries at a time to bound the memory
+        used.
+
+        Parameters
+        ----------
+        criteria : dict
+            Mapping of variable names to (values, ranges) tuples, where values
+            and ranges are 1D arrays with one entry per query.
+        chunk_size : int
+            The number of queries to evaluate at a time
+
+        Returns
+        -------
+        List of 1D arrays of the row indices of the matches for each query
+        """
+        criteria = dict( (name, (np.ma.filled(np.ma.asarray(value, dtype=float), np.nan),
+                                 np.ma.filled(np.ma.asarray(rng, dtype=float), np.nan)))
+                         for name, (value, rng) in criteria.items() )
+        num_queries = max(len(np.atleast_1d(value)) for value, rng in criteria.values())
+
+        matches = []
+        for start in range(0, num_queries, chunk_size):
+            end = min(start + chunk_size, num_queries)
+            match = np.ones((end - start, self.size), dtype=bool)
+            for name, (value, rng) in criteria.items():
+                col = self._cols[name][np.newaxis, :]
+                value = np.broadcast_to(value, (num_queries,))[start:end, np.newaxis]
+                rng = np.broadcast_to(rng, (num_queries,))[start:end, np.newaxis]
+                match &= (value >= (col - rng)) & (value <= (col + rng))
+            matches.extend(np.where(m)[0] for m in match)
+        return matches
+
+_database_cache = {}
+
+def load_database(database_fn, columns, comments='#'):
+    """
+    Loads a SARS database file and builds a RangeIndex over its columns. The
+    result is cached on the file name and modification time, so a database is
+    only read again if it changes on disk.
+
+    Parameters
+    ----------
+    database_fn : str
+        Filename of the database (relative to this directory, or absolute)
+    columns : dict
+        Mapping of the variable names to the column numbers to index
+    comments : str
+        The comment string passed to np.loadtxt
+
+    Returns
+    -------
+    database : 2D array of bytes with the raw contents of the database
+    index : RangeIndex over the requested columns
+    """
+    database_fn = os.path.join( os.path.dirname( __file__ ), database_fn )
+    key = (database_fn, os.path.getmtime(database_fn), tuple(sorted(columns.items())), comments)
+    if key not in _database_cache:
+        database = np.loadtxt(database_fn, skiprows=1, dtype=bytes, comments=comments)
+        index = RangeIndex(dict( (name, np.asarray(database[:,col], dtype=float)) for name, col in columns.items() ))
+        _database_cache[key] = (database, index)
+    return _database_cache[key]
+
 def supercell(database_fn, mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, srh3):
     '''
     The SARS Supercell database was provided by Rich Thompson of the 
@@ -76,72 +321,17 @@ def supercell(database_fn, mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, sr
     num_matches: The number of weak and sig matches in the loose matches
     tor_prob: SARS sig. tornado probability
     '''
-    # Open and read the file
-    database_fn = os.path.join( os.path.dirname( __file__ ), database_fn)
-    supercell_database = np.loadtxt(database_fn, skiprows=1, dtype=bytes, comments="%%%%")
+    # Open and read the file (cached after the first call)
+    supercell_database, index = load_database(database_fn, SUPERCELL_COLUMNS, comments="%%%%")
 
     # Set range citeria for matching soundings
-    # MLCAPE ranges
-    if mlcape == 0:
-        range_mlcape = 0
-    else:
-        range_mlcape = 1300 # J/kg
-    range_mlcape_t1 = mlcape * 0.25 # J/kg
-
-    # MLLCL ranges
-    range_mllcl = 500 # m
-    range_mllcl_t1 = 200 # m
+    loose, quality = supercell_ranges(mlcape, srh, srh3)
+    values = {'mlcape': mlcape, 'mllcl': mllcl, 'shr': shr, 'srh': srh, 'h5temp': h5temp,
+              'lr': lr, 'shr3k': shr3k, 'shr9k': shr9k, 'srh3': srh3}
+    mat_category = index.column('category') # category of match (0=non, 1=weak, 2=sig)
 
-    # 0-6 km shear ranges (kts)
-    range_shr = 14
-    range_shr_t1 = 10
-
-    # 0-1 km SRH Ranges (m2/s2)
-    if np.abs(srh) < 50:
-        range_srh = 100.
-    else:
-        range_srh = srh
-
-    if np.abs(srh) < 100:
-        range_srh_t1 = 50
-    else:
-        range_srh_t1 = np.abs(srh) * 0.30
-
-    # 0-3 SRH tier 1 ranges (m2/s2)
-    if np.abs(srh3) < 100:
-        range_srh3_t1 = 50.
-    else:
-        range_srh3_t1 = np.abs(srh3) * 0.50
-
-    # 500 mb temperature ranges
-    range_temp = 7 # C
-    range_temp_t1 = 5 # C
-
-    # 700-500 mb lapse rate ranges (C/km)
-    range_lr = 1.0
-    range_lr_t1 = 0.8
-
-    # 3 km and 9 km shear matching
-    range_shr3k_t1 = 15
-    range_shr9k_t1 = 25
-    ## Read in the columns for each variable
-    mat_category = np.asarray(supercell_database[:,1], dtype=float) # category of match (0=non, 1=weak, 2=sig)
-    mat_mlcape = np.asarray(supercell_database[:,3], dtype=float)
-    mat_mllcl = np.asarray(supercell_database[:,5], dtype=float)
-    mat_shr = np.asarray(supercell_database[:,7], dtype=float) # 0-6 KM SHEAR
-    mat_srh = np.asarray(supercell_database[:,6], dtype=float) # 0-1 KM SRH
-    mat_srh3 = np.asarray(supercell_database[:,14], dtype=float) # 0-3 KM SRH
-    mat_h5temp = np.asarray(supercell_database[:,9], dtype=float) # 500 MB TEMP C
-    mat_lr75 = np.asarray(supercell_database[:,11], dtype=float) # 700-500 MB LAPSE RATE
-    mat_shr3 = np.asarray(supercell_database[:,12], dtype=float) # 0-3 KM SHEAR
-    mat_shr9 = np.asarray(supercell_database[:,13], dtype=float) # 0-9 KM SHEAR
     ## Get the loose matches
-    loose_match_idx = np.where((mlcape >= (mat_mlcape - range_mlcape)) & (mlcape <= (mat_mlcape + range_mlcape)) & \
-                               (mllcl >= (mat_mllcl - range_mllcl)) & (mllcl <= (mat_mllcl + range_mllcl)) & \
-                               (shr >= (mat_shr - range_shr)) & (shr <= (mat_shr + range_shr)) & \
-                               (srh >= (mat_srh - range_srh)) & (srh <= (mat_srh + range_srh)) & \
-                               (h5temp >= (mat_h5temp - range_temp)) & (h5temp <= (mat_h5temp + range_temp)) & \
-                               (lr >= (mat_lr75 - range_lr)) & (lr <= (mat_lr75 + range_lr)))[0]
+    loose_match_idx = index.query(dict( (name, (values[name], rng)) for name, rng in loose.items() ))
 
     num_matches = len(np.where(mat_category[loose_match_idx] > 0)[0]) #number of weak and sig matches in the loose matches
 
@@ -152,15 +342,7 @@ def supercell(database_fn, mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, sr
         tor_prob = 0.
 
     # Tier 1 matches (also known as the quality matches)
-    quality_match_idx = np.where((mlcape >= (mat_mlcape - range_mlcape_t1)) & (mlcape <= (mat_mlcape + range_mlcape_t1)) & \
-                               (mllcl >= (mat_mllcl - range_mllcl_t1)) & (mllcl <= (mat_mllcl + range_mllcl_t1)) & \
-                               (shr >= (mat_shr - range_shr_t1)) & (shr <= (mat_shr + range_shr_t1)) & \
-                               (srh >= (mat_srh - range_srh_t1)) & (srh <= (mat_srh + range_srh_t1)) & \
-                               (h5temp >= (mat_h5temp - range_temp_t1)) & (h5temp <= (mat_h5temp + range_temp_t1)) & \
-                               (lr >= (mat_lr75 - range_lr_t1)) & (lr <= (mat_lr75 + range_lr_t1)) & \
-                               (shr3k >= (mat_shr3 - range_shr3k_t1)) & (shr3k <= (mat_shr3 + range_shr3k_t1)) & \
-                               (shr9k >= (mat_shr9 - range_shr9k_t1)) & (shr9k <= (mat_shr9 + range_shr9k_t1)) & \
-                               (srh3 >= (mat_srh3 - range_srh3_t1)) & (srh3 <= (mat_srh3 + range_srh3_t1)))[0]
+    quality_match_idx = index.query(dict( (name, (values[name], rng)) for name, rng in quality.items() ))
 
     quality_match_soundings = supercell_database[:,0][quality_match_idx]
     quality_match_tortype = np.asarray(supercell_database[:,1][quality_match_idx], dtype='|S7')
@@ -174,6 +356,69 @@ def supercell(database_fn, mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, sr
 
     return quality_match_soundings, quality_match_tortype, len(loose_match_idx), num_matches, tor_prob
 
+def supercell_batch(database_fn, mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, srh3):
+    '''
+    Vectorized version of the SARS supercell matching for many soundings at
+    once. The database is loaded once and shared, and the matching criteria
+    for all of the soundings are evaluated as arrays. The ranges used and the
+    matches found are the same as those in supercell().
+
+    Parameters
+    ----------
+    database_fn - filename of the database
+    mlcape - the mixed layer cape (J/kg)
+    mllcl - the mixed layer LCL (m)
+    h5temp - the 500mb temp (C)
+    lr - the 700-500mb lapse rate (C/km)
+    shr - the 0-1km shear (kts)
+    srh - the 0-1km storm relative helicity (m^2/s^2)
+    shr3k - the 0-3km shear (kts)
+    shr9k - the 0-9km shear (kts)
+    srh3 - the 0-3km storm relative helicity (m^2/s^2)
+
+    All of the parameters (except database_fn) are 1D arrays with one entry
+    per sounding. Masked values never match.
+
+    Returns
+    -------
+    quality_match_soundings: List of the dates/locations of the quality matches for each sounding
+    quality_match_tortype: List of the types of quality match (SIGTOR/WEAKTOR/NONTOR) for each sounding
+    num_loose_matches: Array of the number of loose matches
+    num_matches: Array of the number of weak and sig matches in the loose matches
+    tor_prob: Array of the SARS sig. tornado probabilities
+    '''
+    supercell_database, index = load_database(database_fn, SUPERCELL_COLUMNS, comments="%%%%")
+
+    mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, srh3 = \
+        [ np.ma.filled(np.ma.asarray(v, dtype=float), np.nan) for v in
+          (mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, srh3) ]
+
+    # Set range criteria for matching soundings
+    loose, quality = supercell_ranges(mlcape, srh, srh3)
+    values = {'mlcape': mlcape, 'mllcl': mllcl, 'shr': shr, 'srh': srh, 'h5temp': h5temp,
+              'lr': lr, 'shr3k': shr3k, 'shr9k': shr9k, 'srh3': srh3}
+
+    loose_match_idx = index.query_batch(dict( (name, (values[name], rng)) for name, rng in loose.items() ))
+    quality_match_idx = index.query_batch(dict( (name, (values[name], rng)) for name, rng in quality.items() ))
+
+    mat_category = index.column('category')
+    num_loose_matches = np.array([ len(idx) for idx in loose_match_idx ])
+    num_matches = np.array([ np.count_nonzero(mat_category[idx] > 0) for idx in loose_match_idx ])
+
+    tor_prob = np.zeros(len(num_loose_matches))
+    has_prob = (num_loose_matches > 0) & (mlcape > 0)
+    tor_prob[has_prob] = num_matches[has_prob] / num_loose_matches[has_prob].astype(float)
+
+    tortypes = {'2': 'SIGTOR', '1': 'WEAKTOR', '0': 'NONTOR'}
+    names = np.array([ name.decode('utf-8') for name in supercell_database[:,0] ])
+    categories = np.array([ cat.decode('utf-8') for cat in supercell_database[:,1] ])
+    categories = np.array([ tortypes.get(cat, cat) for cat in categories ])
+
+    quality_match_soundings = [ names[idx] for idx in quality_match_idx ]
+    quality_match_tortype = [ categories[idx] for idx in quality_match_idx ]
+
+    return quality_match_soundings, quality_match_tortype, num_loose_matches, num_matches, tor_prob
+
 
 
 
@@ -243,74 +488,20 @@ def hail(database_fn, mumr, mucape, h5_temp, lr, shr6, shr9, shr3, srh):
     prob_sig_hail (float) - SARS sig. hail probability
     
     '''
-    ## open the file in the current directory with the name database_fn
-    database_fn = os.path.join( os.path.dirname( __file__ ), database_fn )
-    hail_database = np.loadtxt(database_fn, skiprows=1, dtype=bytes)
+    ## open the file in the current directory with the name database_fn (cached after the first call)
+    hail_database, index = load_database(database_fn, HAIL_COLUMNS)
 
     #Set range criteria for matching sounding
-    # MU Mixing Ratio Ranges
-    range_mumr = 2.0 # g/kg
-    range_mumr_t1 = 2.0 # g/kg
-
-    # MUCAPE Ranges (J/kg)
-    range_mucape = mucape*.30
-    if mucape < 500.:
-        range_mucape_t1 = mucape * .50
-    elif mucape >= 500. and mucape < 2000.:
-        range_mucape_t1 = mucape * .25
-    else:
-        range_mucape_t1 = mucape * .20
-
-    # 700-500 mb Lapse Rate Ranges
-    range_lr = 2.0 # C/km
-    range_lr_t1 = 0.4 # C/km
-
-    # 500 mb temperature ranges
-    range_temp = 9 # C
-    range_temp_t1 = 1.5 # C
-
-    # 0-6 km shear ranges
-    range_shr6 = 12 # m/s
-    range_shr6_t1 = 6 # m/s
-
-    # 0-9 km shear ranges
-
-    range_shr9 = 22 # m/s
-    range_shr9_t1 = 15 # m/s
-
-    # 0-3 km shear ranges
-    range_shr3 = 10
-    range_shr3_t1 = 8
-
-    # 0-3 SRH Ranges
-    range_srh = 100
-    if srh < 50:
-        range_srh_t1 = 25
-    else:
-        range_srh_t1 = srh * 0.5
-
-    #Get database variables from the columns in the file and make them floats
-    matmr = np.asarray(hail_database[:,4], dtype=float) # MU Mixing Ratio
-    matcape = np.asarray(hail_database[:,3], dtype=float) # MUCAPE
-    matlr = np.asarray(hail_database[:,7], dtype=float) # 700-500 mb lapse rate
-    mattemp = np.asarray(hail_database[:,5], dtype=float) # 500 mb temp
-    matshr6 = np.asarray(hail_database[:,10], dtype=float) # 0-6 shear
-    matshr9 = np.asarray(hail_database[:,11], dtype=float) # 0-9 shear
-    matshr3 = np.asarray(hail_database[:,9], dtype=float) # 0-3 shear
-    matsrh = np.asarray(hail_database[:,12], dtype=float) # 0-3 SRH
+    loose, quality = hail_ranges(mucape, srh)
+    values = {'mumr': mumr, 'mucape': mucape, 'lr': lr, 'h5temp': h5_temp, 'shr6': shr6,
+              'shr9': shr9, 'shr3': shr3, 'srh': srh}
 
     # Find the loose matches using the ranges set above
-    loose_match_idx = np.where((mumr >= (matmr - range_mumr)) & (mumr <= (matmr + range_mumr)) & \
-                               (mucape >= (matcape - range_mucape)) & (mucape <= (matcape + range_mucape)) & \
-                               (lr >= (matlr - range_lr)) & (lr <= (matlr + range_lr)) & \
-                               (h5_temp >= (mattemp - range_temp)) & (h5_temp <= (mattemp + range_temp)) & \
-                               (shr6 >= (matshr6 - range_shr6)) & (shr6 <= (matshr6 + range_shr6)) & \
-                               (shr9 >= (matshr9 - range_shr9)) & (shr9 <= (matshr9 + range_shr9)) & \
-                               (shr3 >= (matshr3 - range_shr3)) & (shr3 <= (matshr3 + range_shr3)))[0]
+    loose_match_idx = index.query(dict( (name, (values[name], rng)) for name, rng in loose.items() ))
     ## How many loose matches are there?
     num_loose_matches = float(len(loose_match_idx))
     ## What were the sizes of those matches?
-    hail_sizes = np.asarray(hail_database[:,2], dtype=float)
+    hail_sizes = index.column('size')
     ## How many of them were significant (>2.0 in)?
     num_sig_reports = float(len(np.where(hail_sizes[loose_match_idx] >= 2.)[0]))
 
@@ -324,14 +515,7 @@ def hail(database_fn, mumr, mucape, h5_temp, lr, shr6, shr9, shr3, srh):
         prob_sig_hail = 0
 
     # Find the quality matches
-    quality_match_idx = np.where((mumr >= (matmr - range_mumr_t1)) & (mumr <= (matmr + range_mumr_t1)) & \
-                               (mucape >= (matcape - range_mucape_t1)) & (mucape <= (matcape + range_mucape_t1)) & \
-                               (lr >= (matlr - range_lr_t1)) & (lr <= (matlr + range_lr_t1)) & \
-                               (h5_temp >= (mattemp - range_temp_t1)) & (h5_temp <= (mattemp + range_temp_t1)) & \
-                               (shr6 >= (matshr6 - range_shr6_t1)) & (shr6 <= (matshr6 + range_shr6_t1)) & \
-                               (shr9 >= (matshr9 - range_shr9_t1)) & (shr9 <= (matshr9 + range_shr9_t1)) & \
-                               (shr3 >= (matshr3 - range_shr3_t1)) & (shr3 <= (matshr3 + range_shr3_t1)) & \
-                               (srh >= (matsrh - range_srh_t1)) & (srh <= (matsrh + range_srh_t1)))[0]
+    quality_match_idx = index.query(dict( (name, (values[name], rng)) for name, rng in quality.items() ))
 
     quality_match_dates = hail_database[quality_match_idx,0]
     quality_match_sizes = np.asarray(hail_database[quality_match_idx,2], dtype=float)
@@ -345,6 +529,65 @@ def hail(database_fn, mumr, mucape, h5_temp, lr, shr6, shr9, shr3, srh):
 
     return quality_match_dates, quality_match_sizes, num_loose_matches, num_sig_reports, prob_sig_hail
 
+def hail_batch(database_fn, mumr, mucape, h5_temp, lr, shr6, shr9, shr3, srh):
+    '''
+    Vectorized version of the SARS hail matching for many soundings at once.
+    The database is loaded once and shared, and the matching criteria for all
+    of the soundings are evaluated as arrays. The ranges used and the matches
+    found are the same as those in hail().
+
+    Parameters
+    ----------
+    mumr - most unstable parcel mixing ratio (g/kg)
+    mucape - most unstable CAPE (J/kg)
+    h5_temp - 500 mb temperature (C)
+    lr - 700-500 mb lapse rate (C/km)
+    shr6 - 0-6 km shear (m/s)
+    shr9 - 0-9 km shear (m/s)
+    shr3 - 0-3 km shear (m/s)
+    srh - 0-3 Storm Relative Helicity (m2/s2)
+
+    All of the parameters (except database_fn) are 1D arrays with one entry
+    per sounding. Masked values never match.
+
+    Returns
+    -------
+    quality_match_dates (list) - dates of the quality matches for each sounding
+    quality_match_sizes (list) - hail sizes of the quality matches for each sounding
+    num_loose_matches (array) - number of loose matches
+    num_sig_reports (array) - number of significant hail reports (>= 2 inches)
+    prob_sig_hail (array) - SARS sig. hail probability
+    '''
+    hail_database, index = load_database(database_fn, HAIL_COLUMNS)
+
+    mumr, mucape, h5_temp, lr, shr6, shr9, shr3, srh = \
+        [ np.ma.filled(np.ma.asarray(v, dtype=float), np.nan) for v in
+          (mumr, mucape, h5_temp, lr, shr6, shr9, shr3, srh) ]
+
+    # Set range criteria for matching soundings
+    loose, quality = hail_ranges(mucape, srh)
+    values = {'mumr': mumr, 'mucape': mucape, 'lr': lr, 'h5temp': h5_temp, 'shr6': shr6,
+              'shr9': shr9, 'shr3': shr3, 'srh': srh}
+
+    loose_match_idx = index.query_batch(dict( (name, (values[name], rng)) for name, rng in loose.items() ))
+    quality_match_idx = index.query_batch(dict( (name, (values[name], rng)) for name, rng in quality.items() ))
+
+    hail_sizes = index.column('size')
+    num_loose_matches = np.array([ len(idx) for idx in loose_match_idx ], dtype=float)
+    num_sig_reports = np.array([ np.count_nonzero(hail_sizes[idx] >= 2.) for idx in loose_match_idx ], dtype=float)
+
+    prob_sig_hail = np.zeros(len(num_loose_matches))
+    has_prob = (num_loose_matches > 0) & (mucape > 0)
+    prob_sig_hail[has_prob] = num_sig_reports[has_prob] / num_loose_matches[has_prob]
+
+    # Only keep the first few quality matches, as in hail()
+    max_quality_matches = 15
+    dates = np.array([ date.decode('utf-8') for date in hail_database[:,0] ])
+    quality_match_dates = [ dates[idx[:max_quality_matches]] for idx in quality_match_idx ]
+    quality_match_sizes = [ hail_sizes[idx[:max_quality_matches]] for idx in quality_match_idx ]
+
+    return quality_match_dates, quality_match_sizes, num_loose_matches, num_sig_reports, prob_sig_hail
+
 
 def get_sars_dir(match_type):
     """
@@ -361,33 +604,49 @@ def get_sars_dir(match_type):
     """
     return os.path.join(os.path.dirname(__file__), "sars/" + match_type.lower() + "/")
 
+_sounding_index = {}
+
+def get_sounding_index(match_type):
+    """
+    Returns a dictionary mapping (date, station) to the path of the raw SARS
+    sounding file. The directory is only listed the first time the index for
+    a match type is requested.
+
+    Parameters
+    ----------
+    match_type : str
+        'supercell' or 'hail'
+    Returns
+    -------
+    dict
+
+    """
+    match_type = match_type.lower()
+    if match_type not in _sounding_index:
+        data_dir = get_sars_dir(match_type)
+        index = {}
+        # Sort the listing so that the file picked for a duplicate key doesn't
+        # depend on the order the filesystem returns them in.
+        for fname in sorted(os.listdir(data_dir)):
+            root, ext = os.path.splitext(fname)
+            index.setdefault((root[:8], ext[1:].upper()), data_dir + fname)
+        _sounding_index[match_type] = index
+    return _sounding_index[match_type]
+
 ## written by Kelton Halbert
 def getSounding(match_string, match_type, profile="default"):
     """
     Given a match string and type (supercell:hail) from one of the
-    SARS routines, decode the raw sounding data into a Profile
-    object and return said object. It will default to a "default"
-    profile object that does not compute any indices, but can be
-    set to profile="convective" if indices are desired.
+    SARS routines, return the path to the raw sounding data file.
+    Raises an IOError if there isn't a raw file for the match.
 
     :param match_string:
     :param match_type:
-    :return: a Profile object
+    :return: the path to the raw sounding file
     """
-    ## make sure the requested match type is valid
-    #if (match_type.lower() != "supercell") or (match_type.lower() != "hail"):
-    #    raise Exception("InvalidSARSType", match_type.lower() + " is an invalid SARS type.")
-    ## get the directory with the data
-    data_dir = get_sars_dir(match_type)
-
     match_date, match_loc = match_string.split(".")
-    files = os.listdir(data_dir)
-    for file in files:
-        if file.startswith(match_date) and file.endswith(match_loc.lower()):
-            datafile = data_dir + file
-            break
-        elif file.startswith(match_date) and file.endswith(match_loc.upper()):
-            datafile = data_dir + file
-            break
+    try:
+        datafile = get_sounding_index(match_type)[(match_date[:8], match_loc.upper())]
+    except KeyError:
+        raise IOError("No raw SARS %s sounding found for '%s'" % (match_type.lower(), match_string))
     return datafile
-
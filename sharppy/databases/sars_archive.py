@@ -0,0 +1,239 @@
+import sharppy.databases.sars as sars
+import sharppy.sharptab.profile as profile
+import sharppy.sharptab.prof_collection as prof_collection
+from sharppy.io.spc_decoder import parseSPCFiles
+
+import numpy as np
+from datetime import datetime
+import struct
+import json
+import glob
+import os
+import time
+import logging
+
+## Packed archive of the raw SARS soundings.  The archive is a single file with
+## a small header, a JSON index giving the metadata and the offset and length
+## of each sounding, and then all of the sounding data as one float64 array of
+## shape (total levels, 6).  The data array is memory-mapped when the archive
+## is opened, so any of the soundings can be turned into a Profile without
+## having to decode the text file.
+
+ARCHIVE_MAGIC = b'SARSPACK'
+ARCHIVE_VERSION = 2
+ARCHIVE_DIR = os.path.join(os.path.expanduser("~"), ".sharppy", "cache", "sars")
+
+_header_fmt = '<8sIQ'
+_fields = ['pres', 'hght', 'tmpc', 'dwpc', 'wdir', 'wspd']
+_archives = {}
+_last_checked = {}
+
+# Seconds between checks of the SARS directory for changes to the raw files.
+# Checking means a stat of every file, so it isn't done on every lookup.
+STALE_CHECK_INTERVAL = 300
+
+def _source_signature(data_dir):
+    # The number of files in the SARS directory, their total size and the newest
+    # mtime, so editing a file in place (which doesn't change the directory's
+    # mtime) is noticed too
+    num_files, total_size, newest = 0, 0, os.path.getmtime(data_dir)
+    for entry in os.scandir(data_dir):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        num_files += 1
+        total_size += stat.st_size
+        newest = max(newest, stat.st_mtime)
+    return [ num_files, total_size, newest ]
+
+def build_archive(match_type, archive_fn, files=None, max_procs=None):
+    """
+    Decodes the raw SARS sounding files and writes them to a packed archive.
+
+    Parameters
+    ----------
+    match_type : str
+        'supercell' or 'hail'
+    archive_fn : str
+        Filename of the archive to write
+    files : list (optional)
+        The raw files to pack. Default is all the files in the SARS directory
+        for the match type.
+    max_procs : int (optional)
+        The max number of processes to use to decode the files. Default is all the CPUs.
+
+    Returns
+    -------
+    None
+    """
+    data_dir = sars.get_sars_dir(match_type)
+    if files is None:
+        files = sorted(glob.glob(os.path.join(data_dir, '*')))
+
+    index = {'match_type': match_type.lower(), 'source': _source_signature(data_dir),
+             'names': [], 'locations': [], 'dates': [], 'lats': [], 'lons': [], 'offsets': [], 'lengths': []}
+    columns = []
+    offset = 0
+    for fname, result in zip(files, parseSPCFiles(files, max_procs=max_procs)):
+        if result is None:
+            logging.debug("Unable to decode SARS file '%s', skipping it." % fname)
+            continue
+
+        location, time, lat, lon, data = result
+        data = np.array(data, dtype=np.float64).T
+        index['names'].append(os.path.basename(fname))
+        index['locations'].append(location)
+        index['dates'].append(time.strftime('%Y%m%d%H%M'))
+        index['lats'].append(lat)
+        index['lons'].append(lon)
+        index['offsets'].append(offset)
+        index['lengths'].append(data.shape[0])
+        columns.append(data)
+        offset += data.shape[0]
+
+    header = json.dumps(index).encode('utf-8')
+    # Pad the index so the data array starts on an 8 byte boundary
+    header += b' ' * (-(struct.calcsize(_header_fmt) + len(header)) % 8)
+    data = np.concatenate(columns, axis=0) if len(columns) > 0 else np.empty((0, len(_fields)))
+
+    dirname = os.path.dirname(os.path.abspath(archive_fn))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    # Write to a temporary file first so a half-written archive is never opened
+    tmp_fn = archive_fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        f.write(struct.pack(_header_fmt, ARCHIVE_MAGIC, ARCHIVE_VERSION, len(header)))
+        f.write(header)
+        f.write(np.ascontiguousarray(data, dtype='<f8').tobytes())
+    os.replace(tmp_fn, archive_fn)
+
+class SARSArchive(object):
+    """
+    SARSArchive: A packed archive of the raw SARS soundings for one match type.
+    """
+    def __init__(self, archive_fn):
+        """
+        Open the archive.
+        archive_fn: The filename of the archive.
+        """
+        self._archive_fn = archive_fn
+        with open(archive_fn, 'rb') as f:
+            magic, version, header_len = struct.unpack(_header_fmt, f.read(struct.calcsize(_header_fmt)))
+            if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+                raise IOError("'%s' is not a SARS archive this version of SHARPpy can read" % archive_fn)
+            self._index = json.loads(f.read(header_len).decode('utf-8'))
+
+        data_offset = struct.calcsize(_header_fmt) + header_len
+        num_levels = sum(self._index['lengths'])
+        if num_levels > 0:
+            self._data = np.memmap(archive_fn, dtype='<f8', mode='r', offset=data_offset, shape=(num_levels, len(_fields)))
+        else:
+            self._data = np.empty((0, len(_fields)))
+
+        self._name_idx = dict( (name, idx) for idx, name in enumerate(self._index['names']) )
+
+    def __len__(self):
+        return len(self._index['names'])
+
+    def getNames(self):
+        """
+        Returns the names of the raw files in the archive.
+        """
+        return list(self._index['names'])
+
+    def isStale(self):
+        """
+        Returns True if the files in the SARS directory have changed since the archive was built.
+        """
+        data_dir = sars.get_sars_dir(self._index['match_type'])
+        return _source_signature(data_dir) != self._index['source']
+
+    def _findIndex(self, name):
+        name = os.path.basename(name)
+        if name not in self._name_idx:
+            # Maybe this is a match string from the SARS routines
+            name = os.path.basename(sars.getSounding(name, self._index['match_type']))
+        try:
+            return self._name_idx[name]
+        except KeyError:
+            raise IOError("'%s' is not in the SARS archive" % name)
+
+    def getData(self, name):
+        """
+        Returns the data columns of a sounding as a dictionary of arrays.
+        name:   The raw file name or the match string of the sounding.
+        """
+        return self._getData(self._findIndex(name))
+
+    def _getData(self, idx):
+        start = self._index['offsets'][idx]
+        end = start + self._index['lengths'][idx]
+        data = np.array(self._data[start:end])
+        return dict( (field, data[:, i]) for i, field in enumerate(_fields) )
+
+    def getProfiles(self, name):
+        """
+        Returns the ProfCollection for a sounding. This is the same ProfCollection
+        the SPCDecoder returns for the raw file.
+        name:   The raw file name or the match string of the sounding.
+        """
+        idx = self._findIndex(name)
+        location = self._index['locations'][idx]
+        time = datetime.strptime(self._index['dates'][idx], '%Y%m%d%H%M')
+        lat = self._index['lats'][idx]
+        lon = self._index['lons'][idx]
+
+        prof = profile.create_profile(profile='raw', location=location, date=time, latitude=lat,
+            longitude=lon, missing=-9999.00, **self._getData(idx))
+
+        prof_coll = prof_collection.ProfCollection(
+            {'':[ prof ]},
+            [ time ],
+        )
+
+        prof_coll.setMeta('loc', location)
+        prof_coll.setMeta('observed', True)
+        prof_coll.setMeta('base_time', time)
+        return prof_coll
+
+def get_archive(match_type):
+    """
+    Returns the SARSArchive for a match type, building the archive in
+    ~/.sharppy/cache/sars if it doesn't exist or the raw files have changed.
+    Once an archive is open, the raw files are only checked for changes every
+    STALE_CHECK_INTERVAL seconds.
+
+    Parameters
+    ----------
+    match_type : str
+        'supercell' or 'hail'
+    Returns
+    -------
+    SARSArchive
+    """
+    match_type = match_type.lower()
+    now = time.time()
+    if match_type in _archives:
+        if now - _last_checked[match_type] < STALE_CHECK_INTERVAL:
+            return _archives[match_type]
+        _last_checked[match_type] = now
+        if not _archives[match_type].isStale():
+            return _archives[match_type]
+
+    archive_fn = os.path.join(ARCHIVE_DIR, match_type + '.sarspack')
+    archive = None
+    if os.path.exists(archive_fn):
+        try:
+            archive = SARSArchive(archive_fn)
+        except IOError:
+            archive = None
+
+    if archive is None or archive.isStale():
+        logging.debug("Building the SARS %s archive in '%s'." % (match_type, archive_fn))
+        build_archive(match_type, archive_fn)
+        archive = SARSArchive(archive_fn)
+
+    _archives[match_type] = archive
+    _last_checked[match_type] = now
+    return archive
@@ -1,6 +1,6 @@
 import sharppy.databases.sars as sars
 import sharppy.sharptab as tab
-from sharppy.io.spc_decoder import SPCDecoder
+import sharppy.databases.sars_archive as sars_archive
 import numpy as np
 from datetime import datetime
 import os
@@ -10,13 +10,12 @@ def get_profile(fname, sars_type):
     # fname - filename/SARS sounding string to load in
     # sars_type - string showing what SARS database (hail/supercell) to look for the raw file
     # Load in the data
+    # The soundings come from the packed archive, so the raw text files don't need decoding
     try:
-        sars_fname = sars.getSounding(fname[0].decode('utf-8'), sars_type)
+        profs = sars_archive.get_archive(sars_type).getProfiles(fname[0].decode('utf-8'))
     except:
         print("Unable to find data file for:", fname[0])
         return None
-    dec = SPCDecoder(sars_fname)
-    profs = dec.getProfiles()
     prof = profs._profs[''][0]
     dates = profs._dates
     prof.strictQC = True
@@ -63,7 +62,11 @@ def check_supercell_cal(use_db=True):
     cn = 0
     miss = 0
     match = 0
-    for f in supercell_db:
+    if use_db is True:
+        # Match every sounding in the database at once
+        cols = [ np.asarray(supercell_db[:,i], dtype=float) for i in (3, 5, 9, 11, 7, 6, 12, 13, 14) ]
+        batch = sars.supercell_batch('sars_supercell.txt', *cols)
+    for i, f in enumerate(supercell_db):
         mlcape = float(f[3])
         mllcl = float(f[5])
         h5temp = float(f[9])
@@ -74,7 +77,7 @@ def check_supercell_cal(use_db=True):
         shr3 = float(f[12])
         shr9 = float(f[13])
         if use_db is True:
-            out = sars.supercell('sars_supercell.txt', mlcape, mllcl, h5temp, lr, shr, srh, shr3, shr9, srh3)
+            out = [ b[i] for b in batch ]
         else:
             new_prof = get_profile(f, 'supercell')
             if new_prof is None:
@@ -141,7 +144,11 @@ def check_hail_cal(use_db=True):
     miss = 0
     fa = 0 
     match = 0
-    for f in hail_db:
+    if use_db is True:
+        # Match every sounding in the database at once
+        cols = [ np.asarray(hail_db[:,i], dtype=float) for i in (4, 3, 5, 7, 10, 11, 9, 12) ]
+        batch = sars.hail_batch('sars_hail.txt', *cols)
+    for i, f in enumerate(hail_db):
         mumr = float(f[4])
         mucape = float(f[3])
         lr = float(f[7])
@@ -151,7 +158,7 @@ def check_hail_cal(use_db=True):
         shr3 = float(f[9])
         srh = float(f[12])
         if use_db is True:
-            out = sars.hail('sars_hail.txt', mumr, mucape, h5_temp, lr, shr, shr9, shr3, srh)
+            out = [ b[i] for b in batch ]
         else:
             new_prof = get_profile(f, 'hail')
             if new_prof is None:
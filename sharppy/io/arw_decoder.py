@@ -18,6 +18,207 @@ __fmtname__ = "wrf-arw"
 __classname__ = "ARWDecoder"
 
 
+# Grid locators are cached by the grid signature, so opening another file
+# (e.g. another output time) from the same domain doesn't rebuild them.
+_grid_locators = {}
+_max_grid_locators = 8
+
+def _haversine(gridlats, gridlons, lat, lon):
+    """
+    Distance on the unit sphere between the grid points and a point. All the
+    angles are in radians.
+    """
+    ## difference between points
+    dlat = gridlats - lat
+    dlon = gridlons - lon
+
+    ## latitude term of the distance equation
+    latTerm = np.sin(0.5*dlat)
+    latTerm = np.power(latTerm, 2)
+
+    ## longitude term of the distance equation
+    lonTerm = np.sin(0.5*dlon)
+    lonTerm = np.power(lonTerm, 2) * np.cos(lat) * np.cos(gridlats)
+
+    ## we assume a radius of 1 on the unit circle
+    dAngle = np.sqrt(latTerm+lonTerm)
+    return 2.*1.0*np.arcsin(dAngle)
+
+def _read_grid_var(ncfile, name):
+    # Read the 2D lat/lon grid from the first time
+    var = ncfile.variables[name]
+    return var[0] if len(var.shape) == 3 else var[:]
+
+def _grid_signature(ncfile):
+    """
+    Returns a key that identifies the model grid in a file. Uses the map projection
+    attributes and a few of the lat/lon points, so only a handful of values are read.
+    """
+    xlat = ncfile.variables["XLAT"]
+    xlon = ncfile.variables["XLONG"]
+    ny, nx = xlat.shape[-2:]
+    points = [ (0, 0), (0, nx - 1), (ny - 1, 0), (ny - 1, nx - 1), (ny // 2, nx // 2) ]
+
+    def value(var, j, i):
+        return float(var[0, j, i]) if len(var.shape) == 3 else float(var[j, i])
+
+    attrs = tuple( str(getattr(ncfile, attr, None)) for attr in
+        ['MAP_PROJ', 'DX', 'DY', 'CEN_LAT', 'CEN_LON', 'TRUELAT1', 'TRUELAT2', 'STAND_LON'] )
+    lats = tuple( value(xlat, j, i) for j, i in points )
+    lons = tuple( value(xlon, j, i) for j, i in points )
+    return (ny, nx) + attrs + lats + lons
+
+def get_grid_locator(ncfile):
+    """
+    Returns the GridLocator for the grid in a WRF-ARW netCDF file, building it
+    if this grid hasn't been seen before.
+    """
+    key = _grid_signature(ncfile)
+    if key not in _grid_locators:
+        if len(_grid_locators) >= _max_grid_locators:
+            del _grid_locators[next(iter(_grid_locators))]
+        _grid_locators[key] = GridLocator(_read_grid_var(ncfile, "XLAT"), _read_grid_var(ncfile, "XLONG"))
+    return _grid_locators[key]
+
+def _read_points(var, jdxs, idxs, max_values=8000000):
+    """
+    Reads the values of a variable at a set of grid points. The points are
+    read in contiguous slabs that cover them (netCDF reads of contiguous
+    slabs are much faster than reads of scattered points), using as few
+    slabs as possible without reading more than about max_values values
+    at once.
+
+    var:    The netCDF variable, with the south_north and west_east dimensions last
+    jdxs:   The row (south_north) index of each point
+    idxs:   The column (west_east) index of each point
+    Returns a masked array with the leading dimensions of the variable and a
+        last dimension of length len(jdxs).
+    """
+    jdxs = np.asarray(jdxs)
+    idxs = np.asarray(idxs)
+    lead_shape = var.shape[:-2]
+    lead_size = int(np.prod(lead_shape))
+    data = np.ma.masked_all(lead_shape + (len(jdxs),), dtype=var.dtype)
+
+    # Group the rows so that each slab stays under the size limit
+    groups = []
+    group = []
+    for pt in np.argsort(jdxs, kind='mergesort'):
+        if len(group) > 0:
+            j0, j1 = min(j0, jdxs[pt]), max(j1, jdxs[pt])
+            i0, i1 = min(i0, idxs[pt]), max(i1, idxs[pt])
+            if lead_size * (j1 - j0 + 1) * (i1 - i0 + 1) > max_values:
+                groups.append(group)
+                group = []
+
+        if len(group) == 0:
+            j0 = j1 = jdxs[pt]
+            i0 = i1 = idxs[pt]
+        group.append(pt)
+
+    if len(group) > 0:
+        groups.append(group)
+
+    for pts in groups:
+        pts = np.array(pts)
+        j0, j1 = jdxs[pts].min(), jdxs[pts].max() + 1
+        i0, i1 = idxs[pts].min(), idxs[pts].max() + 1
+        slab = var[..., j0:j1, i0:i1]
+        data[..., pts] = slab[..., jdxs[pts] - j0, idxs[pts] - i0]
+    return data
+
+def convert_columns(column, point, level_axis):
+    """
+    Computes the sounding variables from the WRF-ARW variables.
+
+    column: A function that returns a 3D WRF variable (e.g. "T") given its name,
+        with any other dimensions
+    point:  A function that returns a 2D WRF variable (e.g. "COSALPHA") given its
+        name, in a shape that broadcasts against the 3D variables
+    level_axis: The axis of the vertical levels in the 3D variables
+    Returns the pressure (hPa), height (m), temperature (C), dewpoint (C), and the
+        earth-relative u and v wind components (kts).
+    """
+    ## read in the data from the WRF file and conduct necessary processing
+    theta = column("T") + 300.0
+    qvapr = column("QVAPOR") * 10**3 #g/kg
+    mpres = (column("P") + column("PB")) * .01
+    mhght = column("PH") + column("PHB") / G
+    ## unstagger the height grid
+    lower = [ slice(None) ] * mhght.ndim
+    upper = [ slice(None) ] * mhght.ndim
+    lower[level_axis] = slice(None, -1)
+    upper[level_axis] = slice(1, None)
+    mhght = ( mhght[tuple(lower)] + mhght[tuple(upper)] ) / 2.
+
+    muwin = column("U")
+    mvwin = column("V")
+
+    ## convert the potential temperature to air temperature
+    mtmpc = thermo.theta(1000.0, theta - 273.15, p2=mpres)
+    ## convert the mixing ratio to dewpoint
+    mdwpc = thermo.temp_at_mixrat(qvapr, mpres)
+    ## convert the grid relative wind to earth relative
+    cosalpha = point('COSALPHA')
+    sinalpha = point('SINALPHA')
+    U = muwin*cosalpha - mvwin*sinalpha
+    V = mvwin*cosalpha + muwin*sinalpha
+    ## convert from m/s to kts
+    muwin = utils.MS2KTS(U)
+    mvwin = utils.MS2KTS(V)
+    return mpres, mhght, mtmpc, mdwpc, muwin, mvwin
+
+class GridLocator(object):
+    """
+    GridLocator: Finds the nearest grid point to a location. The grid points are
+    sorted by latitude, so only the points in a narrow latitude band around the
+    location need their distances computed.
+    """
+    def __init__(self, gridlats, gridlons, stride=16):
+        """
+        gridlats:   The 2D grid latitudes in degrees
+        gridlons:   The 2D grid longitudes in degrees
+        stride:     Spacing of the coarse grid used for the first guess
+        """
+        self._shape = gridlats.shape
+        self._lats = np.radians(gridlats).ravel()
+        self._lons = np.radians(gridlons).ravel()
+
+        self._order = np.argsort(self._lats, kind='mergesort')
+        self._sorted_lats = self._lats[self._order]
+
+        coarse = np.arange(self._lats.size).reshape(self._shape)[::stride, ::stride]
+        self._coarse = coarse.ravel()
+
+    def nearest(self, lon, lat):
+        """
+        Returns the (row, column) index arrays of the nearest grid point, in the same
+        form as np.where.
+        lon:    The longitude of the location in degrees
+        lat:    The latitude of the location in degrees
+        """
+        lon = np.radians(lon)
+        lat = np.radians(lat)
+
+        # The nearest point on the coarse grid gives an upper bound on the distance
+        coarse_dist = _haversine(self._lats[self._coarse], self._lons[self._coarse], lat, lon)
+        max_dist = float(coarse_dist.min())
+        if not np.isfinite(max_dist):
+            max_dist = np.pi
+
+        # Distance on the sphere is at least the difference in latitude, so nothing
+        # outside this latitude band can be closer. Pad it a bit for round-off.
+        band = max_dist + 1e-6
+        lb = np.searchsorted(self._sorted_lats, lat - band, side='left')
+        ub = np.searchsorted(self._sorted_lats, lat + band, side='right')
+        cand = np.sort(self._order[lb:ub])
+
+        dist = _haversine(self._lats[cand], self._lons[cand], lat, lon)
+
+        ## find the smallest distance and return the index
+        flat_idx = cand[np.where( dist == dist.min() )]
+        return np.unravel_index(flat_idx, self._shape)
+
 class ARWDecoder(Decoder):
     def __init__(self, file_name):
         super(ARWDecoder, self).__init__(file_name)
@@ -49,34 +250,7 @@ class ARWDecoder(Decoder):
         Code modified from existing code given by Nick Szapiro
         at the University of Oklahoma.
         """
-        ## convert the map lat/lon into radians
-        lon = np.radians(lon)
-        lat = np.radians(lat)
-
-        ## open the netCDF file from the WRF-ARW and convert
-        ## its grid points into radians
-        gridlons = np.radians(ncfile.variables["XLONG"][0])
-        gridlats = np.radians(ncfile.variables["XLAT"][0])
- 
-        ## difference between points
-        dlat = gridlats - lat
-        dlon = gridlons - lon
-
-        ## latitude term of the distance equation
-        latTerm = np.sin(0.5*dlat)
-        latTerm = np.power(latTerm, 2)
-        
-        ## longitude term of the distance equation
-        lonTerm = np.sin(0.5*dlon)
-        lonTerm = np.power(lonTerm, 2) * np.cos(lat) * np.cos(gridlats)
- 
-        ## we assume a radius of 1 on the unit circle
-        dAngle = np.sqrt(latTerm+lonTerm)
-        dist = 2.*1.0*np.arcsin(dAngle)
-
-        ## find the smalled distance and return the index
-        idx = np.where( dist == dist.min() )
-        return idx
+        return get_grid_locator(ncfile).nearest(lon, lat)
 
     def _parse(self):
         """
@@ -87,74 +261,70 @@ class ARWDecoder(Decoder):
         file_data = self._downloadFile()
         gridx = self._file_name[1]
         gridy = self._file_name[2]
-        
-        ## calculate the nearest grid point to the map point 
-        idx = self._find_nearest_point(file_data, gridx, gridy)
+
+        return ARWDecoder._parsePoints(file_data, [ (gridx, gridy) ])[0]
+
+    @classmethod
+    def decodePoints(cls, file_name, points):
+        """
+        Decode the columns at many points from a WRF-ARW file. The file is
+        opened once, and each variable is read for all the points together.
+
+        file_name:  The file name or URL of the netCDF file
+        points:     A list of (lon, lat) tuples
+        Returns a list of ProfCollections in the same order as points.
+        """
+        try:
+            from netCDF4 import Dataset
+        except ImportError:
+            raise IOError("No netCDF install found. Cannot read netCDF file.")
+
+        try:
+            file_data = Dataset(file_name)
+        except (RuntimeError, IOError):
+            raise IOError("File '%s' cannot be found" % file_name)
+
+        try:
+            return cls._parsePoints(file_data, points)
+        finally:
+            file_data.close()
+
+    @staticmethod
+    def _parsePoints(file_data, points):
+        ## calculate the nearest grid point to each map point
+        locator = get_grid_locator(file_data)
+        jdxs = []
+        idxs = []
+        for gridx, gridy in points:
+            idx = locator.nearest(gridx, gridy)
+            jdxs.append(idx[0][0])
+            idxs.append(idx[1][0])
 
         ## check to see if this is a 4D netCDF4 that includes all available times.
-        ## If it does, open and compute the variables as 4D variables
-        if len(file_data.variables["T"][:].shape) == 4:        
-            ## read in the data from the WRF file and conduct necessary processing
-            theta = file_data.variables["T"][:, :, idx[0], idx[1]] + 300.0
-            qvapr = file_data.variables["QVAPOR"][:, :, idx[0], idx[1]] * 10**3 #g/kg
-            mpres = (file_data.variables["P"][:, :, idx[0], idx[1]] + file_data.variables["PB"][:, :, idx[0], idx[1]]) * .01
-            mhght = file_data.variables["PH"][:, :, idx[0], idx[1]] + file_data.variables["PHB"][:, :, idx[0], idx[1]] / G
-            ## unstagger the height grid
-            mhght = ( mhght[:, :-1, :, :] + mhght[:, 1:, :, :] ) / 2.
-
-            muwin = file_data.variables["U"][:, :, idx[0], idx[1]]
-            mvwin = file_data.variables["V"][:, :, idx[0], idx[1]]
-
-            ## convert the potential temperature to air temperature
-            mtmpc = thermo.theta(1000.0, theta - 273.15, p2=mpres) 
-            ## convert the mixing ratio to dewpoint
-            mdwpc = thermo.temp_at_mixrat(qvapr, mpres)
-            ## convert the grid relative wind to earth relative
-            U = muwin*file_data.variables['COSALPHA'][0, idx[0], idx[1]] - mvwin*file_data.variables['SINALPHA'][0, idx[0], idx[1]]
-            V = mvwin*file_data.variables['COSALPHA'][0, idx[0], idx[1]] + muwin*file_data.variables['SINALPHA'][0, idx[0], idx[1]]
-            ## convert from m/s to kts
-            muwin = utils.MS2KTS(U)
-            mvwin = utils.MS2KTS(V)
-
-        ## if the data is not 4D, then it must be assumed that this is a file containing only a single time
-        else:
-            ## read in the data from the WRF file and conduct necessary processing
-            theta = file_data.variables["T"][:, idx[0], idx[1]] + 300.0
-            qvapr = file_data.variables["QVAPOR"][:, idx[0], idx[1]] * 10**3 #g/kg
-            mpres = (file_data.variables["P"][:, idx[0], idx[1]] + file_data.variables["PB"][:, idx[0], idx[1]]) * .01
-            mhght = file_data.variables["PH"][:, idx[0], idx[1]] + file_data.variables["PHB"][:, idx[0], idx[1]] / G
-            ## unstagger the height grid
-            mhght = ( mhght[:-1, :, :] + mhght[1:, :, :] ) / 2.
-
-            muwin = file_data.variables["U"][:, idx[0], idx[1]]
-            mvwin = file_data.variables["V"][:, idx[0], idx[1]]
-
-            ## convert the potential temperature to air temperature
-            mtmpc = thermo.theta(1000.0, theta - 273.15, p2=mpres) 
-            ## convert the mixing ratio to dewpoint
-            mdwpc = thermo.temp_at_mixrat(qvapr, mpres)
-            ## convert the grid relative wind to earth relative
-            U = muwin*file_data.variables['COSALPHA'][0, idx[0], idx[1]] - mvwin*file_data.variables['SINALPHA'][0, idx[0], idx[1]]
-            V = mvwin*file_data.variables['COSALPHA'][0, idx[0], idx[1]] + muwin*file_data.variables['SINALPHA'][0, idx[0], idx[1]]
-            ## convert from m/s to kts
-            muwin = utils.MS2KTS(U)
-            mvwin = utils.MS2KTS(V)
+        ## If it isn't, it must be assumed that this is a file containing only a single
+        ## time. Only the columns at the grid points are read from each variable.
+        ntimes = file_data.variables["T"].shape[0] if len(file_data.variables["T"].shape) == 4 else 1
+
+        def column(name):
+            # Returns an array of shape (times, levels, points)
+            var = file_data.variables[name]
+            data = _read_points(var, jdxs, idxs)
+            return data if len(var.shape) == 4 else data[np.newaxis]
+
+        def point(name):
+            # Returns an array of shape (points,) from the first time
+            var = file_data.variables[name]
+            data = _read_points(var, jdxs, idxs)
+            return data[0] if len(var.shape) == 3 else data
+
+        mpres, mhght, mtmpc, mdwpc, muwin, mvwin = convert_columns(column, point, level_axis=1)
 
         ## get the model start time of the file
         inittime = dattim.datetime.strptime( str( file_data.START_DATE ), '%Y-%m-%d_%H:%M:%S')
 
-        profiles = []
         dates = []
         ## loop over the available times
-        
-        for i in range(file_data.variables["T"][:].shape[0]):
-            ## make sure the arrays are 1D
-            prof_pres = mpres[i].flatten()
-            prof_hght = mhght[i].flatten()
-            prof_tmpc = mtmpc[i].flatten()
-            prof_dwpc = mdwpc[i].flatten()
-            prof_uwin = muwin[i].flatten()
-            prof_vwin = mvwin[i].flatten()
+        for i in range(ntimes):
             ## compute the time of the profile
             try:
                 delta = dattim.timedelta( minutes=int(file_data.variables["XTIME"][i]) )
@@ -162,23 +332,33 @@ class ARWDecoder(Decoder):
             except KeyError:
                 var = ''.join(np.asarray(file_data.variables['Times'][i], dtype=str))
                 curtime = dattim.datetime.strptime(var, '%Y-%m-%d_%H:%M:%S') 
-            date_obj = curtime
+            dates.append(curtime)
+
+        prof_colls = []
+        for pt, (gridx, gridy) in enumerate(points):
+            profiles = []
+            for i, date_obj in enumerate(dates):
+                ## make sure the arrays are 1D
+                prof_pres = mpres[i, :, pt].flatten()
+                prof_hght = mhght[i, :, pt].flatten()
+                prof_tmpc = mtmpc[i, :, pt].flatten()
+                prof_dwpc = mdwpc[i, :, pt].flatten()
+                prof_uwin = muwin[i, :, pt].flatten()
+                prof_vwin = mvwin[i, :, pt].flatten()
 
-            ## construct the profile object
-            prof = profile.create_profile(profile="raw", pres=prof_pres, 
-                hght=prof_hght, tmpc=prof_tmpc, dwpc=prof_dwpc, u=prof_uwin, v=prof_vwin,
-                location=str(gridx) + "," + str(gridy), date=date_obj, missing=-999.0,
-                latitude=gridy, strictQC=False)
+                ## construct the profile object
+                prof = profile.create_profile(profile="raw", pres=prof_pres, 
+                    hght=prof_hght, tmpc=prof_tmpc, dwpc=prof_dwpc, u=prof_uwin, v=prof_vwin,
+                    location=str(gridx) + "," + str(gridy), date=date_obj, missing=-999.0,
+                    latitude=gridy, longitude=gridx, strictQC=False)
 
-            ## append the dates and profiles
-            profiles.append(prof)
-            dates.append(date_obj)
+                profiles.append(prof)
 
-        ## create a profile collection - dictionary has no key since this 
-        ## is not an ensemble model
-        prof_coll = prof_collection.ProfCollection({'':profiles}, dates)
+            ## create a profile collection - dictionary has no key since this 
+            ## is not an ensemble model
+            prof_colls.append(prof_collection.ProfCollection({'':profiles}, list(dates)))
 
-        return prof_coll
+        return prof_colls
 
 if __name__ == '__main__':
 	file = ARWDecoder(("/Users/blumberg/Downloads/wrfout_v2_Lambert.nc", -97, 35))
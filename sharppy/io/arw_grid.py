@@ -0,0 +1,192 @@
+import numpy as np
+import sharppy.sharptab.gridded as gridded
+from sharppy.io.arw_decoder import convert_columns
+
+from datetime import datetime
+import multiprocessing
+import logging
+
+## Computes convective parameters for every column of a WRF-ARW grid (or every
+## stride'th column of a subdomain) and writes them out as 2D fields. The grid is
+## split into bands of rows, and each band is read and computed in a worker
+## process using the vectorized routines in sharptab.gridded.
+
+# Number of columns in each band of rows that a worker computes
+CHUNK_COLUMNS = 20000
+
+def _open_dataset(file_name, mode='r'):
+    try:
+        from netCDF4 import Dataset
+    except ImportError:
+        raise IOError("No netCDF install found. Cannot read netCDF file.")
+
+    try:
+        return Dataset(file_name, mode)
+    except (RuntimeError, IOError):
+        raise IOError("File '%s' cannot be opened" % file_name)
+
+def _compute_band(args):
+    # Reads one band of rows from the file and computes the parameters for it
+    file_name, time_idx, rows, cols, params = args
+    ncfile = _open_dataset(file_name)
+    try:
+        def column(name):
+            var = ncfile.variables[name]
+            return var[time_idx, :, rows, cols] if len(var.shape) == 4 else var[:, rows, cols]
+
+        def point(name):
+            var = ncfile.variables[name]
+            return var[time_idx, rows, cols] if len(var.shape) == 3 else var[rows, cols]
+
+        fields = convert_columns(column, point, level_axis=0)
+    finally:
+        ncfile.close()
+
+    nz, ny, nx = fields[0].shape
+    # Put the levels last and make one column per grid point
+    pres, hght, tmpc, dwpc, u, v = [ np.moveaxis(np.ma.filled(f.astype(float), np.nan), 0, -1).reshape((ny * nx, nz))
+        for f in fields ]
+    results = gridded.compute_params(pres, hght, tmpc, dwpc, u, v, params=params)
+    return dict( (param, value.reshape((ny, nx))) for param, value in results.items() )
+
+def compute_grid_params(file_name, out_file=None, params=None, time_idx=0, stride=1, subdomain=None, max_procs=None):
+    """
+    Computes convective parameters for the columns of a WRF-ARW grid.
+
+    Parameters
+    ----------
+    file_name : str
+        The WRF-ARW netCDF file
+    out_file : str (optional)
+        A netCDF file to write the fields to
+    params : list (optional)
+        The names of the parameters to compute (see sharptab.gridded.PARAMS).
+        Default is all of them.
+    time_idx : int (optional)
+        The time in the file to use. Default is the first one.
+    stride : int (optional)
+        Only compute every stride'th row and column. Default is 1 (every column).
+    subdomain : tuple (optional)
+        (south, north, west, east) grid indices of the part of the grid to use,
+        like a slice (the north and east edges aren't included). Default is the whole grid.
+    max_procs : int (optional)
+        The max number of processes to use. None (the default) uses all the CPUs.
+
+    Returns
+    -------
+    fields : dict
+        The 2D field for each parameter
+    lats : numpy array
+        The latitudes of the columns
+    lons : numpy array
+        The longitudes of the columns
+    """
+    if params is None:
+        params = sorted(gridded.PARAMS.keys())
+    for param in params:
+        if param not in gridded.PARAMS:
+            raise ValueError("Unknown gridded parameter '%s'" % param)
+
+    ncfile = _open_dataset(file_name)
+    try:
+        ny, nx = ncfile.variables["XLAT"].shape[-2:]
+        j0, j1, i0, i1 = subdomain if subdomain is not None else (0, ny, 0, nx)
+        xlat = ncfile.variables["XLAT"]
+        xlon = ncfile.variables["XLONG"]
+        if len(xlat.shape) == 3:
+            lats = xlat[time_idx, j0:j1:stride, i0:i1:stride]
+            lons = xlon[time_idx, j0:j1:stride, i0:i1:stride]
+        else:
+            lats = xlat[j0:j1:stride, i0:i1:stride]
+            lons = xlon[j0:j1:stride, i0:i1:stride]
+
+        start_date = str(ncfile.START_DATE)
+        try:
+            valid_date = ''.join(np.asarray(ncfile.variables['Times'][time_idx], dtype=str))
+        except KeyError:
+            valid_date = ''
+    finally:
+        ncfile.close()
+
+    nrows, ncols = lats.shape
+    if nrows == 0 or ncols == 0:
+        raise ValueError("The subdomain doesn't have any grid points in it")
+
+    # Split the rows into bands of about CHUNK_COLUMNS columns each
+    band_rows = max(1, CHUNK_COLUMNS // ncols)
+    bands = []
+    for row in range(0, nrows, band_rows):
+        rows = slice(j0 + row * stride, j0 + min(row + band_rows, nrows) * stride, stride)
+        bands.append((file_name, time_idx, rows, slice(i0, i1, stride), params))
+
+    num_procs = max_procs if max_procs is not None else multiprocessing.cpu_count()
+    num_procs = min(num_procs, len(bands))
+    results = None
+    if num_procs > 1:
+        try:
+            pool = multiprocessing.Pool(num_procs)
+        except (OSError, ValueError) as e:
+            logging.exception(e)
+            logging.debug("Couldn't start the process pool, computing serially.")
+        else:
+            try:
+                results = pool.map(_compute_band, bands)
+            finally:
+                pool.close()
+                pool.join()
+
+    if results is None:
+        results = [ _compute_band(band) for band in bands ]
+
+    fields = dict( (param, np.concatenate([ res[param] for res in results ], axis=0)) for param in params )
+    lats = np.ma.filled(lats, np.nan)
+    lons = np.ma.filled(lons, np.nan)
+
+    if out_file is not None:
+        write_grid_params(out_file, fields, lats, lons, source=file_name, start_date=start_date,
+            valid_date=valid_date, stride=stride, subdomain=[j0, j1, i0, i1])
+
+    return fields, lats, lons
+
+def write_grid_params(out_file, fields, lats, lons, **attrs):
+    """
+    Writes 2D parameter fields to a netCDF file.
+
+    Parameters
+    ----------
+    out_file : str
+        The netCDF file to write
+    fields : dict
+        The 2D field for each parameter
+    lats : numpy array
+        The latitudes of the grid
+    lons : numpy array
+        The longitudes of the grid
+    attrs : (optional)
+        Global attributes to add to the file
+
+    Returns
+    -------
+    None
+    """
+    ncfile = _open_dataset(out_file, 'w')
+    try:
+        ncfile.createDimension('south_north', lats.shape[0])
+        ncfile.createDimension('west_east', lats.shape[1])
+        dims = ('south_north', 'west_east')
+
+        for name, data, units in [ ('XLAT', lats, 'degree_north'), ('XLONG', lons, 'degree_east') ]:
+            var = ncfile.createVariable(name, 'f4', dims)
+            var.units = units
+            var[:] = data
+
+        for param, data in sorted(fields.items()):
+            var = ncfile.createVariable(param, 'f4', dims, fill_value=np.float32(-9999.))
+            var.units = gridded.PARAMS.get(param, '')
+            var[:] = np.ma.masked_invalid(data)
+
+        ncfile.created = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S')
+        for key, value in attrs.items():
+            setattr(ncfile, key, value)
+    finally:
+        ncfile.close()
@@ -8,6 +8,7 @@ import sharppy.sharptab.prof_collection as prof_collection
 from .decoder import Decoder
 
 from datetime import datetime
+from functools import partial
 
 __fmtname__ = "bufkit"
 __classname__ = "BufDecoder"
@@ -21,10 +22,13 @@ def _prettify_member_name(mem_name):
 
 
 class BufDecoder(Decoder):
-    def __init__(self, file_name):
-        super(BufDecoder, self).__init__(file_name)
+    def __init__(self, file_name, max_procs=1, lazy=False, file_data=None):
+        super(BufDecoder, self).__init__(file_name, max_procs=max_procs, lazy=lazy, file_data=file_data)
 
     def _parse(self):
+        return self._parseIndexes(None)
+
+    def _parseIndexes(self, indexes):
         file_data = self._downloadFile()
 
         string = '\r\n\r\n\r\n'
@@ -33,10 +37,12 @@ class BufDecoder(Decoder):
         num_members = len(members)
         profiles = {}
         dates = None
+        loc = None
         mean_member = None
 
-        for n, mem_txt in enumerate(members):
-            mem_name, mem_profs, mem_dates = self._parseMember(mem_txt)
+        # The members are independent, so they can be decoded in parallel
+        parse_member = BufDecoder._parseMember if indexes is None else partial(BufDecoder._parseMember, indexes=indexes)
+        for mem_name, mem_profs, mem_dates, loc in self._mapSections(parse_member, list(members)):
             if "mean" in mem_name.lower():
                 mem_name = "Mean"
                 mean_member = mem_name
@@ -49,22 +55,34 @@ class BufDecoder(Decoder):
         if mean_member is None:
             mean_member = list(profiles.keys())[0]
 
+        base_time = dates[0]
+        if indexes is not None:
+            dates = [ dates[idx] for idx in prof_collection.normalize_indexes(indexes, len(dates)) ]
+
         prof_coll = prof_collection.ProfCollection(profiles, dates)
         prof_coll.setHighlightedMember(mean_member)
-        prof_coll.setMeta('loc', profiles[mean_member][0].location)
+        prof_coll.setMeta('loc', loc)
         prof_coll.setMeta('observed', False)
-        prof_coll.setMeta('base_time', dates[0])
+        prof_coll.setMeta('base_time', base_time)
         return prof_coll
 
-    def _parseMember(self, text):
-        data = np.array(text.split('\r\n'))
+    @classmethod
+    def _parseMember(cls, text, indexes=None):
+        # If indexes is given, only the profiles at those time indexes are decoded, but
+        # the dates for all the times are still returned, along with the station.
+        data = text.split('\r\n')
+        member_name = data[0]
+        dates = []
         data_idxs = []
         new_record = False
         begin_idx = 0
-        member_name = data[0]
-        dates = []
+
+        # Only the lines with one of the keywords can start or end a record, so
+        # find those in a single pass and then step through just those lines.
+        key_lines = [ i for i, line in enumerate(data) if 'HGHT' in line or 'STID' in line or 'STN' in line ]
+
         # Figure out the indices for the data chunks
-        for i in range(len(data)):
+        for i in key_lines:
             if "STID" in data[i]:
                 # Here is information about the record
                 spl = data[i].split()
@@ -78,9 +96,10 @@ class BufDecoder(Decoder):
                     wmo_id = spl[5]
                     dates.append(datetime.strptime(spl[8], '%y%m%d/%H%M'))
 
-                slat = float(data[i+1].split()[2])
-                slon = float(data[i+1].split()[5])
-                selv = float(data[i+1].split()[8])
+                stn_info = data[i+1].split()
+                slat = float(stn_info[2])
+                slon = float(stn_info[5])
+                selv = float(stn_info[8])
                 stim = float(data[i+2].split()[2])
 
             if data[i].find('HGHT') >= 0 and new_record == False:
@@ -95,42 +114,86 @@ class BufDecoder(Decoder):
                 # We've found the end of the last data chunk of the file
                 new_record = False
                 data_idxs.append((begin_idx, i))
-            elif new_record == True:
-                continue
-                    ##print data[i]
-        
+
         data_idxs = data_idxs[1:]
-        # Make arrays to store the data
-        profiles = []        
-
-        # Parse out the profiles
-        for i in range(len(data_idxs)):
-            data_stuff = data[data_idxs[i][0]: data_idxs[i][1]]
-            profile_length = len(data[data_idxs[i][0]: data_idxs[i][1]])//2
-
-            hght = np.zeros((profile_length,), dtype=float)
-            pres = np.zeros((profile_length,), dtype=float)
-            tmpc = np.zeros((profile_length,), dtype=float)
-            dwpc = np.zeros((profile_length,), dtype=float)
-            wdir = np.zeros((profile_length,), dtype=float)
-            wspd = np.zeros((profile_length,), dtype=float)
-            omeg = np.zeros((profile_length,), dtype=float)
-
-            for j in np.arange(0, profile_length * 2, 2):
-                if len(data_stuff[j+1].split()) == 1:
-                    hght[j // 2] = float(data_stuff[j+1].split()[0])
-                else:
-                    hght[j // 2] = float(data_stuff[j+1].split()[1])
-                tmpc[j // 2] = float(data_stuff[j].split()[1])
-                dwpc[j // 2] = float(data_stuff[j].split()[3])
-                pres[j // 2] = float(data_stuff[j].split()[0])
-                wspd[j // 2] = float(data_stuff[j].split()[6])
-                wdir[j // 2] = float(data_stuff[j].split()[5])
-                omeg[j // 2] = float(data_stuff[j].split()[7])
 
+        if indexes is not None:
+            indexes = prof_collection.normalize_indexes(indexes, min(len(dates), len(data_idxs)))
+            prof_dates = [ dates[idx] for idx in indexes ]
+            prof_idxs = [ data_idxs[idx] for idx in indexes ]
+        else:
+            prof_dates = dates
+            prof_idxs = data_idxs
+
+        # Each level takes up two lines in the file. Join all the levels from
+        # all the forecast hours together and convert them in one go.
+        prof_lens = [ (end - begin) // 2 for begin, end in prof_idxs ]
+        blocks = [ data[begin:begin + 2 * prof_len] for (begin, end), prof_len in zip(prof_idxs, prof_lens) ]
+        prof_data = cls._parseBlocks(blocks, prof_lens)
+
+        # Make the profile objects
+        profiles = []
+        for i, (pres, hght, tmpc, dwpc, wdir, wspd, omeg) in enumerate(prof_data):
             prof = profile.create_profile(profile='raw', pres=pres, hght=hght, tmpc=tmpc, dwpc=dwpc, 
-                wdir=wdir, wspd=wspd, omeg=omeg, location=station, date=dates[i], latitude=slat)
+                wdir=wdir, wspd=wspd, omeg=omeg, location=station, date=prof_dates[i], latitude=slat,
+                longitude=slon)
 
             profiles.append(prof)
 
-        return member_name, profiles, dates
+        return member_name, profiles, dates, station
+
+    @classmethod
+    def _parseBlocks(cls, blocks, prof_lens):
+        # Returns a list of (pres, hght, tmpc, dwpc, wdir, wspd, omeg) tuples, one for each block.
+        total_len = sum(prof_lens)
+        if total_len == 0:
+            return [ cls._parseBlockLines(block, prof_len) for block, prof_len in zip(blocks, prof_lens) ]
+
+        # The number of values per level comes from the first level (e.g. 8 on
+        # the first line and CFRL HGHT on the second line)
+        first_block = blocks[[ idx for idx, prof_len in enumerate(prof_lens) if prof_len > 0 ][0]]
+        num_vals = len(first_block[0].split()) + len(first_block[1].split())
+
+        values = np.array(' '.join(' '.join(block) for block in blocks).split(), dtype=float)
+        if len(first_block[0].split()) < 8 or len(values) != total_len * num_vals:
+            # The levels aren't all the same shape, so do it line by line
+            return [ cls._parseBlockLines(block, prof_len) for block, prof_len in zip(blocks, prof_lens) ]
+
+        values = values.reshape((total_len, num_vals))
+        # Height is the only value on the second line, or comes after CFRL
+        hght_col = min(num_vals - 1, len(first_block[0].split()) + 1)
+
+        prof_data = []
+        start = 0
+        for prof_len in prof_lens:
+            vals = values[start:start + prof_len]
+            prof_data.append((vals[:, 0].copy(), vals[:, hght_col].copy(), vals[:, 1].copy(), vals[:, 3].copy(),
+                              vals[:, 5].copy(), vals[:, 6].copy(), vals[:, 7].copy()))
+            start += prof_len
+        return prof_data
+
+    @staticmethod
+    def _parseBlockLines(data_stuff, profile_length):
+        hght = np.zeros((profile_length,), dtype=float)
+        pres = np.zeros((profile_length,), dtype=float)
+        tmpc = np.zeros((profile_length,), dtype=float)
+        dwpc = np.zeros((profile_length,), dtype=float)
+        wdir = np.zeros((profile_length,), dtype=float)
+        wspd = np.zeros((profile_length,), dtype=float)
+        omeg = np.zeros((profile_length,), dtype=float)
+
+        for j in np.arange(0, profile_length * 2, 2):
+            hght_line = data_stuff[j+1].split()
+            if len(hght_line) == 1:
+                hght[j // 2] = float(hght_line[0])
+            else:
+                hght[j // 2] = float(hght_line[1])
+            line = data_stuff[j].split()
+            tmpc[j // 2] = float(line[1])
+            dwpc[j // 2] = float(line[3])
+            pres[j // 2] = float(line[0])
+            wspd[j // 2] = float(line[6])
+            wdir[j // 2] = float(line[5])
+            omeg[j // 2] = float(line[7])
+
+        return pres, hght, tmpc, dwpc, wdir, wspd, omeg
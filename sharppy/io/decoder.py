@@ -2,18 +2,16 @@
 import numpy as np
 
 import sharppy.sharptab.profile as profile
-from sutils.utils import is_py3
+import sharppy.io.http_cache as http_cache
 
-try:
-    from urllib2 import urlopen
-except ImportError:
-    from urllib.request import urlopen
-import certifi
 from datetime import datetime
 import glob
 import os
-import imp
+import importlib
+import importlib.util
+import ast
 import logging
+import multiprocessing
 
 class abstract(object):
     def __init__(self, func):
@@ -25,72 +23,261 @@ class abstract(object):
 # Comment this file
 
 HOME_DIR = os.path.join(os.path.expanduser("~"), ".sharppy", "decoders")
-_decoders = {}
+# The built-in decoder modules.  Their format and class names are read from the
+# files, and the modules aren't imported until a file in that format is decoded.
+BUILT_INS = [ 'buf_decoder', 'spc_decoder', 'pecan_decoder', 'arw_decoder', 'uwyo_decoder', 'nucaps_decoder' ] # JTS - Added NUCAPS.
 
-def findDecoders():
-    global _decoders
+# Files with less text than this are always decoded in the calling process,
+# since starting the worker processes would take longer than the decoding.
+PARALLEL_MIN_SIZE = 500000
+
+def _readManifest(path):
+    """
+    Reads __fmtname__ and __classname__ from a custom decoder file without
+    importing it. Returns None if they aren't plain strings in the file.
+    """
+    try:
+        with open(path, 'r') as f:
+            tree = ast.parse(f.read(), filename=path)
+    except (IOError, SyntaxError, ValueError):
+        return None
+
+    consts = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name not in ('__fmtname__', '__classname__'):
+                continue
+            try:
+                value = ast.literal_eval(node.value)
+            except ValueError:
+                continue
+            if isinstance(value, str):
+                consts[name] = value
+
+    if len(consts) < 2:
+        return None
+    return consts['__fmtname__'], consts['__classname__']
+
+def _loadSource(module, path):
+    # Imports a module from a file
+    spec = importlib.util.spec_from_file_location(module, path)
+    dec_imp = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dec_imp)
+    return dec_imp
+
+class DecoderRegistry(object):
+    """
+    DecoderRegistry: Maps format names to decoder classes, importing each
+    decoder's module the first time its format is asked for. It acts like a
+    read-only dictionary.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._classes = {}
+
+    def register(self, fmt_name, module, class_name, path=None):
+        """
+        Adds a decoder without importing it.
+        fmt_name:   The format name
+        module:     The module name (for a custom decoder, the name to give it)
+        class_name: The name of the decoder class in the module
+        path:       The file the module is in, for custom decoders. Default is
+            to import it by module name.
+        """
+        self._entries[fmt_name] = (module, class_name, path)
+        self._classes.pop(fmt_name, None)
+
+    def registerClass(self, fmt_name, dec_cls):
+        """
+        Adds a decoder class that has already been imported.
+        """
+        self._entries[fmt_name] = (dec_cls.__module__, dec_cls.__name__, None)
+        self._classes[fmt_name] = dec_cls
 
-    level = -1 if not is_py3() else 0
+    def isLoaded(self, fmt_name):
+        return fmt_name in self._classes
 
-    built_ins = [ 'buf_decoder', 'spc_decoder', 'pecan_decoder', 'arw_decoder', 'uwyo_decoder', 'nucaps_decoder' ] # JTS - Added NUCAPS.
-    io = __import__('sharppy.io', globals(), locals(), built_ins, level)
+    def __getitem__(self, fmt_name):
+        if fmt_name not in self._classes:
+            module, class_name, path = self._entries[fmt_name]
+            logging.debug("Loading decoder '%s'." % module)
+            if path is None:
+                dec_imp = importlib.import_module(module)
+            else:
+                dec_imp = _loadSource(module, path)
+            self._classes[fmt_name] = getattr(dec_imp, class_name)
+        return self._classes[fmt_name]
 
-    for dec in built_ins:
-        # Load build-in decoders
-        logging.debug("Loading decoder '%s'." % dec)
-        dec_imp = getattr(io, dec)
+    def get(self, fmt_name, default=None):
+        try:
+            return self[fmt_name]
+        except KeyError:
+            return default
+
+    def __contains__(self, fmt_name):
+        return fmt_name in self._entries
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return list(self._entries.keys())
 
-        dec_name = dec_imp.__classname__
-        fmt_name = dec_imp.__fmtname__
+    def values(self):
+        # Generators, so a loop that stops early doesn't import the rest of the decoders
+        return ( self[fmt_name] for fmt_name in self.keys() )
 
-        _decoders[fmt_name] = getattr(dec_imp, dec_name)
+    def items(self):
+        return ( (fmt_name, self[fmt_name]) for fmt_name in self.keys() )
+
+_decoders = DecoderRegistry()
+
+def findDecoders():
+    for dec in BUILT_INS:
+        module = 'sharppy.io.' + dec
+        manifest = _readManifest(os.path.join(os.path.dirname(__file__), dec + '.py'))
+        if manifest is not None:
+            fmt_name, dec_name = manifest
+            _decoders.register(fmt_name, module, dec_name)
+        else:
+            # No source to read (e.g. a frozen build), so import it now
+            dec_imp = importlib.import_module(module)
+            _decoders.registerClass(dec_imp.__fmtname__, getattr(dec_imp, dec_imp.__classname__))
 
     custom = glob.glob(os.path.join(HOME_DIR, '*.py'))
 
     for dec in custom:
-        # Find and load custom decoders
+        # Find custom decoders. Their modules are only imported here if the format
+        # and class names can't be read from the file.
         dec_mod_name = os.path.basename(dec)[:-3]
         logging.debug("Found custom decoder '%s'." % dec_mod_name)
-        dec_imp = imp.load_source(dec_mod_name, dec)
-
-        dec_name = dec_imp.__classname__
-        fmt_name = dec_imp.__fmtname__
-
-        _decoders[fmt_name] = getattr(dec_imp, dec_name)
+        manifest = _readManifest(dec)
+        if manifest is not None:
+            fmt_name, dec_name = manifest
+            _decoders.register(fmt_name, dec_mod_name, dec_name, path=dec)
+        else:
+            dec_imp = _loadSource(dec_mod_name, dec)
+            _decoders.registerClass(dec_imp.__fmtname__, getattr(dec_imp, dec_imp.__classname__))
 
 def getDecoder(dec_name):
     return getDecoders()[dec_name]
 
 def getDecoders():
-    if _decoders == {}:
+    if len(_decoders) == 0:
         findDecoders()
 
     return _decoders
 
+def getFormats():
+    """
+    Returns the names of the formats there are decoders for, without importing any of them.
+    """
+    return getDecoders().keys()
+
 class Decoder(object):
-    def __init__(self, file_name):
+    def __init__(self, file_name, max_procs=1, lazy=False, file_data=None):
+        """
+        file_name:  The file name or URL to decode.
+        max_procs:  The max number of processes to use to decode independent sections of
+            the file (e.g. ensemble members). None uses all the CPUs. Default is 1 (serial).
+        lazy:   If True, don't decode anything until getProfiles() is called, and then only
+            decode the profiles that were asked for. Default is False.
+        file_data:  The contents of the file, if it has already been downloaded (e.g. by
+            downloads.fetch_many()), as bytes or text. Default is to read it from file_name.
+        """
         self._file_name = file_name
-        self._prof_collection = self._parse()
+        self._max_procs = max_procs
+        self._lazy = lazy
+        if isinstance(file_data, bytes):
+            file_data = file_data.decode('utf-8')
+        self._file_data = file_data
+        self._lazy_profs = {}
+
+        if lazy:
+            self._prof_collection = None
+        else:
+            self._prof_collection = self._parse()
+
+    @classmethod
+    def supportsLazy(cls):
+        """
+        Returns True if the decoder can decode only some of the time indexes in a file
+        (i.e. it overrides _parseIndexes()).
+        """
+        return cls._parseIndexes is not Decoder._parseIndexes
 
     @abstract
     def _parse(self):
         pass
 
+    def _parseIndexes(self, indexes):
+        """
+        Decodes only the profiles at the given time indexes. Decoders that can find the
+        records for a time in a cheap pass should override this. The default decodes the
+        whole file and subsets it.
+        """
+        self._prof_collection = self._parse()
+        return self._prof_collection.subset(indexes)
+
     def _downloadFile(self):
-        # Try to open the file.  This is a dirty hack right now until
-        # I can figure out a cleaner way to make sure the file (either local or URL)
-        # gets opened.
-        try:
-            f = urlopen(self._file_name, cafile=certifi.where())
-        except (ValueError, IOError):
+        # In lazy mode, the file may be decoded a piece at a time, so only download it once.
+        # The contents may also have been handed to the decoder already.
+        if self._file_data is not None:
+            return self._file_data
+
+        # URLs go through the on-disk cache, so a file that hasn't changed on the
+        # server is only downloaded once.
+        if http_cache.is_remote(self._file_name):
+            try:
+                file_data = http_cache.get_cache().fetch(self._file_name)
+            except http_cache.DownloadCancelled:
+                raise
+            except IOError as e:
+                logging.debug(str(e))
+                raise IOError("File '%s' cannot be found" % self._file_name)
+        else:
             try:
                 fname = self._file_name[7:] if self._file_name.startswith('file://') else self._file_name
-                f = open(fname, 'rb')
+                with open(fname, 'rb') as f:
+                    file_data = f.read()
             except IOError:
                 raise IOError("File '%s' cannot be found" % self._file_name)
-        file_data = f.read()
-#       f.close() # Apparently, this multiplies the time this function takes by anywhere from 2 to 6 ... ???
-        return file_data.decode('utf-8')
+        file_data = file_data.decode('utf-8')
+        if self._lazy:
+            self._file_data = file_data
+        return file_data
+
+    def _mapSections(self, func, sections):
+        """
+        Applies func to each section of the file and returns the results in the
+        same order as the sections.  The sections are spread over a process pool if
+        the decoder was given more than one process and the file is big enough to
+        make it worth it.  Otherwise, they're decoded one after another.
+
+        func:   A picklable function (e.g. a module-level function or a classmethod)
+        sections:   A list of the text sections to decode.
+        """
+        num_procs = self._max_procs if self._max_procs is not None else multiprocessing.cpu_count()
+        num_procs = min(num_procs, len(sections))
+
+        if num_procs > 1 and sum(len(sect) for sect in sections) >= PARALLEL_MIN_SIZE:
+            try:
+                pool = multiprocessing.Pool(num_procs)
+            except (OSError, ValueError) as e:
+                logging.exception(e)
+                logging.debug("Couldn't start the process pool, decoding serially.")
+            else:
+                try:
+                    return pool.map(func, sections)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        return [ func(sect) for sect in sections ]
 
     def getProfiles(self, indexes=None):
         '''
@@ -104,12 +291,26 @@ class Decoder(object):
                 Default is to return the full list of profiles
 
         '''
+        if self._prof_collection is None:
+            if indexes is None:
+                self._prof_collection = self._parse()
+            else:
+                # Lazy mode: decode just these indexes the first time they're asked for
+                key = tuple(indexes)
+                if key not in self._lazy_profs:
+                    self._lazy_profs[key] = self._parseIndexes(list(indexes))
+                return self._lazy_profs[key]
+
         prof_col = self._prof_collection
         if indexes is not None:
             prof_col = prof_col.subset(indexes)
         return prof_col
 
     def getStnId(self):
+        if self._prof_collection is None:
+            if len(self._lazy_profs) > 0:
+                return list(self._lazy_profs.values())[0].getMeta('loc')
+            return self.getProfiles(indexes=[0]).getMeta('loc')
         return self._prof_collection.getMeta('loc')
 
 if __name__ == "__main__":
@@ -0,0 +1,308 @@
+try:
+    from urlparse import urlsplit, urljoin
+    import httplib as http_client
+except ImportError:
+    from urllib.parse import urlsplit, urljoin
+    import http.client as http_client
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+import sharppy.io.http_cache as http_cache
+from sharppy.io.http_cache import DownloadCancelled
+import certifi
+import ssl
+import threading
+import socket
+import logging
+import atexit
+
+## Downloads many files at once.  The URLs are fetched by a bounded pool of
+## threads, and each thread keeps one connection open to each host it has
+## talked to, so a batch of files from the same server doesn't pay for a new
+## connection (and TLS handshake) per file.  Everything goes through the
+## on-disk cache in http_cache, so files that haven't changed aren't
+## downloaded again.  Failed requests are retried with exponential backoff.
+##
+## The bodies can be handed straight to the decoders, e.g.
+##
+##   bodies = fetch_many(urls)
+##   decs = [ SPCDecoder(url, file_data=body) for url, body in zip(urls, bodies) ]
+##
+## Each batch of downloads has its own cancel token (a threading.Event), so
+## cancelling one batch doesn't stop the downloads that come after it.
+
+# Max number of downloads at once
+DEFAULT_WORKERS = 8
+
+# Bytes read from the server at a time (progress is reported after each read)
+READ_SIZE = 65536
+
+_managers = {}
+
+class DownloadManager(object):
+    """
+    DownloadManager: Fetches URLs on a pool of threads, reusing connections.
+    """
+    def __init__(self, max_workers=DEFAULT_WORKERS, retries=3, backoff=0.5, timeout=30, cache=None):
+        """
+        max_workers:    The max number of downloads at once.
+        retries:    The number of times to retry a request that failed because the
+            server couldn't be reached or had an error (5xx).
+        backoff:    Seconds to wait before the first retry. The wait doubles after each retry.
+        timeout:    Seconds to wait on the server before giving up.
+        cache:  The HTTPCache to use. Default is the shared one in ~/.sharppy/cache/http.
+        """
+        self._max_workers = max_workers
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._cache = cache if cache is not None else http_cache.get_cache()
+        self._context = ssl.create_default_context(cafile=certifi.where())
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._pending = {}
+        self._local = threading.local()
+        self._conns = set()
+
+    def _getPool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._max_workers)
+            return self._pool
+
+    def _connection(self, scheme, netloc):
+        # One open connection per host per thread
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = {}
+
+        key = (scheme, netloc)
+        if key not in self._local.conns:
+            if scheme == 'https':
+                conn = http_client.HTTPSConnection(netloc, timeout=self._timeout, context=self._context)
+            else:
+                conn = http_client.HTTPConnection(netloc, timeout=self._timeout)
+            self._local.conns[key] = conn
+            with self._pool_lock:
+                self._conns.add(conn)
+        return self._local.conns[key]
+
+    def _dropConnection(self, scheme, netloc):
+        conn = self._local.conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+            with self._pool_lock:
+                self._conns.discard(conn)
+
+    def _request(self, url, headers, progress, cancel):
+        # Makes one GET request over a kept-alive connection, following redirects
+        for redirect in range(5):
+            parts = urlsplit(url)
+            path = parts.path if parts.path != '' else '/'
+            if parts.query != '':
+                path += '?' + parts.query
+
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+
+                total = resp.getheader('Content-Length')
+                total = int(total) if total is not None else None
+                chunks = []
+                nread = 0
+                while True:
+                    if cancel.is_set():
+                        raise DownloadCancelled("The download of '%s' was cancelled" % url)
+
+                    chunk = resp.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    nread += len(chunk)
+                    if progress is not None:
+                        progress(url, nread, total)
+            except (http_client.HTTPException, socket.error, IOError):
+                # The connection is in an unknown state, so start over with a new one next time
+                self._dropConnection(parts.scheme, parts.netloc)
+                raise
+
+            if resp.will_close:
+                self._dropConnection(parts.scheme, parts.netloc)
+
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location') is not None:
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            return resp.status, resp.msg, b''.join(chunks)
+
+        raise IOError("Too many redirects for '%s'" % url)
+
+    def _get(self, url, headers, progress, cancel):
+        # The function the cache uses to talk to the server: retries with backoff
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            if cancel.is_set():
+                raise DownloadCancelled("The download of '%s' was cancelled" % url)
+
+            try:
+                code, resp_headers, body = self._request(url, headers, progress, cancel)
+            except DownloadCancelled:
+                raise
+            except (http_client.HTTPException, socket.error, IOError) as e:
+                if attempt == self._retries:
+                    raise IOError(str(e))
+                logging.debug("Request for '%s' failed (%s), retrying in %.1f s." % (url, e, delay))
+            else:
+                if code < 500 or attempt == self._retries:
+                    return code, resp_headers, body
+                logging.debug("Request for '%s' got HTTP %d, retrying in %.1f s." % (url, code, delay))
+
+            cancel.wait(delay)
+            delay *= 2
+
+    def fetch(self, url, progress=None, cancel=None):
+        """
+        Returns the body of a URL as bytes. Raises IOError if it can't be fetched, or
+        DownloadCancelled if the download was cancelled.
+
+        url:    The URL to fetch.
+        progress:   A function (url, bytes read, total bytes) called as the body comes in
+            and once more when it's done. The total is None if the server didn't say.
+        cancel:     A threading.Event that cancels the download when it's set.
+        """
+        if cancel is None:
+            cancel = threading.Event()
+        if cancel.is_set():
+            raise DownloadCancelled("The download of '%s' was cancelled" % url)
+
+        scheme = urlsplit(url).scheme.lower()
+        if scheme in ('http', 'https'):
+            get = lambda u, headers: self._get(u, headers, progress, cancel)
+        else:
+            # Other schemes (e.g. ftp) go through urlopen with no connection reuse
+            get = None
+        body = self._cache.fetch(url, get=get)
+
+        if cancel.is_set():
+            raise DownloadCancelled("The download of '%s' was cancelled" % url)
+        if progress is not None:
+            progress(url, len(body), len(body))
+        return body
+
+    def submit(self, url, progress=None, cancel=None):
+        """
+        Starts fetching a URL in the background and returns a concurrent.futures.Future
+        for its body. Setting cancel (a threading.Event) cancels the download.
+        """
+        if cancel is None:
+            cancel = threading.Event()
+        fut = self._getPool().submit(self.fetch, url, progress, cancel)
+        with self._pool_lock:
+            self._pending[fut] = cancel
+        fut.add_done_callback(self._discard)
+        return fut
+
+    def _discard(self, fut):
+        with self._pool_lock:
+            self._pending.pop(fut, None)
+
+    def fetchMany(self, urls, progress=None, futures=False, cancel=None):
+        """
+        Fetches a list of URLs at once.
+
+        urls:   The URLs to fetch.
+        progress:   A function (url, bytes read, total bytes) called as the bodies come in.
+        futures:    If True, return the Futures right away instead of waiting for the bodies.
+        cancel:     A threading.Event that cancels the whole batch when it's set. Default
+            is a new one for this batch.
+
+        Returns a list of the bodies (or Futures) in the same order as the URLs. A body
+        that couldn't be fetched is the IOError that was raised instead.
+        """
+        if cancel is None:
+            cancel = threading.Event()
+        futs = [ self.submit(url, progress, cancel) for url in urls ]
+        if futures:
+            return futs
+
+        bodies = []
+        for fut in futs:
+            try:
+                bodies.append(fut.result())
+            except IOError as e:
+                bodies.append(e)
+            except CancelledError:
+                bodies.append(DownloadCancelled("The download was cancelled"))
+        return bodies
+
+    def cancel(self):
+        """
+        Cancels all the downloads that are waiting or in progress. They raise
+        DownloadCancelled. Downloads submitted afterward aren't affected.
+        """
+        with self._pool_lock:
+            pending = list(self._pending.items())
+        for fut, cancel in pending:
+            cancel.set()
+            fut.cancel()
+
+    def close(self):
+        """
+        Waits for the downloads in progress, shuts down the thread pool, and closes the
+        kept-alive connections.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+        with self._pool_lock:
+            conns, self._conns = list(self._conns), set()
+        for conn in conns:
+            conn.close()
+
+def get_manager(max_workers=DEFAULT_WORKERS):
+    """
+    Returns the shared DownloadManager with this many workers.
+
+    Parameters
+    ----------
+    max_workers : int (optional)
+        The max number of downloads at once
+
+    Returns
+    -------
+    DownloadManager
+    """
+    if max_workers not in _managers:
+        _managers[max_workers] = DownloadManager(max_workers=max_workers)
+    return _managers[max_workers]
+
+def fetch_many(urls, max_workers=DEFAULT_WORKERS, progress=None, futures=False):
+    """
+    Fetches a list of URLs at once with the shared DownloadManager.
+
+    Parameters
+    ----------
+    urls : list
+        The URLs to fetch
+    max_workers : int (optional)
+        The max number of downloads at once
+    progress : function (optional)
+        Called with (url, bytes read, total bytes) as the bodies come in
+    futures : bool (optional)
+        If True, return Futures for the bodies instead of waiting for them
+
+    Returns
+    -------
+    A list of the bodies as bytes (or Futures, or the IOError for a URL that couldn't
+    be fetched), in the same order as the URLs
+    """
+    return get_manager(max_workers).fetchMany(urls, progress=progress, futures=futures)
+
+def close_managers():
+    """
+    Closes the shared DownloadManagers. This is called when the program exits.
+    """
+    for manager in list(_managers.values()):
+        manager.close()
+
+atexit.register(close_managers)
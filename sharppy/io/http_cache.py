@@ -0,0 +1,277 @@
+try:
+    from urllib2 import urlopen, Request, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
+from contextlib import closing
+import certifi
+import ssl
+import hashlib
+import threading
+import socket
+import json
+import time
+import os
+import logging
+
+## On-disk cache of the files downloaded from the data sources.  Each URL is
+## stored as two files named by the SHA-1 hash of the URL: the body and a small
+## JSON file with the ETag, Last-Modified time and when it was fetched.  A
+## cached body is served without touching the network until its time-to-live
+## runs out, and after that it's revalidated with a conditional GET, so an
+## unchanged file is never downloaded twice.  If the network is down (or the
+## cache is put in offline mode), whatever is in the cache is served.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".sharppy", "cache", "http")
+
+# Seconds a cached body is served without revalidating it, unless a TTL has
+# been set for the URL
+DEFAULT_TTL = 600
+
+# Bytes of bodies to keep before the least recently used ones are evicted
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024
+
+_caches = {}
+
+class DownloadCancelled(IOError):
+    pass
+
+class HTTPCache(object):
+    """
+    HTTPCache: An on-disk cache of URL responses.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_size=DEFAULT_MAX_SIZE, default_ttl=DEFAULT_TTL, timeout=30):
+        """
+        cache_dir:  The directory to keep the cached responses in.
+        max_size:   The max number of bytes of response bodies to keep.
+        default_ttl:    Seconds to serve a body before revalidating it, for URLs
+            that don't have a TTL set with setTTL().
+        timeout:    Seconds to wait on the server before giving up.
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._default_ttl = default_ttl
+        self._timeout = timeout
+        self._ttls = {}
+        self._offline = False
+        self._offline_until = None
+        self._lock = threading.Lock()
+        self._context = ssl.create_default_context(cafile=certifi.where())
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self._cache_dir, key)
+        return base + '.body', base + '.json'
+
+    def _readMeta(self, url):
+        body_fn, meta_fn = self._paths(url)
+        try:
+            with open(meta_fn, 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if meta.get('url') != url or not os.path.exists(body_fn):
+            return None
+        return meta
+
+    def _readBody(self, url):
+        body_fn, meta_fn = self._paths(url)
+        with open(body_fn, 'rb') as f:
+            body = f.read()
+        # The body's mtime is the last time it was used, which is what eviction goes by
+        os.utime(body_fn, None)
+        return body
+
+    def _writeEntry(self, url, body, meta):
+        body_fn, meta_fn = self._paths(url)
+        # Write to temporary files first so a half-written entry is never read
+        for fn, data, mode in [ (body_fn, body, 'wb'), (meta_fn, json.dumps(meta), 'w') ]:
+            tmp_fn = "%s.%d.%d.tmp" % (fn, os.getpid(), threading.current_thread().ident)
+            with open(tmp_fn, mode) as f:
+                f.write(data)
+            os.replace(tmp_fn, fn)
+
+    def _touchMeta(self, url, meta):
+        body_fn, meta_fn = self._paths(url)
+        tmp_fn = "%s.%d.%d.tmp" % (meta_fn, os.getpid(), threading.current_thread().ident)
+        with open(tmp_fn, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_fn, meta_fn)
+
+    def setTTL(self, url_prefix, ttl):
+        """
+        Sets the number of seconds to serve cached bodies for URLs starting with
+        url_prefix before revalidating them. The longest matching prefix wins.
+        """
+        self._ttls[url_prefix] = ttl
+
+    def getTTL(self, url):
+        """
+        Returns the number of seconds a cached body for this URL is served without
+        revalidating it.
+        """
+        prefixes = [ pfx for pfx in self._ttls.keys() if url.startswith(pfx) ]
+        if len(prefixes) == 0:
+            return self._default_ttl
+        return self._ttls[max(prefixes, key=len)]
+
+    def setOffline(self, offline, ttl=None):
+        """
+        In offline mode, only cached bodies are served, and the network is never used.
+        ttl:    Seconds until the cache goes back online by itself (default is to stay
+            offline until setOffline(False) is called).
+        """
+        self._offline = offline
+        self._offline_until = time.time() + ttl if offline and ttl is not None else None
+
+    def isOffline(self):
+        if self._offline and self._offline_until is not None and time.time() >= self._offline_until:
+            # Try the network again
+            self._offline = False
+            self._offline_until = None
+        return self._offline
+
+    def isCached(self, url):
+        """
+        Returns True if there is a cached body for this URL (fresh or not).
+        """
+        return self._readMeta(url) is not None
+
+    def _urlGet(self, url, headers):
+        # The default way of getting a URL. Returns the status code, headers and body.
+        try:
+            with closing(urlopen(Request(url, headers=headers), timeout=self._timeout, context=self._context)) as resp:
+                return 200, resp.headers, resp.read()
+        except HTTPError as e:
+            return e.code, e.headers, b''
+        except (URLError, socket.timeout) as e:
+            raise IOError(str(e))
+
+    def fetch(self, url, get=None):
+        """
+        Returns the body of the URL as bytes, from the cache if it's there and fresh,
+        and from the server otherwise. Raises IOError if the URL can't be fetched
+        and isn't in the cache.
+
+        url:    The URL to fetch.
+        get:    A function (url, headers) -> (status code, response headers, body) used
+            to talk to the server (it should raise IOError if the server can't be reached).
+            Default uses urlopen.
+        """
+        meta = self._readMeta(url)
+        if meta is not None:
+            age = time.time() - meta['fetched']
+            if self.isOffline() or 0 <= age < self.getTTL(url):
+                return self._readBody(url)
+        elif self.isOffline():
+            raise IOError("'%s' is not in the cache, and the cache is offline" % url)
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        if get is None:
+            get = self._urlGet
+
+        try:
+            code, resp_headers, body = get(url, headers)
+        except DownloadCancelled:
+            raise
+        except IOError as e:
+            if meta is not None:
+                logging.debug("Couldn't reach '%s', serving it from the cache." % url)
+                return self._readBody(url)
+            raise IOError("'%s' could not be downloaded: %s" % (url, e))
+
+        if code == 304 and meta is not None:
+            # Not modified, so the cached body is good for another TTL
+            meta['fetched'] = time.time()
+            self._touchMeta(url, meta)
+            return self._readBody(url)
+        elif code != 200:
+            raise IOError("'%s' could not be downloaded (HTTP %d)" % (url, code))
+
+        etag = resp_headers.get('ETag') if resp_headers is not None else None
+        last_modified = resp_headers.get('Last-Modified') if resp_headers is not None else None
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified, 'fetched': time.time(), 'size': len(body)}
+        self._writeEntry(url, body, meta)
+        self.evict()
+        return body
+
+    def getSize(self):
+        """
+        Returns the number of bytes of bodies in the cache.
+        """
+        return sum(size for fn, mtime, size in self._bodies())
+
+    def _bodies(self):
+        bodies = []
+        for fn in os.listdir(self._cache_dir):
+            if not fn.endswith('.body'):
+                continue
+            path = os.path.join(self._cache_dir, fn)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Evicted by someone else
+                continue
+            bodies.append((path, stat.st_mtime, stat.st_size))
+        return bodies
+
+    def evict(self, max_size=None):
+        """
+        Deletes the least recently used bodies until the cache is no bigger than
+        max_size bytes (default is the cache's max size).
+        """
+        if max_size is None:
+            max_size = self._max_size
+
+        with self._lock:
+            bodies = sorted(self._bodies(), key=lambda b: b[1])
+            total = sum(size for fn, mtime, size in bodies)
+            for body_fn, mtime, size in bodies:
+                if total <= max_size:
+                    break
+                meta_fn = body_fn[:-len('.body')] + '.json'
+                for fn in [ meta_fn, body_fn ]:
+                    try:
+                        os.remove(fn)
+                    except OSError:
+                        pass
+                total -= size
+
+    def clear(self):
+        """
+        Deletes everything in the cache.
+        """
+        self.evict(max_size=0)
+
+def get_cache(cache_dir=CACHE_DIR):
+    """
+    Returns the shared HTTPCache for a cache directory (default is ~/.sharppy/cache/http).
+
+    Parameters
+    ----------
+    cache_dir : str (optional)
+        The directory the cache is kept in
+
+    Returns
+    -------
+    HTTPCache
+    """
+    if cache_dir not in _caches:
+        _caches[cache_dir] = HTTPCache(cache_dir)
+    return _caches[cache_dir]
+
+def is_remote(url):
+    """
+    Returns True if the file name is a URL the cache handles (http, https or ftp).
+    """
+    return url.split('://', 1)[0].lower() in ('http', 'https', 'ftp')
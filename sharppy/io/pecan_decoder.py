@@ -14,24 +14,40 @@ __fmtname__ = "pecan"
 __classname__ = "PECANDecoder"
 
 class PECANDecoder(Decoder):
-    def __init__(self, file_name):
-        super(PECANDecoder, self).__init__(file_name)
+    def __init__(self, file_name, max_procs=1, lazy=False, file_data=None):
+        super(PECANDecoder, self).__init__(file_name, max_procs=max_procs, lazy=lazy, file_data=file_data)
 
     def _parse(self):
+        return self._parseIndexes(None)
+
+    def _parseIndexes(self, indexes):
         file_data = self._downloadFile()
 
         file_profiles = file_data.split('\n\n\n')
+        if indexes is not None:
+            # Only the second line of each section is needed to find its time, so
+            # read those and keep just the sections at the requested times.
+            sect_times = [ PECANDecoder._tryParseTime(section) for section in file_profiles ]
+            all_dates = []
+            for sect_time in sect_times:
+                if sect_time is not None and sect_time[0] not in all_dates:
+                    all_dates.append(sect_time[0])
+            keep_dates = [ all_dates[idx] for idx in prof_collection.normalize_indexes(indexes, len(all_dates)) ]
+            all_inits = [ sect_time[1] for sect_time in sect_times if sect_time is not None ]
+            all_sections = file_profiles
+            file_profiles = [ section for section, sect_time in zip(file_profiles, sect_times)
+                if sect_time is not None and sect_time[0] in keep_dates ]
+
         profiles = {}
         dates = []
         date_init = None
         loc = None
-        for m in file_profiles:
-            try:
-                prof, dt_obj, init_dt, member = self._parseSection(m)
-            except Exception as e:
-            #    print(e)
+        # The sections are independent, so they can be decoded in parallel
+        for section in self._mapSections(PECANDecoder._tryParseSection, file_profiles):
+            if section is None:
                 continue
-            
+            prof, dt_obj, init_dt, member = section
+
             loc = prof.location
             # Try to add the profile object to the list of profiles for this member
             try:
@@ -43,6 +59,26 @@ class PECANDecoder(Decoder):
             if date_init is None or init_dt < date_init:
                 date_init = init_dt
             #print(profiles)
+        if indexes is not None:
+            # Put the profiles in the order they were asked for
+            date_order = [ dates.index(dt_obj) for dt_obj in keep_dates if dt_obj in dates ]
+            profiles = dict( (mem, [ profs[idx] for idx in date_order if idx < len(profs) ]) for mem, profs in profiles.items() )
+            # Keep all the members, in file order, even if none of their times were asked for
+            members = []
+            for section, sect_time in zip(all_sections, sect_times):
+                member = section.split('\n', 1)[0].split('=')[-1].strip()
+                if sect_time is not None and member not in members:
+                    members.append(member)
+            profiles = dict( (mem, profiles.get(mem, [])) for mem in members )
+            dates = [ dt_obj for dt_obj in keep_dates if dt_obj in dates ]
+            date_init = min(all_inits) if len(all_inits) > 0 else None
+            if loc is None:
+                # None of the times were asked for, but the station still comes from the file
+                first = next(( section for section, sect_time in zip(all_sections, sect_times) if sect_time is not None ), None)
+                parsed = PECANDecoder._tryParseSection(first) if first is not None else None
+                if parsed is not None:
+                    loc = parsed[0].location
+
         prof_coll = prof_collection.ProfCollection(profiles, dates)
         if "MEAN" in list(profiles.keys()):
             prof_coll.setHighlightedMember("MEAN")
@@ -51,7 +87,33 @@ class PECANDecoder(Decoder):
         prof_coll.setMeta('loc', loc)
         return prof_coll
 
-    def _parseSection(self, section):
+    @classmethod
+    def _tryParseSection(cls, section):
+        # Sections that can't be decoded (e.g. blank ones) are skipped
+        try:
+            return cls._parseSection(section)
+        except Exception as e:
+        #    print(e)
+            return None
+
+    @staticmethod
+    def _tryParseTime(section):
+        # Returns the valid and initialization times of a section from just its time line
+        try:
+            parts = section.split('\n', 2)
+            if ' F' in parts[1]:
+                valid, fhr = parts[1].split(' F')
+                fhr = int(fhr)
+            else:
+                valid = parts[1]
+                fhr = 0
+            dt_obj = datetime.strptime(valid, 'TIME = %y%m%d/%H%M')
+            return dt_obj, dt_obj - timedelta(hours=fhr)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _parseSection(section):
         parts = section.split('\n')
         if ' F' in parts[1]:
             valid, fhr = parts[1].split(' F')
@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import logging
+
+## Loads the soundings the user is likely to ask for next while they're looking
+## at the current one.  After a sounding is loaded, predict_requests() guesses
+## what comes next (the next and previous runs and the nearest stations), and
+## the PrefetchScheduler downloads and decodes those on a background thread and
+## builds the ConvectiveProfiles, once the user has been idle for a moment.
+## The results are kept within a memory budget until they're asked for.
+## Scheduling a new set of predictions cancels the ones that haven't started.
+
+# Bytes of prefetched profiles to keep
+DEFAULT_MEMORY_BUDGET = 200 * 1024 * 1024
+
+# Seconds the user has to be idle before prefetching starts
+DEFAULT_IDLE_DELAY = 1.
+
+def request_key(data_source, loc, run, indexes):
+    """
+    Returns a hashable key for a sounding request.
+    """
+    return (data_source.getName(), loc['srcid'], run, tuple(indexes))
+
+def _haversine(lat1, lon1, lats, lons):
+    lat1, lon1, lats, lons = [ np.radians(x) for x in (lat1, lon1, lats, lons) ]
+    a = np.sin((lats - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lats) * np.sin((lons - lon1) / 2.) ** 2
+    return 2 * np.arcsin(np.sqrt(a))
+
+def predict_requests(data_source, loc, run, indexes, num_stations=2, points=None):
+    """
+    Guesses the sounding requests that are likely to follow this one.
+
+    Parameters
+    ----------
+    data_source : DataSource
+        The data source of the current sounding
+    loc : dict
+        The station point of the current sounding
+    run : datetime
+        The run (or observation time) of the current sounding
+    indexes : list
+        The time indexes that were loaded
+    num_stations : int (optional)
+        The number of nearby stations to predict. Default is 2.
+    points : list (optional)
+        The station points to pick the nearby stations from. Default is the
+        stations available at the run.
+
+    Returns
+    -------
+    A list of (data_source, loc, run, indexes) tuples, most likely first
+    """
+    # The next and previous runs
+    cycles = sorted(data_source.getDailyCycles())
+    if len(cycles) > 1:
+        step = timedelta(hours=min( c2 - c1 for c1, c2 in zip(cycles[:-1], cycles[1:]) ))
+    else:
+        step = timedelta(hours=24)
+
+    recent = data_source.getMostRecentCycle()
+    runs = [ (data_source, loc, next_run, indexes) for next_run in [ run + step, run - step ] if next_run <= recent ]
+
+    # The nearest stations
+    if points is None:
+        points = data_source.getAvailableAtTime(run)
+    points = [ pnt for pnt in points if pnt['srcid'] != loc['srcid'] ]
+    stations = []
+    if len(points) > 0 and num_stations > 0:
+        lats = np.array([ pnt['lat'] for pnt in points ])
+        lons = np.array([ pnt['lon'] for pnt in points ])
+        dists = _haversine(loc['lat'], loc['lon'], lats, lons)
+        stations = [ (data_source, points[idx], run, indexes) for idx in np.argsort(dists)[:num_stations] ]
+
+    # Stepping forward in time is the most common, then the nearby stations
+    return runs[:1] + stations + runs[1:]
+
+class PrefetchScheduler(object):
+    """
+    PrefetchScheduler: Loads likely sounding requests in the background.
+    """
+    def __init__(self, loader, memory_budget=DEFAULT_MEMORY_BUDGET, idle_delay=DEFAULT_IDLE_DELAY):
+        """
+        loader: A function (data_source, loc, run, indexes) -> ProfCollection that loads a sounding.
+        memory_budget:  The max number of bytes of prefetched profiles to keep.
+        idle_delay: Seconds since the last request before prefetching starts.
+        """
+        self._loader = loader
+        self._memory_budget = memory_budget
+        self._idle_delay = idle_delay
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._done = OrderedDict()
+        self._sizes = {}
+        self._pending = {}
+        self._wanted = set()
+        self._loading = set()
+        self._last_activity = time.time()
+
+        self._hits = 0
+        self._misses = 0
+        self._loaded = 0
+        self._evicted = 0
+        self._cancelled = 0
+
+    def _run(self, key, request):
+        # Wait for the user to be idle, giving up if the request isn't wanted anymore
+        while True:
+            with self._lock:
+                if key not in self._wanted:
+                    self._pending.pop(key, None)
+                    self._cancelled += 1
+                    return None
+                wait = self._last_activity + self._idle_delay - time.time()
+                if wait <= 0:
+                    self._loading.add(key)
+                    break
+            time.sleep(min(wait, 0.1))
+
+        try:
+            prof_col = self._loader(*request)
+            # Build the ConvectiveProfiles for the highlighted member now, so showing it is quick
+            for idx in range(len(prof_col.getDates())):
+                prof_col.getProfAt(idx)
+        except Exception as e:
+            logging.exception(e)
+            logging.debug("Couldn't prefetch %s." % str(key))
+            with self._lock:
+                self._pending.pop(key, None)
+                self._loading.discard(key)
+            return None
+
+        size = prof_col.getMemoryUsage()['total']
+        with self._lock:
+            self._pending.pop(key, None)
+            self._loading.discard(key)
+            if size > self._memory_budget:
+                return None
+            self._done[key] = prof_col
+            self._sizes[key] = size
+            self._loaded += 1
+            self._evict()
+        return prof_col
+
+    def _evict(self):
+        # Drops collections until they fit in the budget: first the old predictions that
+        # aren't wanted anymore, then the wanted ones from the least likely (they're
+        # loaded most likely first, so that's the last one loaded)
+        stale = [ key for key in self._done.keys() if key not in self._wanted ]
+        wanted = [ key for key in reversed(self._done.keys()) if key in self._wanted ]
+        for key in stale + wanted:
+            if sum(self._sizes.values()) <= self._memory_budget:
+                break
+            del self._done[key]
+            del self._sizes[key]
+            self._evicted += 1
+
+    def prefetch(self, requests):
+        """
+        Schedules requests to be loaded in the background, and cancels the
+        scheduled ones that haven't started yet.
+        requests:   A list of (data_source, loc, run, indexes) tuples, most likely first.
+        """
+        with self._lock:
+            self._last_activity = time.time()
+            self._wanted = set( request_key(*request) for request in requests )
+
+            # Drop the requests the user has moved away from
+            for key in list(self._pending.keys()):
+                if key not in self._wanted and self._pending[key].cancel():
+                    del self._pending[key]
+                    self._cancelled += 1
+
+            for request in requests:
+                key = request_key(*request)
+                if key in self._done or key in self._pending:
+                    continue
+                self._pending[key] = self._executor.submit(self._run, key, request)
+
+    def prefetchAround(self, data_source, loc, run, indexes, **kwargs):
+        """
+        Predicts the requests likely to follow this one (see predict_requests()) and
+        schedules them. The prediction happens in the background too, since it may
+        need to look up which stations are available.
+        """
+        def predict():
+            try:
+                self.prefetch(predict_requests(data_source, loc, run, indexes, **kwargs))
+            except Exception as e:
+                logging.exception(e)
+                logging.debug("Couldn't predict the next requests.")
+
+        self.prefetch([])
+        self._executor.submit(predict)
+
+    def get(self, data_source, loc, run, indexes, wait=True):
+        """
+        Returns the prefetched ProfCollection for a request, or None if it wasn't
+        prefetched. The collection is handed over, so it's removed from the scheduler.
+        wait:   If the request is being loaded right now, wait for it. Default is True.
+        """
+        key = request_key(data_source, loc, run, indexes)
+        with self._lock:
+            self._last_activity = time.time()
+            fut = self._pending.get(key) if key in self._loading else None
+            prof_col = self._done.pop(key, None)
+            self._sizes.pop(key, None)
+
+        if prof_col is None and fut is not None and wait:
+            prof_col = fut.result()
+            with self._lock:
+                self._done.pop(key, None)
+                self._sizes.pop(key, None)
+
+        with self._lock:
+            if prof_col is None:
+                # The caller is loading it, so don't load it again
+                self._wanted.discard(key)
+                self._misses += 1
+            else:
+                self._hits += 1
+        return prof_col
+
+    def cancel(self):
+        """
+        Cancels everything that hasn't started and forgets what has been prefetched.
+        """
+        with self._lock:
+            self._wanted = set()
+            for fut in self._pending.values():
+                if fut.cancel():
+                    self._cancelled += 1
+            self._pending = {}
+            self._done = OrderedDict()
+            self._sizes = {}
+
+    def getStats(self):
+        """
+        Returns a dictionary with the hits, misses, hit rate and the number of
+        collections loaded, evicted and cancelled.
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {'hits': self._hits, 'misses': self._misses,
+                    'hit_rate': float(self._hits) / total if total > 0 else 0.,
+                    'loaded': self._loaded, 'evicted': self._evicted, 'cancelled': self._cancelled,
+                    'bytes': sum(self._sizes.values())}
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
@@ -11,67 +11,158 @@ try:
 except ImportError:
     from io import BytesIO
 from datetime import datetime, timedelta
+import multiprocessing
+import logging
+import glob
+import os
 
 __fmtname__ = "spc"
 __classname__ = "SPCDecoder"
 
-class SPCDecoder(Decoder):
-    def __init__(self, file_name):
-        super(SPCDecoder, self).__init__(file_name)
-
-    def _parse(self):
-        file_data = self._downloadFile()
-        ## read in the file
-        data = np.array([l.strip() for l in file_data.split('\n')])
-
-        ## necessary index points
-        title_idx = np.where( data == '%TITLE%')[0][0]
-        start_idx = np.where( data == '%RAW%' )[0][0] + 1
-        finish_idx = np.where( data == '%END%')[0][0]
-
-        ## create the plot title
-        data_header = data[title_idx + 1].split()
-        location = data_header[0]
-        time = datetime.strptime(data_header[1][:11], '%y%m%d/%H%M')
-        if len(data_header) > 2:
-            lat, lon = data_header[2].split(',')
-            lat = float(lat)
-            lon = float(lon)
-        else:
-            lat = 35.
-            lon = -97.
-
-        if time > datetime.utcnow() + timedelta(hours=1): 
-            # If the strptime accidently makes the sounding in the future (like with SARS archive)
-            # i.e. a 1957 sounding becomes 2057 sounding...ensure that it's a part of the 20th century
-            time = datetime.strptime('19' + data_header[1][:11], '%Y%m%d/%H%M')
-
-        ## put it all together for StringIO
-        full_data = '\n'.join(data[start_idx : finish_idx][:])
-
+def _findMarker(file_data, marker):
+    # Returns the index of the first line that is only the marker (with whitespace)
+    idx = file_data.find(marker)
+    while idx >= 0:
+        line_start = file_data.rfind('\n', 0, idx) + 1
+        line_end = file_data.find('\n', idx)
+        if line_end < 0:
+            line_end = len(file_data)
+        if file_data[line_start:line_end].strip() == marker:
+            return line_start, line_end
+        idx = file_data.find(marker, line_end)
+    raise ValueError("Couldn't find '%s' in the file" % marker)
+
+def _parseSPCBlock(block):
+    # Converts the comma-separated data block to a (levels, 6) array
+    fields = [ line.split(',') for line in block.splitlines() if line.strip() != '' ]
+    values = None
+    if '%' not in block and all( len(line) == 6 for line in fields ):
+        try:
+            values = np.array(fields, dtype=float)
+        except ValueError:
+            pass
+
+    if values is None:
+        # Missing values or comments, so let genfromtxt sort it out
         if not is_py3():
-            sound_data = StringIO( full_data )
+            sound_data = StringIO( block )
         else:
-            sound_data = BytesIO( full_data.encode() )
-
-        ## read the data into arrays
-        p, h, T, Td, wdir, wspd = np.genfromtxt( sound_data, delimiter=',', comments="%", unpack=True )
-#       idx = np.argsort(p, kind='mergesort')[::-1] # sort by pressure in case the pressure array is off.
+            sound_data = BytesIO( block.encode() )
+        return np.genfromtxt( sound_data, delimiter=',', comments="%" )
+
+    return values.reshape((-1, 6))
+
+def parseSPCText(file_data):
+    """
+    Splits the text of an SPC-format sounding into its header information
+    and data columns.
+
+    file_data:  The text of the file
+    Returns the location, time, latitude, longitude, and a tuple of the
+        pressure, height, temperature, dewpoint, wind direction, and wind speed arrays.
+    """
+    ## necessary index points
+    title_start, title_end = _findMarker(file_data, '%TITLE%')
+    raw_start, raw_end = _findMarker(file_data, '%RAW%')
+    end_start, end_end = _findMarker(file_data, '%END%')
+
+    ## create the plot title
+    header_end = file_data.find('\n', title_end + 1)
+    data_header = file_data[title_end + 1:header_end if header_end >= 0 else len(file_data)].split()
+    location = data_header[0]
+    time = datetime.strptime(data_header[1][:11], '%y%m%d/%H%M')
+    if len(data_header) > 2:
+        lat, lon = data_header[2].split(',')
+        lat = float(lat)
+        lon = float(lon)
+    else:
+        lat = 35.
+        lon = -97.
+
+    if time > datetime.utcnow() + timedelta(hours=1): 
+        # If the strptime accidently makes the sounding in the future (like with SARS archive)
+        # i.e. a 1957 sounding becomes 2057 sounding...ensure that it's a part of the 20th century
+        time = datetime.strptime('19' + data_header[1][:11], '%Y%m%d/%H%M')
+
+    ## read the data into arrays
+    p, h, T, Td, wdir, wspd = _parseSPCBlock(file_data[raw_end + 1:end_start]).T
+
+    pres = p
+    hght = h
+    tmpc = T
+    dwpc = Td
+
+    # Br00tal hack
+    if hght[0] > 30000:
+        hght[0] = -9999.00
+
+    return location, time, lat, lon, (pres, hght, tmpc, dwpc, wdir, wspd)
+
+def _tryParseSPCFile(file_name):
+    try:
+        with open(file_name, 'rb') as f:
+            return parseSPCText(f.read().decode('utf-8'))
+    except Exception as e:
+        # Lots of the files that get tried aren't SPC files, so this isn't worth a traceback
+        logging.debug("Unable to decode '%s' as an SPC file: %s" % (file_name, e))
+        return None
+
+def parseSPCFiles(file_names, max_procs=None):
+    """
+    Splits many SPC-format files into their header information and data columns,
+    using a pool of worker processes.
+
+    file_names: A list of the files to decode
+    max_procs:  The max number of processes to use. None uses all the CPUs.
+    Returns a list of the parseSPCText() results in the same order as file_names.
+        Files that can't be decoded give None.
+    """
+    num_procs = max_procs if max_procs is not None else multiprocessing.cpu_count()
+    num_procs = min(num_procs, len(file_names))
+
+    if num_procs > 1:
+        try:
+            pool = multiprocessing.Pool(num_procs)
+        except (OSError, ValueError) as e:
+            logging.exception(e)
+            logging.debug("Couldn't start the process pool, decoding serially.")
+        else:
+            try:
+                chunk_size = max(1, len(file_names) // (4 * num_procs))
+                return pool.map(_tryParseSPCFile, file_names, chunk_size)
+            finally:
+                pool.close()
+                pool.join()
+
+    return [ _tryParseSPCFile(fname) for fname in file_names ]
+
+def parseSPCDirectory(path, pattern='*', max_procs=None):
+    """
+    Decodes all the SPC-format files in a directory (e.g. the SARS archive).
+
+    path:   The directory to decode
+    pattern:    A glob pattern for the files in the directory to decode. Default is all of them.
+    max_procs:  The max number of processes to use. None uses all the CPUs.
+    Returns a dictionary of file name to parseSPCText() results. Files that can't
+        be decoded are left out.
+    """
+    file_names = sorted(glob.glob(os.path.join(path, pattern)))
+    file_names = [ fname for fname in file_names if os.path.isfile(fname) ]
+    results = parseSPCFiles(file_names, max_procs=max_procs)
+    return dict( (fname, result) for fname, result in zip(file_names, results) if result is not None )
 
-        pres = p #[idx]
-        hght = h #[idx]
-        tmpc = T #[idx]
-        dwpc = Td #[idx]
-        wspd = wspd #[idx]
-        wdir = wdir #[idx]
+class SPCDecoder(Decoder):
+    def __init__(self, file_name, file_data=None):
+        super(SPCDecoder, self).__init__(file_name, file_data=file_data)
 
-        # Br00tal hack
-        if hght[0] > 30000:
-            hght[0] = -9999.00
+    def _parse(self):
+        file_data = self._downloadFile()
+        location, time, lat, lon, (pres, hght, tmpc, dwpc, wdir, wspd) = parseSPCText(file_data)
 
         # Force latitude to be 35 N. Figure out a way to fix this later.
         prof = profile.create_profile(profile='raw', pres=pres, hght=hght, tmpc=tmpc, dwpc=dwpc,
-            wdir=wdir, wspd=wspd, location=location, date=time, latitude=lat, missing=-9999.00)
+            wdir=wdir, wspd=wspd, location=location, date=time, latitude=lat, longitude=lon,
+            missing=-9999.00)
 
         prof_coll = prof_collection.ProfCollection(
             {'':[ prof ]}, 
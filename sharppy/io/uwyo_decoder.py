@@ -11,8 +11,8 @@ __classname__ = "UWYODecoder"
 class UWYODecoder(Decoder):
     MISSING = -9999.00
 
-    def __init__(self, file_name):
-        super(UWYODecoder, self).__init__(file_name)
+    def __init__(self, file_name, file_data=None):
+        super(UWYODecoder, self).__init__(file_name, file_data=file_data)
 
     def _parse(self):
         file_data = self._downloadFile()
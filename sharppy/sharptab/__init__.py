@@ -1 +1 @@
-__all__ = ['constants', 'utils', 'profile', 'params', 'thermo', 'interp', 'winds', 'watch_type']
+__all__ = ['constants', 'utils', 'profile', 'params', 'thermo', 'interp', 'winds', 'watch_type', 'gridded']
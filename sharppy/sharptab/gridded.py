@@ -0,0 +1,592 @@
+''' Vectorized Parameters for Many Columns '''
+from __future__ import division
+import numpy as np
+from sharppy.sharptab.constants import *
+import sharppy.sharptab.thermo as thermo
+import sharppy.sharptab.utils as utils
+
+## These routines compute a few of the SHARPpy parameters for many columns at
+## once (e.g. every column of a model grid). All the arrays have the shape
+## (columns, levels), with the levels ordered from the surface up. They follow
+## the same methods as the Profile-based routines in params and winds, but work
+## on the model levels instead of an interpolated sounding, so they will differ
+## slightly from the values in the full ConvectiveProfile.
+
+__all__ = ['satlift', 'interp_hght', 'interp_pres', 'lift_parcels']
+__all__ += ['sb_parcel', 'ml_parcel', 'mu_parcel', 'effective_inflow_layer']
+__all__ += ['bunkers_motion', 'bunkers_storm_motion', 'helicity', 'bulk_shear', 'pbl_height', 'stp_fixed', 'scp', 'compute_params']
+__all__ += ['PARAMS']
+
+# The parameters compute_params() knows about, with their units
+PARAMS = {
+    'sbcape': 'J/kg', 'sbcin': 'J/kg', 'sblcl': 'm',
+    'mlcape': 'J/kg', 'mlcin': 'J/kg', 'mllcl': 'm',
+    'mucape': 'J/kg', 'mucin': 'J/kg', 'mulcl': 'm',
+    'srh1': 'm2/s2', 'srh3': 'm2/s2',
+    'shr1': 'kts', 'shr6': 'kts',
+    'pblh': 'm',
+    'stp': '', 'scp': '',
+}
+
+def satlift(p, thetam, conv=0.1, max_iter=50):
+    '''
+    Returns the temperature (C) of saturated parcels when lifted to new
+    pressure levels. This is thermo.satlift, but each element is iterated
+    until it converges on its own.
+
+    Parameters
+    ----------
+    p : numpy array
+        Pressure to which the parcels are raised (hPa)
+    thetam : numpy array
+        Saturated Potential Temperature of the parcels (C)
+    conv : number
+        Convergence criteria (C)
+    max_iter : number
+        Maximum number of iterations
+
+    Returns
+    -------
+    Temperature (C) of the saturated parcels at the new levels
+    '''
+    p, thetam = np.broadcast_arrays(np.asarray(p, dtype=float), np.asarray(thetam, dtype=float))
+    lft = thetam.copy()
+    todo = np.fabs(p - 1000.) - 0.001 > 0
+
+    pwrp = np.power((p[todo] / 1000.), ROCP)
+    thm = thetam[todo]
+    t1 = (thm + ZEROCNK) * pwrp - ZEROCNK
+    e1 = thermo.wobf(t1) - thermo.wobf(thm)
+    rate = np.ones(t1.shape)
+    idxs = np.where(todo.ravel())[0]
+
+    for i in range(max_iter):
+        t2 = t1 - (e1 * rate)
+        e2 = (t2 + ZEROCNK) / pwrp - ZEROCNK
+        e2 += thermo.wobf(t2) - thermo.wobf(e2) - thm
+        eor = e2 * rate
+
+        # Save the ones that have converged and keep going on the rest
+        done = np.fabs(eor) - conv <= 0
+        if i == max_iter - 1:
+            done[:] = True
+        lft.flat[idxs[done]] = t2[done] - eor[done]
+        if np.all(done):
+            break
+
+        left = ~done
+        rate = (t2[left] - t1[left]) / (e2[left] - e1[left])
+        t1 = t2[left]
+        e1 = e2[left]
+        pwrp = pwrp[left]
+        thm = thm[left]
+        idxs = idxs[left]
+
+    return lft
+
+def _interp(x, xs, field):
+    # Linear interpolation along the last axis. xs must be increasing along the
+    # last axis, and x has one value per column. Values off the ends are extrapolated.
+    nlev = xs.shape[-1]
+    idx = np.clip(np.sum(xs <= x[..., np.newaxis], axis=-1), 1, nlev - 1)[..., np.newaxis]
+    x0 = np.take_along_axis(xs, idx - 1, axis=-1)[..., 0]
+    x1 = np.take_along_axis(xs, idx, axis=-1)[..., 0]
+    f0 = np.take_along_axis(field, idx - 1, axis=-1)[..., 0]
+    f1 = np.take_along_axis(field, idx, axis=-1)[..., 0]
+    return f0 + (x - x0) / (x1 - x0) * (f1 - f0)
+
+def interp_hght(h, hght, field):
+    '''
+    Interpolates a field to a height in each column.
+
+    Parameters
+    ----------
+    h : number, numpy array
+        Height (m) in each column
+    hght : numpy array
+        Heights of the levels (m)
+    field : numpy array
+        The field to interpolate
+
+    Returns
+    -------
+    The field at the height in each column
+    '''
+    h = np.broadcast_to(h, hght.shape[:-1])
+    return _interp(h, hght, field)
+
+def interp_pres(p, pres, field):
+    '''
+    Interpolates a field to a pressure in each column (linear in log pressure).
+
+    Parameters
+    ----------
+    p : number, numpy array
+        Pressure (hPa) in each column
+    pres : numpy array
+        Pressures of the levels (hPa)
+    field : numpy array
+        The field to interpolate
+
+    Returns
+    -------
+    The field at the pressure in each column
+    '''
+    p = np.broadcast_to(p, pres.shape[:-1])
+    return _interp(-np.log(p), -np.log(pres), field)
+
+def lift_parcels(pres, hght, tmpc, dwpc, p0, t0, td0):
+    '''
+    Lifts a parcel in each column and integrates its buoyancy. As in
+    params.parcelx, CAPE is the positive area above the LCL, and CIN is the
+    negative area below the LCL plus the negative area above the LCL and
+    below 500 hPa. CIN is 0 when there is no CAPE.
+
+    Parameters
+    ----------
+    pres, hght, tmpc, dwpc : numpy array
+        The pressure (hPa), height (m), temperature (C) and dewpoint (C) of the levels
+    p0, t0, td0 : numpy array
+        Pressure (hPa), temperature (C), and dewpoint (C) of the parcel in each column
+
+    Returns
+    -------
+    cape : numpy array
+        Convective available potential energy (J/kg)
+    cin : numpy array
+        Convective inhibition (J/kg)
+    lclhght : numpy array
+        Height of the LCL (m AGL)
+    elhght : numpy array
+        Height of the EL (m AGL), or NaN if the parcel has no EL
+    '''
+    plcl, tlcl = thermo.drylift(p0, t0, td0)
+    thta = thermo.theta(p0, t0, 1000.)
+    w0 = thermo.mixratio(p0, td0)
+
+    # Below the LCL, the parcel follows the dry adiabat and keeps its mixing ratio
+    tdry = thermo.theta(1000., thta[:, np.newaxis], pres)
+    tv_dry = thermo.virtemp(pres, tdry, thermo.temp_at_mixrat(w0[:, np.newaxis], pres))
+
+    # Above the LCL, it follows the moist adiabat through the LCL
+    thetam = thta - thermo.wobf(thta) + thermo.wobf(tlcl)
+    below_lcl = pres >= plcl[:, np.newaxis]
+    tmoist = np.where(below_lcl, tdry, 0.)
+    tmoist[~below_lcl] = satlift(pres[~below_lcl], np.broadcast_to(thetam[:, np.newaxis], pres.shape)[~below_lcl])
+    tv_moist = thermo.virtemp(pres, tmoist, tmoist)
+
+    tv_pcl = np.where(below_lcl, tv_dry, tv_moist)
+    tv_env = thermo.virtemp(pres, tmpc, dwpc)
+    tdef = (tv_pcl - tv_env) / thermo.ctok(tv_env)
+
+    lyre = G * (tdef[:, :-1] + tdef[:, 1:]) / 2. * (hght[:, 1:] - hght[:, :-1])
+    # Only the layers at and above the parcel's starting level count
+    in_pcl = pres[:, :-1] <= p0[:, np.newaxis]
+    above_lcl = pres[:, 1:] < plcl[:, np.newaxis]
+
+    cape = np.where(in_pcl & above_lcl & (lyre > 0), lyre, 0.).sum(axis=1)
+    cin = np.where(in_pcl & (lyre < 0) & (~above_lcl | (pres[:, 1:] > 500.)), lyre, 0.).sum(axis=1)
+    cin = np.where(cape == 0, 0., cin)
+
+    lclhght = interp_pres(plcl, pres, hght) - hght[:, 0]
+
+    # As in params.parcelx, the EL is in the last layer above the LCL whose energy is negative
+    # after a layer whose energy wasn't (there is none if a later layer is buoyant again). It's
+    # found by stepping up from the bottom of that layer 5 hPa at a time until the parcel isn't
+    # buoyant.
+    in_cloud = in_pcl & above_lcl
+    crosses = np.zeros(lyre.shape, dtype=bool)
+    crosses[:, 1:] = in_cloud[:, 1:] & (lyre[:, 1:] <= 0) & (lyre[:, :-1] >= 0)
+    nlyr = lyre.shape[1]
+    lyr = nlyr - 1 - np.argmax(crosses[:, ::-1], axis=1)
+    later = np.arange(nlyr) > lyr[:, np.newaxis]
+    has_el = crosses.any(axis=1) & ~(later & in_cloud & (lyre > 0)).any(axis=1)
+
+    rows = np.arange(lyre.shape[0])
+    pbot, ptop = pres[rows, lyr], pres[rows, lyr + 1]
+    nstep = int(np.ceil(np.max(np.where(has_el, pbot - ptop, 0.)) / 5.)) + 1
+    steps = np.maximum(pbot[:, np.newaxis] - 5. * np.arange(nstep), ptop[:, np.newaxis])
+    tstep = satlift(steps, np.broadcast_to(thetam[:, np.newaxis], steps.shape))
+    tv_step = np.array([ interp_pres(steps[:, i], pres, tv_env) for i in range(nstep) ]).T
+    buoyant = thermo.virtemp(steps, tstep, tstep) > tv_step
+    step = np.where(buoyant.all(axis=1), nstep - 1, np.argmin(buoyant, axis=1))
+    elpres = steps[rows, step]
+    elhght = np.where(has_el, interp_pres(elpres, pres, hght) - hght[:, 0], np.nan)
+    return cape, cin, lclhght, elhght
+
+def sb_parcel(pres, tmpc, dwpc):
+    '''
+    Returns the pressure (hPa), temperature (C), and dewpoint (C) of the
+    surface-based parcel in each column.
+    '''
+    return pres[:, 0], tmpc[:, 0], dwpc[:, 0]
+
+def ml_parcel(pres, tmpc, dwpc, depth=100.):
+    '''
+    Returns the pressure (hPa), temperature (C), and dewpoint (C) of the
+    mixed-layer parcel in each column, as in params.DefineParcel (flag=4). The
+    parcel has the mean potential temperature and mixing ratio of the lowest
+    depth hPa and starts at the surface. The means are the ones from
+    params.mean_theta and params.mean_mixratio with exact=True: the levels
+    inside the layer count twice as much as its ends, and the mixing ratio is
+    the one at the mean pressure and dewpoint.
+    '''
+    psfc = pres[:, 0]
+    ptop = psfc - depth
+    tmpc_top = interp_pres(ptop, pres, tmpc)
+    dwpc_top = interp_pres(ptop, pres, dwpc)
+    in_lyr = (pres < psfc[:, np.newaxis]) & (pres > ptop[:, np.newaxis])
+    num = 2. * in_lyr.sum(axis=1) + 2.
+
+    def mean(bot, top, field):
+        return (bot + top + 2. * np.where(in_lyr, field, 0.).sum(axis=1)) / num
+
+    mean_thta = mean(thermo.theta(psfc, tmpc[:, 0]), thermo.theta(ptop, tmpc_top), thermo.theta(pres, tmpc))
+    mean_mxr = thermo.mixratio(mean(psfc, ptop, pres), mean(dwpc[:, 0], dwpc_top, dwpc))
+    return psfc, thermo.theta(1000., mean_thta, psfc), thermo.temp_at_mixrat(mean_mxr, psfc)
+
+def mu_parcel(pres, tmpc, dwpc, depth=300.):
+    '''
+    Returns the pressure (hPa), temperature (C), and dewpoint (C) of the
+    most-unstable parcel (highest theta-e) in the lowest depth hPa of each column.
+    '''
+    # Only the levels that are in the layer in some column need to be checked
+    in_lyr = pres >= (pres[:, 0] - depth)[:, np.newaxis]
+    nlev = max(1, in_lyr.sum(axis=1).max())
+    pres, tmpc, dwpc, in_lyr = pres[:, :nlev], tmpc[:, :nlev], dwpc[:, :nlev], in_lyr[:, :nlev]
+
+    # Theta-e is the potential temperature of the parcel after lifting it to 100 hPa
+    plcl, tlcl = thermo.drylift(pres, tmpc, dwpc)
+    thta = thermo.theta(plcl, tlcl, 1000.)
+    thetam = thta - thermo.wobf(thta) + thermo.wobf(tlcl)
+    thetae = thermo.theta(100., satlift(np.full(pres.shape, 100.), thetam), 1000.)
+
+    thetae = np.where(in_lyr, thetae, -np.inf)
+    idx = np.argmax(thetae, axis=1)[:, np.newaxis]
+    take = lambda field: np.take_along_axis(field, idx, axis=1)[:, 0]
+    return take(pres), take(tmpc), take(dwpc)
+
+def effective_inflow_layer(pres, hght, tmpc, dwpc, mucape, mucin, ecape=100, ecinh=-250):
+    '''
+    Finds the effective inflow layer in each column, as in params.effective_inflow_layer.
+    The bottom is the lowest level whose parcel has at least ecape CAPE and more than
+    ecinh CIN, and the top is the level below the first one above it that doesn't.
+
+    Parameters
+    ----------
+    pres, hght, tmpc, dwpc : numpy array
+        The pressure (hPa), height (m), temperature (C) and dewpoint (C) of the levels
+    mucape, mucin : numpy array
+        CAPE and CIN (J/kg) of the most-unstable parcel in each column
+    ecape : number (optional; default=100)
+        Minimum amount of CAPE in the layer to be considered part of the
+        effective inflow layer.
+    ecinh : number (optional; default=-250)
+        Maximum amount of CINH in the layer to be considered part of the
+        effective inflow layer
+
+    Returns
+    -------
+    pbot : numpy array
+        Pressure of the bottom level (hPa), NaN where there is no layer
+    ptop : numpy array
+        Pressure of the top level (hPa), NaN where there is no layer
+    '''
+    ncol, nlev = pres.shape
+    ibot = np.full(ncol, -1)
+    itop = np.full(ncol, -1)
+    find_bot = (mucape >= ecape) & (mucin > ecinh)
+    find_top = np.zeros(ncol, dtype=bool)
+
+    # Lift a parcel from each level, but only in the columns that are still searching
+    for lev in range(nlev - 1):
+        todo = np.where(find_bot | find_top)[0]
+        if len(todo) == 0:
+            break
+        cape, cin = lift_parcels(pres[todo], hght[todo], tmpc[todo], dwpc[todo],
+            pres[todo, lev], tmpc[todo, lev], dwpc[todo, lev])[:2]
+        ok = (cape >= ecape) & (cin > ecinh)
+
+        top = todo[find_top[todo] & ~ok]
+        itop[top] = lev - 1
+        find_top[top] = False
+
+        bot = todo[find_bot[todo] & ok]
+        ibot[bot] = lev
+        find_bot[bot] = False
+        find_top[bot] = True
+
+    found = (ibot >= 0) & (itop >= 0)
+    rows = np.arange(ncol)
+    pbot = np.where(found, pres[rows, ibot], np.nan)
+    ptop = np.where(found, pres[rows, itop], np.nan)
+    return pbot, ptop
+
+def _pres_at(h, hagl, pres):
+    # Pressure (hPa) at a height (m AGL) in each column, like interp.pres
+    return np.exp(interp_hght(h, hagl, np.log(pres)))
+
+def _layer(pres, field, pbot, ptop):
+    # The field from pbot to ptop (hPa) in each column, like the exact layer routines use it:
+    # the levels in the layer with the ends interpolated. The levels below and above the layer
+    # take the value at that end, so they add nothing to sums over the layers.
+    pbot, ptop = pbot[:, np.newaxis], ptop[:, np.newaxis]
+    fbot = interp_pres(pbot[:, 0], pres, field)[:, np.newaxis]
+    ftop = interp_pres(ptop[:, 0], pres, field)[:, np.newaxis]
+    return np.where(pres > pbot, fbot, np.where(pres < ptop, ftop, field))
+
+def _mean_wind(pres, u, v, pbot, ptop, weighted=True):
+    # Mean wind (kts) from pbot to ptop (hPa), pressure-weighted like winds.mean_wind or
+    # not like winds.mean_wind_npw
+    lyr_p = np.clip(pres, ptop[:, np.newaxis], pbot[:, np.newaxis])
+    dp = lyr_p[:, :-1] - lyr_p[:, 1:]
+    wts = lyr_p if weighted else np.ones(pres.shape)
+
+    def mean(field):
+        lyr = _layer(pres, field, pbot, ptop) * wts
+        return ((lyr[:, :-1] + lyr[:, 1:]) / 2. * dp).sum(axis=1) / ((wts[:, :-1] + wts[:, 1:]) / 2. * dp).sum(axis=1)
+    return mean(u), mean(v)
+
+def _wind_shear(pres, u, v, pbot, ptop):
+    # Shear vector (kts) from pbot to ptop (hPa), like winds.wind_shear
+    shru = interp_pres(ptop, pres, u) - interp_pres(pbot, pres, u)
+    shrv = interp_pres(ptop, pres, v) - interp_pres(pbot, pres, v)
+    return shru, shrv
+
+def _deviate(mnu, mnv, shru, shrv):
+    # Right-mover storm motion from the mean wind and shear vector
+    d = utils.MS2KTS(7.5)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tmp = np.where(np.hypot(shru, shrv) > 0, d / np.hypot(shru, shrv), 0.)
+    return mnu + (tmp * shrv), mnv - (tmp * shru)
+
+def bunkers_motion(hagl, pres, u, v):
+    '''
+    Computes the Bunkers storm motion for a right-moving supercell in each
+    column, using the non-parcel method in winds.non_parcel_bunkers_motion.
+
+    Parameters
+    ----------
+    hagl : numpy array
+        Heights of the levels (m AGL)
+    pres : numpy array
+        Pressures of the levels (hPa)
+    u, v : numpy array
+        Wind components of the levels (kts)
+
+    Returns
+    -------
+    rstu : numpy array
+        Right Storm Motion U-component (kts)
+    rstv : numpy array
+        Right Storm Motion V-component (kts)
+    '''
+    psfc = pres[:, 0]
+    p6km = _pres_at(6000., hagl, pres)
+    # SFC-6km mean wind (not pressure-weighted) and shear vector
+    mnu6, mnv6 = _mean_wind(pres, u, v, psfc, p6km, weighted=False)
+    shru, shrv = _wind_shear(pres, u, v, psfc, p6km)
+    return _deviate(mnu6, mnv6, shru, shrv)
+
+def bunkers_storm_motion(hagl, pres, u, v, mucape, muel, ebot):
+    '''
+    Computes the Bunkers storm motion for a right-moving supercell in each
+    column, using the parcel-based method in params.bunkers_storm_motion. The
+    mean wind and shear are taken from the bottom of the effective inflow layer
+    to 65% of the way to the most-unstable EL. The columns with 100 J/kg of
+    most-unstable CAPE or less, or no EL or effective inflow layer, use the
+    non-parcel method in bunkers_motion.
+
+    Parameters
+    ----------
+    hagl, pres, u, v : numpy array
+        Heights (m AGL), pressures (hPa), and wind components (kts) of the levels
+    mucape : numpy array
+        Most-unstable CAPE (J/kg)
+    muel : numpy array
+        Most-unstable EL height (m AGL)
+    ebot : numpy array
+        Pressure of the bottom of the effective inflow layer (hPa)
+
+    Returns
+    -------
+    rstu : numpy array
+        Right Storm Motion U-component (kts)
+    rstv : numpy array
+        Right Storm Motion V-component (kts)
+    '''
+    rstu, rstv = bunkers_motion(hagl, pres, u, v)
+    use = (mucape > 100.) & np.isfinite(muel) & np.isfinite(ebot)
+    if use.any():
+        hagl, pres, u, v = hagl[use], pres[use], u[use], v[use]
+        pbot = ebot[use]
+        base = interp_pres(pbot, pres, hagl)
+        ptop = _pres_at(base + (muel[use] - base) * 0.65, hagl, pres)
+        mnu, mnv = _mean_wind(pres, u, v, pbot, ptop)
+        shru, shrv = _wind_shear(pres, u, v, pbot, ptop)
+        rstu[use], rstv[use] = _deviate(mnu, mnv, shru, shrv)
+    return rstu, rstv
+
+def helicity(hagl, pres, u, v, top, stu=0, stv=0, bottom=0.):
+    '''
+    Computes the storm-relative helicity from bottom to top (m AGL) in each column,
+    using the levels in the layer as in winds.helicity with exact=True.
+
+    Parameters
+    ----------
+    hagl, pres, u, v : numpy array
+        Heights (m AGL), pressures (hPa), and wind components (kts) of the levels
+    top : number, numpy array
+        Top of the layer (m AGL)
+    stu, stv : number, numpy array
+        Storm motion (kts)
+    bottom : number, numpy array
+        Bottom of the layer (m AGL). Default is the surface.
+
+    Returns
+    -------
+    Storm-relative helicity (m2/s2)
+    '''
+    pbot = _pres_at(bottom, hagl, pres)
+    ptop = _pres_at(top, hagl, pres)
+    sru = utils.KTS2MS(_layer(pres, u, pbot, ptop) - np.asarray(stu)[..., np.newaxis])
+    srv = utils.KTS2MS(_layer(pres, v, pbot, ptop) - np.asarray(stv)[..., np.newaxis])
+    return ((sru[:, 1:] * srv[:, :-1]) - (sru[:, :-1] * srv[:, 1:])).sum(axis=1)
+
+def bulk_shear(hagl, u, v, top):
+    '''
+    Computes the magnitude of the bulk wind difference (kts) from the surface to
+    top (m AGL) in each column.
+    '''
+    du = interp_hght(top, hagl, u) - u[:, 0]
+    dv = interp_hght(top, hagl, v) - v[:, 0]
+    return np.hypot(du, dv)
+
+def pbl_height(pres, hght, tmpc, dwpc):
+    '''
+    Computes the depth of the boundary layer (m AGL) in each column. See params.pbl_top.
+    The top is the first level where the virtual potential temperature is more than
+    0.5 K warmer than at the surface (or the top level, if there isn't one).
+    '''
+    thetav = thermo.theta(pres, thermo.virtemp(pres, tmpc, dwpc))
+    above = thetav[:, :1] + .5 < thetav
+    level = np.where(above.any(axis=1), np.argmax(above, axis=1), pres.shape[1] - 1)
+    return hght[np.arange(hght.shape[0]), level] - hght[:, 0]
+
+def stp_fixed(sbcape, sblcl, srh01, bwd6):
+    '''
+    Significant Tornado Parameter (fixed layer) for arrays. See params.stp_fixed.
+
+    Parameters
+    ----------
+    sbcape : numpy array
+        Surface based CAPE (J/kg)
+    sblcl : numpy array
+        Surface based LCL (m)
+    srh01 : numpy array
+        Surface to 1 km storm relative helicity (m2/s2)
+    bwd6 : numpy array
+        Bulk wind difference between 0 to 6 km (m/s)
+
+    Returns
+    -------
+    Signifcant tornado parameter (fixed-layer)
+    '''
+    lcl_term = np.clip((2000. - sblcl) / 1000., 0., 1.)
+    bwd6 = np.where(bwd6 < 12.5, 0., np.minimum(bwd6, 30.))
+    return (sbcape / 1500.) * lcl_term * (srh01 / 150.) * (bwd6 / 20.)
+
+def scp(mucape, srh, ebwd):
+    '''
+    Supercell Composite Parameter for arrays. See params.scp.
+
+    Parameters
+    ----------
+    mucape : numpy array
+        Most Unstable CAPE (J/kg)
+    srh : numpy array
+        Storm relative helicity (m2/s2)
+    ebwd : numpy array
+        Bulk wind difference (m/s)
+
+    Returns
+    -------
+    Supercell composite parameter
+    '''
+    ebwd = np.where(ebwd < 10., 0., np.minimum(ebwd, 20.))
+    return (mucape / 1000.) * (srh / 50.) * (ebwd / 20.)
+
+def compute_params(pres, hght, tmpc, dwpc, u, v, params=None):
+    '''
+    Computes a set of parameters for each column. As in the ConvectiveProfile,
+    the storm motion is the parcel-based Bunkers motion where there is an
+    effective inflow layer, SCP uses the effective SRH and bulk wind difference
+    (and is 0 without an effective inflow layer), and STP uses the fixed-layer
+    formulation.
+
+    Parameters
+    ----------
+    pres, hght, tmpc, dwpc : numpy array
+        The pressure (hPa), height (m), temperature (C) and dewpoint (C) of the levels
+    u, v : numpy array
+        Wind components of the levels (kts)
+    params : list (optional)
+        The names of the parameters to compute (the keys of PARAMS). Default is all of them.
+
+    Returns
+    -------
+    A dictionary of parameter name to an array with a value for each column
+    '''
+    if params is None:
+        params = list(PARAMS.keys())
+    for param in params:
+        if param not in PARAMS:
+            raise ValueError("Unknown gridded parameter '%s'" % param)
+
+    hagl = hght - hght[:, :1]
+    results = {}
+    # The parameters that others depend on are computed as they're needed
+    def get(name):
+        if name in results:
+            return results[name]
+
+        pcl_type = name[:2]
+        if pcl_type in [ 'sb', 'ml', 'mu' ] and name[2:] in [ 'cape', 'cin', 'lcl' ]:
+            pcl_func = { 'sb':sb_parcel, 'ml':ml_parcel, 'mu':mu_parcel }[pcl_type]
+            p0, t0, td0 = pcl_func(pres, tmpc, dwpc)
+            cape, cin, lcl, el = lift_parcels(pres, hght, tmpc, dwpc, p0, t0, td0)
+            results[pcl_type + 'cape'] = cape
+            results[pcl_type + 'cin'] = cin
+            results[pcl_type + 'lcl'] = lcl
+            results[pcl_type + 'el'] = el
+        elif name in [ 'ebot', 'etop' ]:
+            results['ebot'], results['etop'] = effective_inflow_layer(pres, hght, tmpc, dwpc, get('mucape'), get('mucin'))
+        elif name in [ 'rstu', 'rstv' ]:
+            results['rstu'], results['rstv'] = bunkers_storm_motion(hagl, pres, u, v, get('mucape'), get('muel'), get('ebot'))
+        elif name in [ 'srh1', 'srh3' ]:
+            top = 1000. if name == 'srh1' else 3000.
+            results[name] = helicity(hagl, pres, u, v, top, get('rstu'), get('rstv'))
+        elif name == 'esrh':
+            has_eff = np.isfinite(get('ebot'))
+            ebotm = np.where(has_eff, interp_pres(get('ebot'), pres, hagl), 0.)
+            etopm = np.where(has_eff, interp_pres(get('etop'), pres, hagl), 0.)
+            results[name] = helicity(hagl, pres, u, v, etopm, get('rstu'), get('rstv'), bottom=ebotm)
+        elif name == 'ebwd':
+            # From the bottom of the effective inflow layer to half way to the most-unstable EL
+            has_eff = np.isfinite(get('ebot')) & np.isfinite(get('muel'))
+            ebot = np.where(has_eff, get('ebot'), pres[:, 0])
+            ebotm = interp_pres(ebot, pres, hagl)
+            elh = _pres_at(np.where(has_eff, ebotm + (get('muel') - ebotm) / 2., 0.), hagl, pres)
+            results[name] = np.where(has_eff, np.hypot(*_wind_shear(pres, u, v, ebot, elh)), 0.)
+        elif name in [ 'shr1', 'shr6' ]:
+            top = 1000. if name == 'shr1' else 6000.
+            results[name] = bulk_shear(hagl, u, v, top)
+        elif name == 'pblh':
+            results[name] = pbl_height(pres, hght, tmpc, dwpc)
+        elif name == 'stp':
+            results[name] = stp_fixed(get('sbcape'), get('sblcl'), get('srh1'), utils.KTS2MS(get('shr6')))
+        elif name == 'scp':
+            results[name] = np.where(np.isfinite(get('ebot')), scp(get('mucape'), get('esrh'), utils.KTS2MS(get('ebwd'))), 0.)
+        return results[name]
+
+    return dict( (param, get(param)) for param in params )
@@ -1,15 +1,289 @@
-
 from __future__ import absolute_import
 
 import sharppy.sharptab.profile as profile
 import sharppy.sharptab.interp as interp
-from sutils.frozenutils import Process, Queue
-import platform
+import sharppy.sharptab.gridded as gridded
+import sharppy.sharptab.utils as utils
+from concurrent.futures import Future, InvalidStateError, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import multiprocessing
+from collections import OrderedDict
+import threading
+import warnings
+import atexit
 import numpy as np
+import numpy.ma as ma
+import logging
+
+## The profiles are upgraded to ConvectiveProfiles in the background by a pool
+## of worker processes that's started once and kept around.  The profile arrays
+## go to the workers through one block of shared memory per batch, and the
+## workers send back what the profile computed (the indices, parcels, etc.,
+## which is most of the profile), but not the arrays they were given.  The collection only hands the pool as many
+## profiles as it has workers, picking the most important one (the one the
+## user is looking at) each time a worker frees up, so the order follows the
+## user around and the work that's still queued can be dropped.
+##
+## The computed profiles (parcel traces, trajectories, SARS matches, ...) are
+## much bigger than the columns they're computed from, so each collection keeps
+## them within a memory budget.  When it's over, the least recently used ones
+## are swapped for plain Profiles holding only the columns, and they're
+## computed again if they're looked at.
+
+# Max number of worker processes for the background copies
+DEFAULT_PROCS = max(1, min(4, multiprocessing.cpu_count() - 1))
+
+# The profile arrays that are passed through shared memory
+SHARED_VARS = [ 'pres', 'hght', 'tmpc', 'dwpc', 'u', 'v', 'wdir', 'wspd', 'omeg' ]
+
+# The other things needed to rebuild a profile
+META_VARS = [ 'location', 'date', 'latitude', 'longitude', 'missing', 'ctf_low', 'ctf_high', 'ctp_low', 'ctp_high' ]
+
+# Everything a plain Profile has (the columns and the metadata)
+RAW_VARS = SHARED_VARS + META_VARS + [ 'profile', 'strictQC', 'dew_stdev', 'tmp_stdev' ]
+
+# Bytes of computed profiles each collection keeps before it drops the least recently used
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+class WorkerPool(object):
+    """
+    WorkerPool: A pool of worker processes whose running work can be killed.
+    """
+    def __init__(self, max_procs=DEFAULT_PROCS):
+        """
+        max_procs:  The number of worker processes.
+        """
+        self._max_procs = max_procs
+        self._pool = None
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Runs func(*args) in a worker and returns a concurrent.futures.Future for the result.
+        """
+        fut = Future()
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self._max_procs)
+            self._running.add(fut)
+            self._pool.apply_async(func, args, callback=lambda result: self._finish(fut, result=result),
+                error_callback=lambda exc: self._finish(fut, exc=exc))
+        return fut
+
+    def _finish(self, fut, result=None, exc=None):
+        with self._lock:
+            self._running.discard(fut)
+        try:
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+        except InvalidStateError:
+            # Cancelled by terminate()
+            pass
+
+    def terminate(self):
+        """
+        Kills the workers, cancelling everything that's running. The next submit()
+        starts new workers.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            running, self._running = self._running, set()
+
+        if pool is not None:
+            pool.terminate()
+        for fut in running:
+            fut.cancel()
+
+def get_pool(max_procs=DEFAULT_PROCS):
+    """
+    Returns the shared worker pool with max_procs processes.
+    """
+    with _pool_lock:
+        if max_procs not in _pools:
+            _pools[max_procs] = WorkerPool(max_procs)
+        return _pools[max_procs]
+
+def shutdown_pools():
+    """
+    Shuts down the worker pools.
+    """
+    with _pool_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.terminate()
+
+atexit.register(shutdown_pools)
+
+def _sizeof(val, depth=0):
+    # Rough number of bytes in the arrays (and strings) held by a value
+    if isinstance(val, np.ndarray):
+        size = val.nbytes
+        if isinstance(val, ma.MaskedArray) and val.mask is not ma.nomask:
+            size += val.mask.nbytes
+        return size
+    elif isinstance(val, (str, bytes)):
+        return len(val)
+    elif depth >= 3:
+        return 0
+    elif isinstance(val, (list, tuple)):
+        return sum( _sizeof(v, depth + 1) for v in val )
+    elif isinstance(val, dict):
+        return sum( _sizeof(v, depth + 1) for v in val.values() )
+    elif hasattr(val, '__dict__'):
+        return _sizeof(val.__dict__, depth + 1)
+    return 0
+
+def raw_size(prof):
+    """
+    Returns the number of bytes in a profile's columns.
+    """
+    return sum( _sizeof(prof.__dict__.get(var)) for var in RAW_VARS )
+
+def computed_size(prof):
+    """
+    Returns the number of bytes in what has been computed from a profile's columns.
+    """
+    return sum( _sizeof(val, 1) for key, val in prof.__dict__.items() if key not in RAW_VARS )
+
+def _has_user_srwind(prof):
+    # The storm motion vectors were changed from the Bunkers ones
+    return getattr(prof, 'user_srwind', None) is not None and prof.user_srwind is not getattr(prof, 'bunkers', None)
+
+def _raw_profile(prof):
+    # A plain Profile with the same columns (not copied). A profile with its own storm
+    # motion is kept whole, since that can't be recomputed.
+    if type(prof) == profile.Profile or _has_user_srwind(prof):
+        return prof
+    raw = profile.Profile.__new__(profile.Profile)
+    raw.__dict__.update( (var, prof.__dict__.get(var)) for var in RAW_VARS )
+    return raw
+
+def _columns(profs):
+    # Stacks the valid levels of the profiles into (columns, levels) arrays for the routines
+    # in sharptab.gridded. The shorter columns are padded by repeating their top level, and
+    # a column with fewer than two valid levels is all NaN.
+    cols = []
+    for prof in profs:
+        if prof.u is not None and prof.v is not None:
+            u, v = prof.u, prof.v
+        else:
+            u, v = utils.vec2comp(prof.wdir, prof.wspd)
+
+        vals = [ ma.asanyarray(val, dtype=float) for val in [ prof.pres, prof.hght, prof.tmpc, prof.dwpc, u, v ] ]
+        bad = np.zeros(len(vals[0]), dtype=bool)
+        for val in vals:
+            data = ma.getdata(val)
+            bad |= ma.getmaskarray(val) | ~np.isfinite(data) | (data == prof.missing)
+        cols.append([ ma.getdata(val)[~bad] for val in vals ])
+
+    nlev = max([ 2 ] + [ len(col[0]) for col in cols ])
+    arrays = np.full((6, len(cols), nlev), np.nan)
+    for icol, col in enumerate(cols):
+        nvalid = len(col[0])
+        if nvalid < 2:
+            continue
+        for ivar, val in enumerate(col):
+            arrays[ivar, icol, :nvalid] = val
+            arrays[ivar, icol, nvalid:] = val[-1]
+    return arrays
+
+def _shared_array(prof, var):
+    # The array as the profile constructor will see it, with the missing values masked
+    val = ma.asanyarray(prof.__dict__[var], dtype=float)
+    return ma.masked_where(ma.getdata(val) == prof.missing, val)
+
+def _share_profiles(profs):
+    # Packs the arrays of a list of profiles into one block of shared memory. Returns the
+    # block and, for each profile, where each of its arrays is in the block.
+    layouts = []
+    arrays = []
+    offset = 0
+    for prof in profs:
+        layout = {}
+        for var in SHARED_VARS:
+            if prof.__dict__.get(var) is None:
+                continue
+            val = _shared_array(prof, var)
+            layout[var] = (offset, len(val))
+            arrays.append(val)
+            offset += len(val)
+        layouts.append(layout)
+
+    # The data, then the masks
+    shm = shared_memory.SharedMemory(create=True, size=max(1, 16 * offset))
+    data = np.ndarray((2, offset), dtype=float, buffer=shm.buf)
+    pos = 0
+    for val in arrays:
+        data[0, pos:pos + len(val)] = ma.getdata(val)
+        data[1, pos:pos + len(val)] = ma.getmaskarray(val)
+        pos += len(val)
+    del data
+    return shm, offset, layouts
+
+def _convert_shared(target_type, shm_name, size, layout, meta):
+    # Runs in a worker: rebuilds a profile from shared memory, converts it to the target
+    # type, and returns what was computed.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray((2, size), dtype=float, buffer=shm.buf)
+        sent = {}
+        for var, (start, length) in layout.items():
+            sent[var] = ma.array(data[0, start:start + length].copy(), mask=data[1, start:start + length].astype(bool))
+        del data
+    finally:
+        shm.close()
+
+    # Same as Profile.copy(): use u and v if the profile has them
+    winds = ('u', 'v') if 'u' in sent and 'v' in sent else ('wdir', 'wspd')
+    kwargs = dict(meta)
+    kwargs.update(dict( (var, val.copy()) for var, val in sent.items() if var in winds or var not in ('u', 'v', 'wdir', 'wspd') ))
+    srwind = kwargs.pop('srwind', None)
+    kwargs['strictQC'] = False
+
+    prof = target_type(**kwargs)
+    if srwind is not None:
+        rmu, rmv, lmu, lmv = srwind
+        prof.set_srright(rmu, rmv)
+        prof.set_srleft(lmu, lmv)
+
+    # Leave out the arrays the profile was given, unless they were changed (e.g. missing
+    # values were masked)
+    computed = {}
+    for key, val in prof.__dict__.items():
+        if key in sent and _same_array(val, sent[key]):
+            continue
+        computed[key] = val
+    return computed
+
+def _same_array(val, sent):
+    if not isinstance(val, np.ndarray) or val.shape != sent.shape or val.dtype != sent.dtype:
+        return False
+    return bool(np.array_equal(ma.getmaskarray(val), ma.getmaskarray(sent)) and
+        np.array_equal(ma.getdata(val)[~ma.getmaskarray(val)], ma.getdata(sent)[~ma.getmaskarray(sent)]))
+
+def _rebuild(target_type, prof, computed):
+    # Puts a converted profile back together from the original profile and what the worker computed
+    new_prof = target_type.__new__(target_type)
+    for var in SHARED_VARS:
+        if var not in computed and prof.__dict__.get(var) is not None:
+            new_prof.__dict__[var] = _shared_array(prof, var)
+    new_prof.__dict__.update(computed)
+    return new_prof
+
+def normalize_indexes(idxs, num_times):
+    """
+    Returns the time indexes that are in range for num_times times. Negative indexes
+    count from the end, like list indexes.
+    """
+    return [ idx + num_times if idx < 0 else idx for idx in idxs if -num_times <= idx < num_times ]
 
-def doCopy(target_type, prof, idx, pipe):
-    pipe.put((target_type.copy(prof), idx))
-    
 class ProfCollection(object):
     """
     ProfCollection: A class to keep track of profiles from a single data source. Handles time switching, ensemble member switching,
@@ -40,75 +314,335 @@ class ProfCollection(object):
         self._interp_profs = {}
         self._async = None
         self._cancel_copy = False
-        self._procs = []
+        self._copy_pool = None
+        self._copy_running = {}
+        self._copy_done = 0
+        self._copy_total = 0
+        self._copying = False
+
+        self._memory_budget = MEMORY_BUDGET
+        self._computed = OrderedDict()
+        self._computed_bytes = 0
+        self._evicted = 0
+        self._user_pcls = set()
+        self._mem_lock = threading.RLock()
+        self._index_cache = {}
 
     def subset(self, idxs):
         """
         Subset the profile collection over time.
-        idxs:   The time indices to include in the subsetted collection.
+        idxs:   The time indices to include in the subsetted collection. Indices that
+            are out of range are left out.
         """
-        def extract_profile_indexes(prof):
-            prof_indexed = []
-            for idx in idxs:
-                try:
-                    prof_indexed.append(prof[idx])
-                except IndexError:
-                    pass
+        idxs = normalize_indexes(idxs, len(self._dates))
 
-            return prof_indexed
+        def extract_profile_indexes(prof):
+            return [ prof[idx] for idx in idxs if idx < len(prof) ]
 
         profiles = dict( (mem, extract_profile_indexes(prof)) for mem, prof in self._profs.items() )
         dates = [ self._dates[idx] for idx in idxs ]
         return ProfCollection(profiles, dates, highlight=self._highlight, **self._meta)
 
-    def _backgroundCopy(self, member, max_procs=2):
+    def _copyPriority(self, key):
+        # Lower is sooner: the highlighted member at the current time, then at the times
+        # outward from it (later before earlier), then the other members the same way
+        member, idx = key
+        cur_idx = max(self._prof_idx, 0)
+        return (member != self._highlight, abs(idx - cur_idx), idx < cur_idx)
+
+    def _backgroundCopy(self, member=None, max_procs=None, callback=None, progress=None):
         """
         Copies the profile objects in the background while the user can continue to do things.
         This upgrades the project object types from Profile to ConvectiveProfile via the
-        _target_type variable.
-        
-        member:     the key indicating a specific member
-        max_procs:  max number of processors to perform this action
-        """
-        pipe = Queue(max_procs)
-
-        for idx, prof in enumerate(self._profs[member]):
-            proc = Process(target=doCopy, args=(self._target_type, prof, idx, pipe))
-            proc.start()
-
-            self._procs.append(proc)
-            
-            if (idx % max_procs) == 0 or idx == len(self._profs[member]) - 1:
-                for proc in self._procs:
-
-                    if platform.system() != "Windows":
-                        # Windows hangs here for some reason, but runs fine without it.
-                        proc.join()
-                        
-                    prof, copy_idx  = pipe.get()
-                    self._profs[member][copy_idx] = prof
-                    
-                self._procs = []
+        _target_type variable. The profiles are done in order of _copyPriority(), which
+        follows the current time and highlighted member as they change.
+
+        member:     the key indicating a specific member (default is all the members)
+        max_procs:  max number of processes to perform this action (default is DEFAULT_PROCS)
+        callback:   a function (member, index) called when a profile has been converted
+        progress:   a function (number done, total number) called as the profiles are converted
+        """
+        if max_procs is None:
+            max_procs = DEFAULT_PROCS
+
+        members = [ member ] if member is not None else list(self._profs.keys())
+        origs = dict( ((mem, idx), prof) for mem in members for idx, prof in enumerate(self._profs[mem])
+            if type(prof) != self._target_type )
+        if len(origs) == 0 or self._cancel_copy:
+            return
+
+        keys = sorted(origs.keys(), key=self._copyPriority)
+        shm, size, layouts = _share_profiles([ origs[key] for key in keys ])
+        layouts = dict(zip(keys, layouts))
+
+        todo = set(keys)
+        self._copy_done = 0
+        self._copy_total = len(keys)
+        self._copy_pool = get_pool(max_procs)
+        self._copying = True
+
+        def finished(key):
+            self._copy_done += 1
+            if callback is not None:
+                callback(*key)
+            if progress is not None:
+                progress(self._copy_done, self._copy_total)
+
+        try:
+            while (len(todo) > 0 or len(self._copy_running) > 0) and not self._cancel_copy:
+                if self._computed_bytes >= self._memory_budget and len(todo) > 0:
+                    # The rest would just push out the ones that were done; they'll be done when they're shown
+                    todo = set()
+                    self._copy_total = self._copy_done + len(self._copy_running)
+                    if progress is not None:
+                        progress(self._copy_done, self._copy_total)
+
+                # Keep the workers busy with the most important profiles
+                while len(todo) > 0 and len(self._copy_running) < max_procs and not self._cancel_copy:
+                    key = min(todo, key=self._copyPriority)
+                    todo.discard(key)
+                    mem, idx = key
+                    if self._profs[mem][idx] is not origs[key]:
+                        # Converted (or modified) in the meantime
+                        finished(key)
+                        continue
+
+                    meta = dict( (var, origs[key].__dict__.get(var)) for var in META_VARS )
+                    if hasattr(origs[key], 'srwind'):
+                        meta['srwind'] = origs[key].srwind
+                    try:
+                        fut = self._copy_pool.submit(_convert_shared, self._target_type, shm.name, size, layouts[key], meta)
+                    except (OSError, ValueError) as e:
+                        logging.exception(e)
+                        logging.debug("Couldn't start the worker pool; profiles will be converted as they're shown.")
+                        return
+                    self._copy_running[fut] = key
+
+                if len(self._copy_running) == 0:
+                    break
+
+                done, not_done = wait(list(self._copy_running.keys()), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    if self._cancel_copy:
+                        break
+                    key = self._copy_running.pop(fut)
+                    mem, idx = key
+                    if fut.cancelled():
+                        # The pool was shut down under us (by this collection or another one)
+                        if not self._cancel_copy:
+                            todo.add(key)
+                        continue
+
+                    try:
+                        computed = fut.result()
+                    except Exception as e:
+                        logging.exception(e)
+                        logging.debug("Couldn't convert profile %d of member '%s' in the background, "
+                            "converting it here." % (idx, mem))
+                        computed = None
+
+                    # Don't replace a profile that has been converted or modified since
+                    if self._profs[mem][idx] is origs[key]:
+                        if computed is not None:
+                            self._profs[mem][idx] = _rebuild(self._target_type, origs[key], computed)
+                        else:
+                            try:
+                                self._profs[mem][idx] = self._target_type.copy(origs[key])
+                            except Exception as e:
+                                # Leave it, so the error comes up again when the profile is used
+                                logging.exception(e)
+                                logging.debug("Couldn't convert profile %d of member '%s'." % (idx, mem))
+                                finished(key)
+                                continue
+                        self._track(mem, idx, used=False)
+                    finished(key)
+        finally:
+            self._copying = False
+            self._copy_running = {}
+            shm.close()
+            shm.unlink()
         return
 
-    def setAsync(self, async_obj):
+    def setAsync(self, async_obj, callback=None, progress=None, max_procs=None):
         """
         Start an asynchronous process to load objects of type 'target_type' in the background.
         Used to upgrade the Profile objects to ConvectiveProfile objects in the background
 
         async:  An AsyncThreads instance.
+        callback:   a function (member, index) called when a profile has been converted
+        progress:   a function (number done, total number) called as the profiles are converted
+        max_procs:  max number of worker processes to use (default is DEFAULT_PROCS)
         """
         self._async = async_obj
-        self._async.post(self._backgroundCopy, None, self._highlight)
+        # AsyncThreads.post() has its own callback argument, so these are passed by position
+        self._async.post(self._backgroundCopy, None, None, max_procs, callback, progress)
 
     def cancelCopy(self):
         """
-        Terminates any threads that are running in the background.
+        Cancels the background copies, including the ones that are running.
+        """
+        self._cancel_copy = True
+        if len(self._copy_running) > 0 and self._copy_pool is not None:
+            # Killing the workers is the only way to stop a running conversion
+            self._copy_pool.terminate()
+
+    def isConverted(self, idx, member=None):
+        """
+        Returns True if the profile at time index idx (of the highlighted member by
+        default) has been upgraded to the target type.
+        """
+        if member is None:
+            member = self._highlight
+        return type(self._profs[member][idx]) == self._target_type
+
+    def getCopyProgress(self):
+        """
+        Returns the number of profiles the background copy has done and the total it's doing.
+        """
+        return self._copy_done, self._copy_total
+
+    def isCopying(self):
+        """
+        Returns True if the background copy is running.
+        """
+        return self._copying
+
+    def _isPinned(self, member, idx):
+        # Profiles that can't be evicted: the ones being shown and the ones the user changed
+        if idx == self._prof_idx:
+            return True
+        if member == self._highlight and (self._mod_therm[idx] or self._mod_wind[idx] or self._interp[idx]
+                or idx in self._user_pcls):
+            return True
+        return _has_user_srwind(self._profs[member][idx])
+
+    def _track(self, member, idx, used=True):
+        """
+        Counts a computed profile against the memory budget and evicts the least recently
+        used ones if it's over.
+        used:   Whether the profile is being used (True), or was just computed in the
+            background (False), in which case it's the first to go.
+        """
+        with self._mem_lock:
+            key = (member, idx)
+            prof = self._profs[member][idx]
+            tracked = self._computed.pop(key, None)
+            if tracked is not None:
+                self._computed_bytes -= tracked[1]
+
+            if type(prof) == profile.Profile:
+                return
+
+            if tracked is not None and tracked[0] is prof:
+                size = tracked[1]
+            else:
+                size = computed_size(prof)
+            self._computed[key] = (prof, size)
+            self._computed_bytes += size
+            if not used:
+                self._computed.move_to_end(key, last=False)
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        with self._mem_lock:
+            for key in list(self._computed.keys()):
+                if self._computed_bytes <= self._memory_budget:
+                    break
+                if key == keep or self._isPinned(*key):
+                    continue
+
+                prof, size = self._computed.pop(key)
+                self._computed_bytes -= size
+                member, idx = key
+                if self._profs[member][idx] is prof:
+                    self._profs[member][idx] = _raw_profile(prof)
+                    self._evicted += 1
+
+    def setMemoryBudget(self, budget):
+        """
+        Sets the max number of bytes of computed profiles to keep, evicting the least
+        recently used ones if it's over.
+        """
+        self._memory_budget = budget
+        self._evict()
+
+    def getMemoryUsage(self):
+        """
+        Returns a dictionary with the bytes in the computed profiles ('computed'), in the
+        columns of all the profiles ('raw') and the total, along with the number of
+        computed profiles held, the number evicted and the budget.
+        """
+        with self._mem_lock:
+            computed = self._computed_bytes
+            num_computed = len(self._computed)
+
+        profs = [ prof for profs in self._profs.values() for prof in profs ]
+        profs.extend(self._orig_profs.values())
+        profs.extend(self._interp_profs.values())
+        raw = sum( raw_size(prof) for prof in set(profs) )
+        return {'computed': computed, 'raw': raw, 'total': computed + raw, 'num_computed': num_computed,
+                'evicted': self._evicted, 'budget': self._memory_budget}
+
+    def getIndexArrays(self, params, current=False):
+        """
+        Computes indices for every member at every time in one vectorized pass, without
+        making ConvectiveProfiles (see sharptab.gridded for the parameters). They're
+        computed on the levels of the profiles, so they can differ slightly from the
+        values in a ConvectiveProfile.
+
+        params:     A list of parameter names (the keys of sharptab.gridded.PARAMS).
+        current:    If True, only return the values at the current time.
+
+        Returns the member names (sorted) and a dictionary of parameter name to a
+        (members, times) array, or a (members,) array if current is True. The times
+        a member doesn't have are NaN.
+        """
+        members = sorted(self._profs.keys())
+        todo = [ param for param in params if param not in self._index_cache ]
+        if len(todo) > 0:
+            ntimes = len(self._dates)
+            keys = [ (imem, idx) for imem, mem in enumerate(members) for idx in range(min(len(self._profs[mem]), ntimes)) ]
+            pres, hght, tmpc, dwpc, u, v = _columns([ self._profs[members[imem]][idx] for imem, idx in keys ])
+            with np.errstate(all='ignore'):
+                results = gridded.compute_params(pres, hght, tmpc, dwpc, u, v, params=todo)
+
+            rows = np.array([ imem for imem, idx in keys ], dtype=int)
+            cols = np.array([ idx for imem, idx in keys ], dtype=int)
+            for param in todo:
+                values = np.full((len(members), ntimes), np.nan)
+                values[rows, cols] = results[param]
+                self._index_cache[param] = values
+
+        arrays = dict( (param, self._index_cache[param]) for param in params )
+        if current:
+            if self.hasCurrentProf():
+                arrays = dict( (param, values[:, self._prof_idx]) for param, values in arrays.items() )
+            else:
+                arrays = dict( (param, np.full(len(members), np.nan)) for param in params )
+        return members, arrays
+
+    def getEnsembleStats(self, params, percentiles=(10, 25, 50, 75, 90)):
         """
-        for proc in self._procs:
-            proc.terminate()
-        if self._async is not None:
-            self._async.clearQueue()
+        Summarizes indices over the ensemble members at each time (see getIndexArrays()).
+
+        params:     A list of parameter names (the keys of sharptab.gridded.PARAMS).
+        percentiles:    The percentiles to compute.
+
+        Returns a dictionary of parameter name to a dictionary with the 'mean', 'spread'
+        (standard deviation), 'min' and 'max' over the members at each time, and
+        'percentiles', a dictionary of percentile to the values at each time.
+        """
+        members, arrays = self.getIndexArrays(params)
+        stats = {}
+        with warnings.catch_warnings():
+            # Times that no member has are NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for param, values in arrays.items():
+                pcts = np.nanpercentile(values, percentiles, axis=0)
+                stats[param] = {'mean': np.nanmean(values, axis=0), 'spread': np.nanstd(values, axis=0),
+                    'min': np.nanmin(values, axis=0), 'max': np.nanmax(values, axis=0),
+                    'percentiles': dict(zip(percentiles, pcts))}
+        return stats
 
     def getMeta(self, key, index=False):
         """
@@ -143,8 +677,29 @@ class ProfCollection(object):
         # then upgrade it via the copy function.
         if type(cur_prof) != self._target_type:
             self._profs[self._highlight][self._prof_idx] = self._target_type.copy(cur_prof)
+        self._track(self._highlight, self._prof_idx)
         return self._profs[self._highlight][self._prof_idx]
 
+    def getProfAt(self, idx, member=None):
+        """
+        Returns the profile at time index idx (of the highlighted member by default),
+        upgrading it to the target type if it hasn't been. The current time doesn't change.
+        """
+        if member is None:
+            member = self._highlight
+
+        prof = self._profs[member][idx]
+        if type(prof) != self._target_type:
+            self._profs[member][idx] = self._target_type.copy(prof)
+        self._track(member, idx)
+        return self._profs[member][idx]
+
+    def getDates(self):
+        """
+        Returns the dates of the profiles.
+        """
+        return list(self._dates)
+
     def getCurrentProfs(self):
         """
         Returns the profiles at the current time.
@@ -163,6 +718,7 @@ class ProfCollection(object):
                     self._profs[mem][self._prof_idx] = self._target_type.copy(cur_prof)
                 elif type(cur_prof) not in [ profile.BasicProfile, self._target_type ]:
                     self._profs[mem][self._prof_idx] = profile.BasicProfile.copy(cur_prof)
+                self._track(mem, self._prof_idx)
 
         profs = dict( (mem, profs[self._prof_idx]) for mem, profs in self._profs.items() if len(profs) > self._prof_idx ) 
         return profs
@@ -243,14 +799,25 @@ class ProfCollection(object):
         """
         self._analog_date = self._dates[0]
         self._dates = [ analog_to_date ]
+        self._index_cache = {}
 
-    def advanceTime(self, direction):
+    def advanceTime(self, direction, ready_only=False):
         """
         Advance time in a direction specified by 'direction'. Returns a datetime object containing the new time.
         direction:  An integer (ether 1 or -1) specifying which direction to move time in. 1 moves time forward,
             -1 moves time backward.
+        ready_only: If True, skip the times whose highlighted profile hasn't been upgraded to the
+            target type yet. The time doesn't change if none of the others have been.
         """
         length = len(self._dates)
+        if ready_only:
+            for step in range(1, length):
+                idx = (self._prof_idx + direction * step) % length
+                if idx < len(self._profs[self._highlight]) and self.isConverted(idx):
+                    self._prof_idx = idx
+                    break
+            return self._dates[self._prof_idx]
+
         if direction > 0 and self._prof_idx == length - 1:
             self._prof_idx = 0
         elif direction < 0 and self._prof_idx == 0:
@@ -291,7 +858,8 @@ class ProfCollection(object):
         parcel:     A parcel object to use as the custom parcel.
         """
         if self.hasCurrentProf():
-            self._profs[self._highlight][self._prof_idx].usrpcl = parcel
+            self.getHighlightedProf().usrpcl = parcel
+            self._user_pcls.add(self._prof_idx)
 
     def modify(self, idx, **kwargs):
         """
@@ -305,11 +873,11 @@ class ProfCollection(object):
         if self.isEnsemble():
             raise ValueError("Can't modify ensemble profiles")
 
-        prof = self._profs[self._highlight][self._prof_idx]
+        prof = self.getHighlightedProf()
 
-        # Save original, if one hasn't already been saved
+        # Save original, if one hasn't already been saved (just the columns are needed)
         if self._prof_idx not in self._orig_profs:
-            self._orig_profs[self._prof_idx] = prof
+            self._orig_profs[self._prof_idx] = _raw_profile(prof)
 
         cls = type(prof)
         # Copy the variables to be modified
@@ -326,6 +894,7 @@ class ProfCollection(object):
  
         # Make a copy of the profile object with the newly modified variables inserted.
         self._profs[self._highlight][self._prof_idx] = cls.copy(prof, **prof_vars)
+        self._index_cache = {}
 
         # Update bookkeeping
         if 'tmpc' in kwargs or 'dwpc' in kwargs:
@@ -336,12 +905,12 @@ class ProfCollection(object):
 
     def modifyStormMotion(self, deviant, vec_u, vec_v):
         if deviant == 'left':
-            self._profs[self._highlight][self._prof_idx].set_srleft(vec_u, vec_v)
+            self.getHighlightedProf().set_srleft(vec_u, vec_v)
         elif deviant == 'right':
-            self._profs[self._highlight][self._prof_idx].set_srright(vec_u, vec_v)
+            self.getHighlightedProf().set_srright(vec_u, vec_v)
 
     def resetStormMotion(self):
-        self._profs[self._highlight][self._prof_idx].reset_srm()
+        self.getHighlightedProf().reset_srm()
 
     def interp(self, dp=-25):
         """
@@ -351,11 +920,11 @@ class ProfCollection(object):
         if self.isEnsemble():
             raise ValueError("Cannot interpolate the ensemble profiles.")
 
-        prof = self._profs[self._highlight][self._prof_idx]
+        prof = self.getHighlightedProf()
 
-        # Save original, if one hasn't already been saved
+        # Save original, if one hasn't already been saved (just the columns are needed)
         if self._prof_idx not in self._orig_profs:
-            self._orig_profs[self._prof_idx] = prof
+            self._orig_profs[self._prof_idx] = _raw_profile(prof)
 
         cls = type(prof)
         # Copy the tmpc, dwpc, etc. profiles to be inteprolated
@@ -375,10 +944,11 @@ class ProfCollection(object):
 
         interp_prof = cls.copy(prof, **prof_vars)
         self._profs[self._highlight][self._prof_idx] = interp_prof
+        self._index_cache = {}
 
          # Save the original like in modify()
         if self._prof_idx not in self._interp_profs:
-            self._interp_profs[self._prof_idx] = interp_prof
+            self._interp_profs[self._prof_idx] = _raw_profile(interp_prof)
        
         # Update bookkeeping
         self._interp[self._prof_idx] = True
@@ -396,7 +966,7 @@ class ProfCollection(object):
         else:
             orig_prof = self._orig_profs[self._prof_idx]
 
-        prof = self._profs[self._highlight][self._prof_idx]
+        prof = self.getHighlightedProf()
         cls = type(prof)
 
         # Get the original variables
@@ -404,6 +974,7 @@ class ProfCollection(object):
 
         # Make a copy of the profile object with the original variables inserted
         self._profs[self._highlight][self._prof_idx] = cls.copy(prof, **prof_vars)
+        self._index_cache = {}
 
         # Update bookkeeping
         if 'tmpc' in args or 'dwpc' in args:
@@ -420,6 +991,7 @@ class ProfCollection(object):
             return
 
         self._profs[self._highlight][self._prof_idx] = self._orig_profs[self._prof_idx]
+        self._index_cache = {}
 
         prof = self._profs[self._highlight][self._prof_idx]
 #       print dict( (k, prof.__dict__[k].shape[0]) for k in [ 'pres', 'hght', 'tmpc', 'dwpc', 'u', 'v' ])
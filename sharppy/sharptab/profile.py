@@ -100,6 +100,7 @@ class Profile(object):
         self.missing = kwargs.get('missing', MISSING)
         self.profile = kwargs.get('profile')
         self.latitude = kwargs.get('latitude', ma.masked)
+        self.longitude = kwargs.get('longitude', ma.masked)
         self.strictQC = kwargs.get('strictQC', False)
 
         # JTS - Get the cloud top fraction/pressure values.
@@ -176,7 +177,7 @@ class Profile(object):
             Copies a profile object.
         '''
         # JTS - Add the cloud top variables to the keyword argument list.
-        new_kwargs = dict( (k, prof.__dict__[k]) for k in [ 'pres', 'hght', 'tmpc', 'dwpc', 'omeg', 'location', 'date', 'latitude', 'strictQC', 'missing', \
+        new_kwargs = dict( (k, prof.__dict__[k]) for k in [ 'pres', 'hght', 'tmpc', 'dwpc', 'omeg', 'location', 'date', 'latitude', 'longitude', 'strictQC', 'missing', \
                                                             'ctf_low', 'ctf_high', 'ctp_low', 'ctp_high'])
 
         if prof.u is not None and prof.v is not None:
@@ -0,0 +1,279 @@
+import datasources.available as available
+from datetime import datetime, timedelta
+import pytest
+import os
+
+@pytest.fixture(autouse=True)
+def avail_cache_dir(tmpdir, monkeypatch):
+    # Keep the availability cache out of the home directory
+    import datasources.data_source as data_source
+    for module in set([ available, data_source.available ]):
+        monkeypatch.setattr(module, 'CACHE_FN', str(tmpdir.join('available.pkl')))
+        monkeypatch.setattr(module, '_avail_cache', None)
+
+def test_availability_cache(tmpdir):
+    cache_fn = str(tmpdir.join('available.pkl'))
+    cache = available.AvailabilityCache(cache_fn=cache_fn, ttls={'spc': 300})
+    calls = []
+    def listing():
+        calls.append(1)
+        return [ datetime(2014, 6, 16, 12) ]
+
+    now = datetime.utcnow()
+    key = ('available', 'spc', 'observed', now)
+    assert cache.get(key, listing) == cache.get(key, listing)
+    assert len(calls) == 1
+    assert cache.getStats()['hits'] == 1 and cache.getStats()['misses'] == 1
+
+    # The entries are saved in batches
+    assert not os.path.exists(cache_fn)
+    cache.save()
+    assert os.path.exists(cache_fn)
+
+    # Another session picks up the saved entries
+    cache2 = available.AvailabilityCache(cache_fn=cache_fn, ttls={'spc': 300})
+    assert cache2.get(key, listing) == [ datetime(2014, 6, 16, 12) ]
+    assert len(calls) == 1
+
+    # Expired entries are fetched again, but old station lists are kept
+    cache3 = available.AvailabilityCache(cache_fn=None, ttls={'spc': 0})
+    cache3.get(key, listing)
+    cache3.get(key, listing)
+    assert len(calls) == 3
+    old_key = ('availableat', 'spc', 'observed', now - timedelta(days=10))
+    cache3.get(old_key, listing)
+    cache3.get(old_key, listing)
+    assert len(calls) == 4
+
+    # The shared cache is made the first time it's used, in CACHE_FN
+    assert available._avail_cache is None
+    assert available.get_avail_cache() is available.get_avail_cache()
+    assert available._avail_cache._cache_fn == str(tmpdir.join('available.pkl'))
+
+def test_available_module():
+    # The data sources use the user's copy of available.py, which has to be up to date
+    import datasources.data_source as data_source
+    assert hasattr(data_source.available, 'get_avail_cache')
+    assert hasattr(data_source.available, 'AvailabilityCache')
+
+def make_datasource(tmpdir):
+    import xml.etree.ElementTree as ET
+    import datasources.data_source as data_source
+
+    csv = tmpdir.join('stations.csv')
+    csv.write("icao,iata,synop,name,state,country,lat,lon,elev,priority,srcid\n"
+              "KOAX,OAX,72558,Omaha,NE,US,41.32,-96.37,350,3,oax\n"
+              ",,72649,Chanhassen,MN,US,44.85,-93.57,287,3,mpx\n"
+              "KTOP,TOP,72456,Topeka,KS,US,39.07,-95.62,268,3,top\n")
+
+    config = ET.fromstring('<datasource name="Test" ensemble="false" observed="true">'
+        '<outlet name="A" url="http://localhost/a/{date}{cycle}_{srcid}" format="spc">'
+        '<time first="0" range="0" delta="0" offset="0" delay="1" cycle="12" archive="24" start="-" end="-"/>'
+        '<points csv="%s" /></outlet>'
+        '<outlet name="B" url="http://localhost/b/{date}{cycle}_{srcid}" format="spc">'
+        '<time first="0" range="0" delta="0" offset="0" delay="1" cycle="12" archive="24" start="-" end="-"/>'
+        '<points csv="%s" /></outlet></datasource>' % (str(csv), str(csv)))
+    return data_source.DataSource(config)
+
+def test_outlet_resolution(tmpdir):
+    import datasources.data_source as data_source
+    ds = make_datasource(tmpdir)
+    cycle = datetime(2014, 6, 16, 12)
+    calls = []
+
+    # Outlet A only has OAX, outlet B has everything
+    for name, outlet in ds._outlets.items():
+        avail = outlet.getPoints()[:1] if name == 'A' else outlet.getPoints()
+        outlet.getAvailableTimes = (lambda n: lambda dt=None, **kw: calls.append((n, 'times')) or [ cycle ])(name)
+        outlet.getAvailableAtTime = (lambda n, a: lambda dt=None, **kw: calls.append((n, 'stns')) or a)(name, avail)
+
+    oax, mpx = ds._outlets['A'].getPoints()[:2]
+    dec, url = ds.getDecoderAndURL(oax, cycle)
+    assert url == 'http://localhost/a/14061612_oax'
+    assert ds.getDecoder(oax, cycle) is dec
+    assert ds.getURL(mpx, cycle) == 'http://localhost/b/14061612_mpx'
+    assert ds.getURL(oax, cycle, outlet_num=1) == 'http://localhost/b/14061612_oax'
+    # One lookup of the times and the stations per outlet
+    assert sorted(calls) == [ ('A', 'stns'), ('A', 'times'), ('B', 'stns'), ('B', 'times') ]
+
+    ds.invalidate()
+    ds.getURL(oax, cycle)
+    assert len(calls) == 8
+
+    # A profile that isn't up yet is looked for again the next time
+    later = cycle + timedelta(hours=12)
+    for attempt in range(2):
+        try:
+            ds.getURL(oax, later)
+            assert False
+        except data_source.DataSourceError:
+            pass
+    assert len(ds._outlet_cache._entries) == 1
+
+def test_station_lookup(tmpdir, monkeypatch):
+    ds = make_datasource(tmpdir)
+    assert ds.getPoint('KOAX')['srcid'] == 'oax'
+    assert ds.getPoint('TOP')['srcid'] == 'top'
+    assert ds.getPoint('72649')['srcid'] == 'mpx'
+    assert ds.getPoint('OP')['srcid'] == 'top'
+    assert ds.getPoint('XYZ') is None
+
+    import datasources.data_source as data_source
+    monkeypatch.setitem(data_source.available.availableat, 'a', {'test': lambda dt: [ 'top', 'xyz', 'oax' ]})
+    stns = ds._outlets['A'].getAvailableAtTime(dt=datetime(2014, 6, 16, 12))
+    assert [ s['srcid'] for s in stns ] == [ 'top', 'oax' ]
+
+    # Both outlets have the same points, so they're only listed once
+    ds._outlets['B'].getAvailableAtTime = lambda dt=None: ds._outlets['B'].getPoints()
+    ds._outlets['A'].getAvailableAtTime = lambda dt=None: ds._outlets['A'].getPoints()
+    assert len(ds.getAvailableAtTime(datetime(2014, 6, 16, 12))) == 3
+
+def test_station_cache(tmpdir, monkeypatch):
+    import datasources.data_source as data_source
+    monkeypatch.setattr(data_source, 'STATION_CACHE_FN', str(tmpdir.join('stations.pkl')))
+    monkeypatch.setattr(data_source, '_station_tables', None)
+
+    ds = make_datasource(tmpdir)
+    # The points aren't loaded until they're used
+    assert all( outlet._points is None for outlet in ds._outlets.values() )
+    pts_a = ds._outlets['A'].getPoints()
+    assert ds._outlets['B'].getPoints() is pts_a
+    assert pts_a[0]['lat'] == 41.32 and pts_a[0]['elev'] == 350
+
+    # A new session reads the tables from the cache, and a changed file is parsed again
+    monkeypatch.setattr(data_source, '_station_tables', None)
+    fields, points = data_source.load_station_table(str(tmpdir.join('stations.csv')))
+    assert points == pts_a
+
+    tmpdir.join('stations.csv').write("icao,iata,synop,name,state,country,lat,lon,elev,priority,srcid\n"
+                                      "KOAX,OAX,72558,Omaha,NE,US,41.32,-96.37,350,3,oax\n")
+    monkeypatch.setattr(data_source, '_station_tables', None)
+    fields, points = data_source.load_station_table(str(tmpdir.join('stations.csv')))
+    assert len(points) == 1
+
+def test_ping_hosts():
+    import socket
+    import threading
+    import time
+    import http.server
+    import datasources.data_source as data_source
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.server.delay > 0:
+                time.sleep(self.server.delay)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    servers = []
+    for delay in [ 0, 2 ]:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.delay = delay
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+
+    # Nothing is listening on this port, so connections are refused
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    refused = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+
+    fast, slow = [ 'http://127.0.0.1:%d' % server.server_port for server in servers ]
+    try:
+        start = time.time()
+        results = data_source.pingHosts([ refused, slow, fast ], timeout=0.5, deadline=None, first_only=False)
+        assert results == {refused: False, slow: False, fast: True}
+        assert time.time() - start < 1.5
+
+        # The fast host's answer is remembered, and the slow one doesn't answer by the deadline
+        with data_source._reachable_lock:
+            data_source._reachable.pop(slow)
+        results = data_source.pingHosts([ fast, slow ], timeout=5, deadline=0.5, first_only=False)
+        assert results == {fast: True, slow: None}
+
+        # pingURLs pings the data sources' hosts at the same time, so the slow host doesn't hold it up
+        class PingSource(object):
+            def getURLList(self):
+                return [ slow + '/data.txt', fast + '/data.txt' ]
+
+        with data_source._reachable_lock:
+            data_source._reachable.clear()
+        start = time.time()
+        results = data_source.pingURLs({'ping': PingSource()}, timeout=5, deadline=3)
+        assert results[fast] is True
+        assert time.time() - start < 1.5
+
+        fut = data_source.pingURLsAsync({})
+        assert fut.result(timeout=5) == {}
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+class FakeSource(object):
+    def getName(self):
+        return "Fake"
+
+    def getDailyCycles(self):
+        return [0, 12]
+
+    def getMostRecentCycle(self):
+        return datetime(2014, 6, 16, 12)
+
+class FakeCollection(object):
+    def __init__(self, nbytes):
+        self._nbytes = nbytes
+
+    def getDates(self):
+        return [datetime(2014, 6, 16, 12)]
+
+    def getProfAt(self, idx, member=None):
+        return None
+
+    def getMemoryUsage(self):
+        return {'total': self._nbytes}
+
+def test_prefetch():
+    from sharppy.io.prefetch import PrefetchScheduler, predict_requests
+    src = FakeSource()
+    run = datetime(2014, 6, 16, 0)
+    loc = {'srcid': 'oax', 'lat': 41.3, 'lon': -96.4}
+    points = [ {'srcid': 'top', 'lat': 39.1, 'lon': -95.6}, {'srcid': 'mpx', 'lat': 44.8, 'lon': -93.6},
+               {'srcid': 'oax', 'lat': 41.3, 'lon': -96.4} ]
+
+    # The next run, then the nearest stations, then the previous run
+    reqs = predict_requests(src, loc, run, [0], points=points)
+    assert [ (r[1]['srcid'], r[2]) for r in reqs ] == [ ('oax', datetime(2014, 6, 16, 12)),
+        ('top', run), ('mpx', run), ('oax', datetime(2014, 6, 15, 12)) ]
+
+    loaded = []
+    def loader(data_source, loc, run, indexes):
+        loaded.append(loc['srcid'])
+        return FakeCollection(1000)
+
+    sched = PrefetchScheduler(loader, memory_budget=2500, idle_delay=0.)
+    sched.prefetch(reqs)
+    sched._executor.submit(lambda: None).result()
+    assert sched.get(*reqs[0]) is not None
+
+    # Only two collections fit in the budget, so the least likely ones are dropped
+    stats = sched.getStats()
+    assert stats['loaded'] == 4 and stats['evicted'] == 2 and stats['bytes'] == 1000
+    assert sched.get(*reqs[3]) is None
+    assert sched.get(*reqs[1]) is not None
+    assert sched.getStats()['hit_rate'] == 2 / 3.
+
+    # Requests the user moved away from aren't loaded
+    sched._idle_delay = 10.
+    sched.prefetch(reqs[:2])
+    sched.prefetch([])
+    sched._executor.submit(lambda: None).result()
+    assert len(loaded) == 4 and sched.getStats()['cancelled'] == 2
+    sched.shutdown()
@@ -1,4 +1,7 @@
 import pytest
+import datetime
+import numpy as np
+import numpy.testing as npt
 import sharppy.io.decoder as decoder
 import sharppy.io.buf_decoder as buf_decoder
 import sharppy.io.spc_decoder as spc_decoder
@@ -53,6 +56,103 @@ def test_bufkit_decoder():
     assert profs.getAnalogDate() is None
     assert profs.hasCurrentProf() == True
 
+def test_bufkit_bulk_parse():
+    # The bulk conversion of the data blocks has to match the line-by-line parse
+    dec = buf_decoder.BufDecoder(files[1])
+    prof = dec.getProfiles()._profs[dec.getProfiles()._highlight][0]
+    member = dec._downloadFile().split('\r\n\r\n\r\n')[0].split('\r\n')
+    begin = [ i for i, line in enumerate(member) if 'HGHT' in line ][1] + 1
+    prof_len = len(prof.pres)
+    block = member[begin:begin + 2 * prof_len]
+    bulk = dec._parseBlocks([ block ], [ prof_len ])[0]
+    lines = dec._parseBlockLines(block, prof_len)
+    for b, l in zip(bulk, lines):
+        np.testing.assert_array_equal(b, l)
+    np.testing.assert_array_equal(bulk[0], prof.pres)
+
+def test_parallel_decoding(monkeypatch):
+    # Decoding the members in a process pool has to give the same collection
+    monkeypatch.setattr(decoder, 'PARALLEL_MIN_SIZE', 0)
+    serial = pecan_decoder.PECANDecoder(files[4]).getProfiles()
+    parallel = pecan_decoder.PECANDecoder(files[4], max_procs=2).getProfiles()
+    assert serial._dates == parallel._dates
+    assert list(serial._profs.keys()) == list(parallel._profs.keys())
+    for mem in serial._profs.keys():
+        for sprof, pprof in zip(serial._profs[mem], parallel._profs[mem]):
+            np.testing.assert_array_equal(sprof.pres, pprof.pres)
+            np.testing.assert_array_equal(sprof.tmpc, pprof.tmpc)
+
+def test_lazy_decoding():
+    # Decoding only some of the times should give the same profiles as subsetting
+    for dec_cls, fname in [ (buf_decoder.BufDecoder, files[1]), (pecan_decoder.PECANDecoder, files[4]) ]:
+        assert dec_cls.supportsLazy()
+        full = dec_cls(fname).getProfiles(indexes=[3, 1])
+        lazy_dec = dec_cls(fname, lazy=True)
+        lazy = lazy_dec.getProfiles(indexes=[3, 1])
+        assert lazy._dates == full._dates
+        assert lazy.getMeta('base_time') == full.getMeta('base_time')
+        assert lazy_dec.getStnId() == full.getMeta('loc')
+        for mem in full._profs.keys():
+            for lprof, fprof in zip(lazy._profs[mem], full._profs[mem]):
+                np.testing.assert_array_equal(lprof.pres, fprof.pres)
+                np.testing.assert_array_equal(lprof.tmpc, fprof.tmpc)
+
+    # Negative indexes count from the end, and times that aren't in the file are left out
+    for dec_cls, fname in [ (buf_decoder.BufDecoder, files[1]), (pecan_decoder.PECANDecoder, files[4]) ]:
+        for indexes, num_times in [ ([-1], 1), ([], 0), ([1, 500, 3], 2) ]:
+            full = dec_cls(fname).getProfiles(indexes=indexes)
+            lazy = dec_cls(fname, lazy=True).getProfiles(indexes=indexes)
+            assert lazy._dates == full._dates and len(lazy._dates) == num_times
+            assert lazy.getMeta('loc') == full.getMeta('loc')
+            assert all( len(lazy._profs[mem]) == len(full._profs[mem]) for mem in full._profs.keys() )
+
+def test_spc_batch():
+    # The SPC files decode the same in a batch, and the other formats are left out
+    results = spc_decoder.parseSPCDirectory('examples/data', max_procs=2)
+    assert sorted(results.keys()) == [ 'examples/data/14061619.OAX', 'examples/data/14072800.BNA' ]
+
+    with open(files[0], 'rb') as f:
+        location, time, lat, lon, data = spc_decoder.parseSPCText(f.read().decode('utf-8'))
+    assert results[files[0]][:4] == (location, time, lat, lon)
+    for batch_col, col in zip(results[files[0]][4], data):
+        np.testing.assert_array_equal(batch_col, col)
+
+    # An empty field is read as missing, and doesn't shift the other values over
+    block = "1000.0,,20.0,10.0,180.0,10.0\n900.0,1000.0,15.0,5.0,190.0,20.0\n850.0,1500.0,12.0,3.0,200.0,25.0\n"
+    data = spc_decoder._parseSPCBlock(block)
+    assert data.shape == (3, 6)
+    assert np.isnan(data[0, 1])
+    np.testing.assert_array_equal(data[1], [900.0, 1000.0, 15.0, 5.0, 190.0, 20.0])
+
+def test_decoder_registry(tmpdir):
+    # The format names are read from the built-in modules
+    assert set(decoder.getFormats()) >= set([ 'bufkit', 'spc', 'pecan', 'wrf-arw', 'uwyo', 'nucaps' ])
+    assert decoder._readManifest(spc_decoder.__file__) == (spc_decoder.__fmtname__, spc_decoder.__classname__)
+    assert decoder.getDecoder('spc') is spc_decoder.SPCDecoder
+
+    custom = tmpdir.join('my_decoder.py')
+    custom.write("from sharppy.io.spc_decoder import SPCDecoder\n"
+                 "__fmtname__ = 'my-fmt'\n"
+                 "__classname__ = 'MyDecoder'\n"
+                 "class MyDecoder(SPCDecoder):\n"
+                 "    pass\n")
+    assert decoder._readManifest(str(custom)) == ('my-fmt', 'MyDecoder')
+
+    registry = decoder.DecoderRegistry()
+    registry.register('my-fmt', 'my_decoder', 'MyDecoder', path=str(custom))
+    assert 'my-fmt' in registry and not registry.isLoaded('my-fmt')
+    assert registry['my-fmt'].__name__ == 'MyDecoder'
+    assert registry.isLoaded('my-fmt')
+
+    # items() imports the decoders one at a time, so a loop that stops early
+    # leaves the rest unloaded
+    registry.register('other-fmt', 'sharppy.io.uwyo_decoder', 'UWYODecoder')
+    for fmt_name, dec_cls in registry.items():
+        break
+    assert fmt_name == 'my-fmt' and dec_cls is registry['my-fmt']
+    assert not registry.isLoaded('other-fmt')
+    assert dict(registry.items()) == {'my-fmt': registry['my-fmt'], 'other-fmt': uwyo_decoder.UWYODecoder}
+
 def test_uwyo_decoder():
     # Try to load in the UWYO file
     try:
@@ -76,3 +176,104 @@ def test_pecan_decoder():
     profs.advanceTime(-1)
     #print(profs) 
 
+
+def make_wrfout(fname, ntimes=2, nz=10, ny=24, nx=30):
+    # Write a small file with the variables the ARW decoder reads
+    netCDF4 = pytest.importorskip('netCDF4')
+    rs = np.random.RandomState(0)
+    nc = netCDF4.Dataset(fname, 'w')
+    for dim, size in [ ('Time', None), ('bottom_top', nz), ('bottom_top_stag', nz + 1), ('south_north', ny), ('west_east', nx) ]:
+        nc.createDimension(dim, size)
+    nc.START_DATE = '2020-05-01_00:00:00'
+
+    lats, lons = np.meshgrid(np.linspace(30, 40, ny), np.linspace(-105, -89, nx), indexing='ij')
+    z = np.linspace(0, 1, nz)[np.newaxis, :, np.newaxis, np.newaxis]
+    zs = np.linspace(0, 1, nz + 1)[np.newaxis, :, np.newaxis, np.newaxis]
+    shape = (ntimes, nz, ny, nx)
+    fields = {
+        'XLAT': (('Time', 'south_north', 'west_east'), np.repeat(lats[np.newaxis], ntimes, axis=0)),
+        'XLONG': (('Time', 'south_north', 'west_east'), np.repeat(lons[np.newaxis], ntimes, axis=0)),
+        'XTIME': (('Time',), np.arange(ntimes) * 60.),
+        'T': (('Time', 'bottom_top', 'south_north', 'west_east'), 10 + 80 * z + rs.rand(*shape)),
+        'QVAPOR': (('Time', 'bottom_top', 'south_north', 'west_east'), 0.015 * (1 - z) ** 3 + 0.001 * rs.rand(*shape)),
+        'P': (('Time', 'bottom_top', 'south_north', 'west_east'), 100 * rs.rand(*shape)),
+        'PB': (('Time', 'bottom_top', 'south_north', 'west_east'), 100000 * (1 - z) ** 1.2 + 5000 + np.zeros(shape)),
+        'PH': (('Time', 'bottom_top_stag', 'south_north', 'west_east'), np.zeros((ntimes, nz + 1, ny, nx))),
+        'PHB': (('Time', 'bottom_top_stag', 'south_north', 'west_east'), 9.81 * (300 + 15000 * zs) + np.zeros((ntimes, nz + 1, ny, nx))),
+        'U': (('Time', 'bottom_top', 'south_north', 'west_east'), 5 + 30 * z + 2 * rs.rand(*shape)),
+        'V': (('Time', 'bottom_top', 'south_north', 'west_east'), 5 + 10 * z + 2 * rs.rand(*shape)),
+        'COSALPHA': (('Time', 'south_north', 'west_east'), np.ones((ntimes, ny, nx))),
+        'SINALPHA': (('Time', 'south_north', 'west_east'), np.zeros((ntimes, ny, nx))),
+        'HGT': (('Time', 'south_north', 'west_east'), 300 + np.zeros((ntimes, ny, nx))),
+    }
+    for name, (dims, data) in fields.items():
+        nc.createVariable(name, 'f4', dims)[:] = data
+    nc.close()
+    return lats, lons
+
+def test_arw_decoder(tmpdir):
+    import sharppy.io.arw_decoder as arw_decoder
+    fname = str(tmpdir.join('wrfout.nc'))
+    lats, lons = make_wrfout(fname)
+
+    # The grid locator has to find the same point as checking every grid point
+    locator = arw_decoder.GridLocator(lats, lons, stride=4)
+    for lon, lat in [ (-97.3, 35.2), (-105., 30.), (-88.9, 40.1), (-100.04, 33.33) ]:
+        dist = arw_decoder._haversine(np.radians(lats), np.radians(lons), np.radians(lat), np.radians(lon))
+        np.testing.assert_array_equal(locator.nearest(lon, lat), np.where(dist == dist.min()))
+
+    profs = arw_decoder.ARWDecoder((fname, -97.3, 35.2)).getProfiles()
+    assert len(profs._dates) == 2
+    assert profs._dates[1] - profs._dates[0] == datetime.timedelta(hours=1)
+
+def test_arw_decode_points(tmpdir):
+    import sharppy.io.arw_decoder as arw_decoder
+    netCDF4 = pytest.importorskip('netCDF4')
+    fname = str(tmpdir.join('wrfout.nc'))
+    make_wrfout(fname)
+
+    points = [ (-97.3, 35.2), (-104.5, 39.8), (-90.1, 30.4), (-97.3, 35.2) ]
+    prof_colls = arw_decoder.ARWDecoder.decodePoints(fname, points)
+    assert len(prof_colls) == len(points)
+    for (lon, lat), prof_coll in zip(points, prof_colls):
+        single = arw_decoder.ARWDecoder((fname, lon, lat)).getProfiles()
+        assert single._dates == prof_coll._dates
+        for sprof, mprof in zip(single._profs[''], prof_coll._profs['']):
+            np.testing.assert_array_equal(sprof.pres, mprof.pres)
+            np.testing.assert_array_equal(sprof.tmpc, mprof.tmpc)
+            np.testing.assert_array_equal(sprof.wspd, mprof.wspd)
+
+    # Reading in many small slabs gives the same values as reading in one
+    nc = netCDF4.Dataset(fname)
+    jdxs, idxs = [ 3, 20, 3, 11 ], [ 25, 0, 7, 11 ]
+    full = nc.variables['T'][:]
+    np.testing.assert_array_equal(arw_decoder._read_points(nc.variables['T'], jdxs, idxs), full[:, :, jdxs, idxs])
+    np.testing.assert_array_equal(arw_decoder._read_points(nc.variables['T'], jdxs, idxs, max_values=1), full[:, :, jdxs, idxs])
+    nc.close()
+
+def test_arw_grid_params(tmpdir):
+    import sharppy.io.arw_decoder as arw_decoder
+    import sharppy.io.arw_grid as arw_grid
+    import sharppy.sharptab.gridded as gridded
+    netCDF4 = pytest.importorskip('netCDF4')
+    fname = str(tmpdir.join('wrfout.nc'))
+    out_fname = str(tmpdir.join('params.nc'))
+    make_wrfout(fname)
+
+    params = [ 'sbcape', 'mlcin', 'srh1', 'shr6', 'stp' ]
+    fields, lats, lons = arw_grid.compute_grid_params(fname, out_file=out_fname, params=params,
+        stride=2, subdomain=(2, 20, 3, 25), max_procs=2)
+    assert lats.shape == (9, 11)
+    for param in params:
+        assert fields[param].shape == lats.shape
+
+    # Each column should match the column from the decoder
+    prof = arw_decoder.ARWDecoder.decodePoints(fname, [ (lons[4, 5], lats[4, 5]) ])[0]._profs[''][0]
+    cols = [ np.ma.filled(var, np.nan).astype(float)[np.newaxis] for var in [ prof.pres, prof.hght, prof.tmpc, prof.dwpc, prof.u, prof.v ] ]
+    results = gridded.compute_params(*cols, params=params)
+    for param in params:
+        npt.assert_allclose(fields[param][4, 5], results[param][0], rtol=1e-4, atol=1e-3)
+
+    nc = netCDF4.Dataset(out_fname)
+    npt.assert_allclose(nc.variables['srh1'][:], fields['srh1'], rtol=1e-5)
+    nc.close()
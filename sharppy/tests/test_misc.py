@@ -1,6 +1,8 @@
 import sharppy.io.spc_decoder as spc_decoder
 import sharppy.sharptab.profile as profile
 import sharppy.sharptab.watch_type as watch
+import sharppy.databases.pwv as pwv
+import sharppy.sharptab.params as params
 import numpy.testing as npt
 import numpy as np
 
@@ -30,5 +32,36 @@ def test_wind_chill():
     prof.wspd[prof.sfc] = 10
     assert round(watch.wind_chill(prof)) == 23
 
+def test_pwv_climo():
+    db = pwv.get_pw_database()
+    mean = pwv.get_mean_pwv('OUN')
+    stdev = pwv.get_stdev_pwv('72357')
+    npt.assert_almost_equal(mean, db.getMean('KOUN'))
+    assert pwv.get_mean_pwv('XXX') is np.ma.masked
+
+    # Interpolating to the station location should give back the station climatology
+    clim_mean, clim_stdev = db.getClimo([35.246], [-97.472], [5])
+    npt.assert_almost_equal(clim_mean[0], mean[4], 2)
+    npt.assert_almost_equal(clim_stdev[0], stdev[4], 2)
+
+    flags = db.getFlags([mean[4], mean[4] + 4 * stdev[4], mean[4]], [35.246, 35.246, 0.], [-97.472, -97.472, 0.], 5)
+    npt.assert_equal(flags, [0, 3, 0])
+
+    # A ConvectiveProfile for a station in the climatology gets its flag
+    raw = all_profs[''][0]
+    cprof = profile.create_profile(pres=raw.pres, hght=raw.hght, tmpc=raw.tmpc, dwpc=raw.dwpc, wspd=raw.wspd,
+                                   wdir=raw.wdir, strictQC=False, profile='convective', date=dates[0], location='OAX')
+    assert pwv.get_mean_pwv('OAX') is not np.ma.masked
+    assert cprof.pwv_flag in range(-3, 4)
+    assert cprof.pwv_flag == pwv.pwv_climo(cprof, 'OAX', month=dates[0].month)
+
+    # A station that isn't in the climatology uses the climatology at its location
+    pwv_300 = float(params.precip_water(cprof, pbot=None, ptop=300))
+    cprof.latitude, cprof.longitude = 41.32, -96.37
+    expected = db.getFlags(pwv_300, 41.32, -96.37, dates[0].month)[0]
+    assert pwv.pwv_climo(cprof, 'XXX', month=dates[0].month) == expected
+    cprof.longitude = np.ma.masked
+    assert pwv.pwv_climo(cprof, 'XXX', month=dates[0].month) == 0
+
 test_heat_index()
 test_wind_chill() 
@@ -1,6 +1,7 @@
 import sharppy.io.spc_decoder as spc_decoder
 import sharppy.sharptab.profile as profile
 import sharppy.sharptab as tab
+import sharppy.sharptab.gridded as gridded
 import numpy.testing as npt
 import numpy as np
 
@@ -73,6 +74,33 @@ def test_parcels():
         bias = np.array(truth_pcls[key]) - np.array(returned)
         assert np.abs(bias).max() < 10
 
+def test_gridded_params():
+    # The vectorized routines should be close to the full profile for the soundings
+    for prof in profs:
+        ok = ~(np.ma.getmaskarray(prof.tmpc) | np.ma.getmaskarray(prof.dwpc))
+        # The profile interpolates the winds at the levels that don't have them
+        u, v = tab.interp.components(prof, prof.pres)
+        cols = [ np.asarray(var[ok], dtype=float)[np.newaxis] for var in [ prof.pres, prof.hght, prof.tmpc, prof.dwpc, u, v ] ]
+        # Two copies of the sounding make two columns
+        cols = [ np.concatenate([ col, col ]) for col in cols ]
+        results = gridded.compute_params(*cols)
+
+        for key in results.keys():
+            npt.assert_array_equal(results[key][0], results[key][1])
+        assert abs(results['sbcape'][0] - prof.sfcpcl.bplus) < 50
+        assert abs(results['sblcl'][0] - prof.sfcpcl.lclhght) < 10
+        assert abs(results['mlcape'][0] - prof.mlpcl.bplus) < 25
+        assert abs(results['mlcin'][0] - prof.mlpcl.bminus) < 5
+        assert abs(results['mllcl'][0] - prof.mlpcl.lclhght) < 1
+        assert abs(results['mucape'][0] - prof.mupcl.bplus) < 50
+        assert abs(results['srh1'][0] - prof.srh1km[0]) < 5
+        assert abs(results['srh3'][0] - prof.srh3km[0]) < 5
+        assert abs(results['shr6'][0] - tab.utils.mag(*prof.sfc_6km_shear)) < 1
+        assert abs(results['stp'][0] - prof.stp_fixed) < 0.2
+        assert abs(results['scp'][0] - prof.right_scp) < 0.5
+        pbl_top = tab.params.pbl_top(prof)
+        assert abs(results['pblh'][0] - tab.interp.to_agl(prof, tab.interp.hght(prof, pbl_top))) < 50
+
 def test_composite_severe():
     prof = profs[0]
     assert tab.params.stp_fixed(0,0,0,0) == 0
@@ -1,8 +1,9 @@
 import numpy as np
+import multiprocessing
 import numpy.ma as ma
 from sharppy.sharptab import constants
 from sharppy.sharptab.constants import MISSING
-from sharppy.sharptab.profile import Profile, BasicProfile
+from sharppy.sharptab.profile import Profile, BasicProfile, ConvectiveProfile
 import numpy.testing as npt
 
 sounding = """
@@ -208,3 +209,210 @@ class TestProfile(object):
         npt.assert_almost_equal(prof.sfc, sfc_ind)
 
 
+
+def test_background_copy():
+    from datetime import datetime
+    from sharppy.sharptab.profile import ConvectiveProfile, create_profile
+    from sharppy.sharptab.prof_collection import ProfCollection
+
+    dates = [ datetime(2014, 6, 16, hr) for hr in range(3) ]
+    profs = [ create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy() + dt,
+                             dwpc=dwpc.copy(), wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING, date=date)
+              for dt, date in enumerate(dates) ]
+    coll = ProfCollection({'': list(profs)}, dates)
+    coll._backgroundCopy('', max_procs=2)
+
+    for prof, copied in zip(profs, coll._profs['']):
+        assert type(copied) == ConvectiveProfile
+        expected = ConvectiveProfile.copy(prof)
+        assert sorted(copied.__dict__.keys()) == sorted(expected.__dict__.keys())
+        for attr in [ 'pres', 'tmpc', 'wspd', 'u', 'wetbulb', 'mupcl.bplus', 'mlpcl.lclhght', 'right_esrh',
+                      'stp_fixed', 'ship', 'sfc', 'precip_type' ]:
+            val, exp = copied, expected
+            for part in attr.split('.'):
+                val, exp = getattr(val, part), getattr(exp, part)
+            if isinstance(exp, str):
+                assert val == exp
+            else:
+                npt.assert_almost_equal(val, exp)
+
+    # setAsync() passes the number of workers on to the background copy
+    class RunNow(object):
+        def post(self, func, callback, *args, **kwargs):
+            func(*args, **kwargs)
+
+    coll = ProfCollection({'': list(profs)}, dates)
+    coll.setAsync(RunNow(), max_procs=1)
+    assert all( type(prof) == ConvectiveProfile for prof in coll._profs[''] )
+    assert coll._copy_pool._max_procs == 1
+
+class WorkerFailProfile(ConvectiveProfile):
+    # Can only be made in the main process, like a conversion that breaks in the workers
+    def __init__(self, **kwargs):
+        if multiprocessing.parent_process() is not None:
+            raise ValueError("Can't convert in a worker")
+        super(WorkerFailProfile, self).__init__(**kwargs)
+
+def test_background_copy_failure():
+    from datetime import datetime
+    from sharppy.sharptab.profile import create_profile
+    from sharppy.sharptab.prof_collection import ProfCollection
+
+    dates = [ datetime(2014, 6, 16, hr) for hr in range(2) ]
+    profs = [ create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy(),
+                             dwpc=dwpc.copy(), wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING, date=date)
+              for date in dates ]
+
+    # The profiles the workers couldn't convert are converted in this process
+    coll = ProfCollection({'': list(profs)}, dates, target_type=WorkerFailProfile)
+    done = []
+    coll._backgroundCopy('', max_procs=2, callback=lambda mem, idx: done.append(idx))
+    assert sorted(done) == [ 0, 1 ]
+    assert all( type(prof) == WorkerFailProfile for prof in coll._profs[''] )
+
+    # A profile that can't be converted at all raises its own error when it's used
+    no_date = create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy(), dwpc=dwpc.copy(),
+                             wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING)
+    coll = ProfCollection({'': [ no_date ]}, dates[:1])
+    coll._backgroundCopy('', max_procs=2)
+    assert not coll.isConverted(0)
+    try:
+        coll.interp()
+    except AttributeError as e:
+        assert 'strftime' in str(e)
+    else:
+        assert False, "interp() should have raised"
+
+def test_background_copy_order():
+    from datetime import datetime
+    from sharppy.sharptab.profile import ConvectiveProfile, create_profile
+    from sharppy.sharptab.prof_collection import ProfCollection
+
+    dates = [ datetime(2014, 6, 16, hr) for hr in range(3) ]
+    def make_profs():
+        return [ create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy(),
+                                dwpc=dwpc.copy(), wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING, date=date)
+                 for date in dates ]
+
+    # The highlighted member at the current time first, then the times around it, then the other member
+    coll = ProfCollection({'a': make_profs(), 'b': make_profs()}, dates, highlight='b')
+    coll.setCurrentDate(dates[1])
+    done = []
+    prog = []
+    coll._backgroundCopy(max_procs=1, callback=lambda mem, idx: done.append((mem, idx)),
+                         progress=lambda ndone, total: prog.append((ndone, total)))
+    assert done == [ ('b', 1), ('b', 2), ('b', 0), ('a', 1), ('a', 2), ('a', 0) ]
+    assert prog[-1] == (6, 6) and coll.getCopyProgress() == (6, 6)
+    assert all( coll.isConverted(idx, member=mem) for mem in 'ab' for idx in range(3) )
+
+    # Cancelling stops the running conversions too
+    coll = ProfCollection({'a': make_profs(), 'b': make_profs()}, dates, highlight='b')
+    done = []
+    def cancel(mem, idx):
+        done.append((mem, idx))
+        coll.cancelCopy()
+    coll._backgroundCopy(max_procs=2, callback=cancel)
+    assert len(done) == 1
+    assert sum( coll.isConverted(idx, member=mem) for mem in 'ab' for idx in range(3) ) == 1
+
+    # The pool starts again after being stopped
+    coll = ProfCollection({'a': make_profs()}, dates)
+    coll._backgroundCopy('a', max_procs=2)
+    assert type(coll.getHighlightedProf()) == ConvectiveProfile and coll.isConverted(2)
+
+def test_advance_ready():
+    from datetime import datetime
+    from sharppy.sharptab.profile import create_profile
+    from sharppy.sharptab.prof_collection import ProfCollection
+
+    dates = [ datetime(2014, 6, 16, hr) for hr in range(4) ]
+    profs = [ create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy(),
+                             dwpc=dwpc.copy(), wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING, date=date)
+              for date in dates ]
+    coll = ProfCollection({'': profs}, dates)
+    coll.getProfAt(0)
+    coll.getProfAt(2)
+
+    # Only the times that have been converted are stepped to
+    assert coll.advanceTime(1, ready_only=True) == dates[2]
+    assert coll.advanceTime(1, ready_only=True) == dates[0]
+    assert coll.advanceTime(-1, ready_only=True) == dates[2]
+    assert coll.advanceTime(1) == dates[3]
+    assert not coll.isCopying()
+
+def test_memory_budget():
+    from datetime import datetime
+    from sharppy.sharptab.profile import Profile, ConvectiveProfile, create_profile
+    from sharppy.sharptab.prof_collection import ProfCollection, computed_size
+
+    dates = [ datetime(2014, 6, 16, hr) for hr in range(4) ]
+    profs = [ create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy(),
+                             dwpc=dwpc.copy(), wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING, date=date)
+              for date in dates ]
+    coll = ProfCollection({'': profs}, dates)
+    size = computed_size(coll.getHighlightedProf())
+    coll.setMemoryBudget(int(3.5 * size))
+
+    # The user changes the first profile, then looks at the others
+    coll.modify(1, tmpc=30.)
+    for date in dates[1:]:
+        coll.setCurrentDate(date)
+        coll.getHighlightedProf()
+
+    # The modified profile and the one being shown stay, the least recently used one goes
+    types = [ type(prof) for prof in coll._profs[''] ]
+    assert types == [ ConvectiveProfile, Profile, ConvectiveProfile, ConvectiveProfile ]
+    usage = coll.getMemoryUsage()
+    assert usage['num_computed'] == 3 and usage['evicted'] == 1
+    assert 0 < usage['computed'] <= usage['budget'] and usage['raw'] > 0
+    npt.assert_almost_equal(coll._profs[''][1].tmpc, coll._orig_profs[0].tmpc)
+
+    # Evicted profiles are computed again when they're looked at
+    coll.setCurrentDate(dates[1])
+    assert type(coll.getHighlightedProf()) == ConvectiveProfile
+    assert type(coll._profs[''][2]) == Profile
+    assert coll._profs[''][0].tmpc[1] == 30.
+
+    # Any time can be computed without changing the current one
+    assert type(coll.getProfAt(2)) == ConvectiveProfile
+    assert coll.getCurrentDate() == dates[1]
+
+def test_ensemble_stats():
+    from datetime import datetime
+    from sharppy.sharptab.profile import Profile, create_profile
+    from sharppy.sharptab.prof_collection import ProfCollection
+    import sharppy.sharptab.gridded as gridded
+    import sharppy.sharptab.utils as utils
+
+    dates = [ datetime(2014, 6, 16, hr) for hr in range(2) ]
+    def make_prof(dt):
+        return create_profile(profile='raw', pres=pres.copy(), hght=hght.copy(), tmpc=tmpc.copy() + dt,
+                              dwpc=dwpc.copy(), wdir=wdir.copy(), wspd=wspd.copy(), missing=MISSING, date=dates[0])
+
+    # Member 'c' is missing the second time
+    members = {'a': [ make_prof(0), make_prof(1) ], 'b': [ make_prof(2), make_prof(3) ], 'c': [ make_prof(4) ]}
+    coll = ProfCollection(members, dates, highlight='a')
+    names, arrays = coll.getIndexArrays(['mlcape', 'shr6', 'stp'])
+    assert names == [ 'a', 'b', 'c' ]
+    assert arrays['mlcape'].shape == (3, 2) and np.isnan(arrays['mlcape'][2, 1])
+
+    # The same as computing each profile on its own
+    prof = members['b'][1]
+    pres_b, hght_b, tmpc_b, dwpc_b, wdir_b, wspd_b = [ ma.filled(var, MISSING) for var in
+        [ prof.pres, prof.hght, prof.tmpc, prof.dwpc, prof.wdir, prof.wspd ] ]
+    ok = np.all([ var != MISSING for var in [ hght_b, tmpc_b, dwpc_b, wdir_b, wspd_b ] ], axis=0)
+    u, v = utils.vec2comp(wdir_b[ok], wspd_b[ok])
+    cols = [ np.asarray(var, dtype=float)[np.newaxis] for var in [ pres_b[ok], hght_b[ok], tmpc_b[ok], dwpc_b[ok], u, v ] ]
+    single = gridded.compute_params(*cols, params=['mlcape', 'shr6', 'stp'])
+    for param in single.keys():
+        npt.assert_allclose(arrays[param][1, 1], single[param][0])
+    assert all( type(p) == Profile for profs in members.values() for p in profs )
+
+    stats = coll.getEnsembleStats(['mlcape', 'shr6'], percentiles=[50])
+    npt.assert_allclose(stats['mlcape']['mean'], np.nanmean(arrays['mlcape'], axis=0))
+    npt.assert_allclose(stats['mlcape']['percentiles'][50], np.nanmedian(arrays['mlcape'], axis=0))
+    npt.assert_allclose(stats['shr6']['spread'], 0., atol=1e-6)
+    assert stats['mlcape']['max'][0] > stats['mlcape']['min'][0]
+
+    names, current = coll.getIndexArrays(['mlcape'], current=True)
+    npt.assert_allclose(current['mlcape'], arrays['mlcape'][:, 0])
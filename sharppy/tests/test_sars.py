@@ -1,4 +1,11 @@
 import sharppy.databases.sars_cal as sars_cal
+import sharppy.databases.sars as sars
+import sharppy.databases.sars_archive as sars_archive
+from sharppy.io.spc_decoder import SPCDecoder
+import glob
+import os
+import numpy as np
+import pytest
 
 def test_sars_hail():
     results = sars_cal.check_hail_cal()
@@ -12,4 +19,107 @@ def test_sars_supercell():
     # Ensure every sounding listed in the database matches back to itself
     assert verif['num'] == verif['match']
 
+def test_range_index():
+    # The index must return exactly what a brute force search returns
+    rs = np.random.RandomState(0)
+    cols = {'a': rs.uniform(0, 100, 5000), 'b': np.round(rs.uniform(-10, 10, 5000), 1)}
+    index = sars.RangeIndex(cols)
+    for i in range(50):
+        crit = {'a': (rs.uniform(0, 100), rs.uniform(0, 20)), 'b': (rs.uniform(-10, 10), rs.uniform(-1, 5))}
+        brute = np.ones(5000, dtype=bool)
+        for name, (val, rng) in crit.items():
+            brute &= (val >= cols[name] - rng) & (val <= cols[name] + rng)
+        np.testing.assert_array_equal(index.query(crit), np.where(brute)[0])
+
+def test_sars_batch():
+    # The batch routines must agree with the scalar routines
+    mlcape = [0., 1500., 3200.]; mllcl = [900., 1200., 700.]; h5temp = [-12., -15., -9.]
+    lr = [6.5, 7.5, 8.2]; shr = [45., 55., 30.]; srh = [30., 150., -80.]
+    shr3k = [25., 35., 20.]; shr9k = [60., 70., 45.]; srh3 = [50., 250., 120.]
+    batch = sars.supercell_batch('sars_supercell.txt', mlcape, mllcl, h5temp, lr, shr, srh, shr3k, shr9k, srh3)
+    for i in range(len(mlcape)):
+        out = sars.supercell('sars_supercell.txt', mlcape[i], mllcl[i], h5temp[i], lr[i], shr[i], srh[i],
+                             shr3k[i], shr9k[i], srh3[i])
+        for scalar, vector in zip(out, batch):
+            np.testing.assert_array_equal(scalar, vector[i])
+
+    mumr = [12., 14., 9.]; mucape = [300., 1500., 3500.]
+    shr6 = [20., 25., 15.]; shr9 = [25., 35., 20.]; shr3 = [12., 18., 8.]
+    batch = sars.hail_batch('sars_hail.txt', mumr, mucape, h5temp, lr, shr6, shr9, shr3, srh3)
+    for i in range(len(mumr)):
+        out = sars.hail('sars_hail.txt', mumr[i], mucape[i], h5temp[i], lr[i], shr6[i], shr9[i], shr3[i], srh3[i])
+        for scalar, vector in zip(out, batch):
+            np.testing.assert_array_equal(scalar, vector[i])
+
+def test_sars_get_sounding():
+    fname = sars.getSounding('00042320.TXK', 'supercell')
+    assert fname.endswith('00042320f0.txk')
+    with pytest.raises(IOError):
+        sars.getSounding('00000000.XXX', 'hail')
+
+def test_sars_archive(tmpdir):
+    # Profiles from the packed archive must be the same as those from the raw files
+    files = sorted(glob.glob(sars.get_sars_dir('supercell') + '*'))[:5]
+    archive_fn = os.path.join(str(tmpdir), 'supercell.sarspack')
+    sars_archive.build_archive('supercell', archive_fn, files=files)
+    archive = sars_archive.SARSArchive(archive_fn)
+    assert len(archive) == len(files)
+
+    for fname in files:
+        raw = SPCDecoder(fname).getProfiles()
+        packed = archive.getProfiles(os.path.basename(fname))
+        assert raw._dates == packed._dates
+        assert raw.getMeta('loc') == packed.getMeta('loc')
+        raw_prof = raw._profs[''][0]
+        packed_prof = packed._profs[''][0]
+        for field in ['pres', 'hght', 'tmpc', 'dwpc', 'wdir', 'wspd']:
+            np.testing.assert_array_equal(getattr(raw_prof, field), getattr(packed_prof, field))
+
+def test_sars_archive_stale(tmpdir, monkeypatch):
+    # Editing a raw file in place makes the archive stale, even though the directory's mtime is the same
+    import shutil
+    data_dir = tmpdir.mkdir('supercell')
+    for fname in sorted(glob.glob(sars.get_sars_dir('supercell') + '*'))[:2]:
+        shutil.copy(fname, str(data_dir))
+    monkeypatch.setattr(sars, 'get_sars_dir', lambda match_type: str(data_dir) + os.sep)
+
+    archive_fn = os.path.join(str(tmpdir), 'supercell.sarspack')
+    sars_archive.build_archive('supercell', archive_fn)
+    archive = sars_archive.SARSArchive(archive_fn)
+    assert not archive.isStale()
+
+    dir_mtime = os.path.getmtime(str(data_dir))
+    edited = data_dir.listdir()[0]
+    edited.write(edited.read() + '\n')
+    os.utime(str(data_dir), (dir_mtime, dir_mtime))
+    assert archive.isStale()
+
+def test_sars_archive_stale_interval(tmpdir, monkeypatch):
+    # An open archive is only checked against the raw files every STALE_CHECK_INTERVAL seconds
+    import shutil
+    data_dir = tmpdir.mkdir('supercell')
+    for fname in sorted(glob.glob(sars.get_sars_dir('supercell') + '*'))[:2]:
+        shutil.copy(fname, str(data_dir))
+    monkeypatch.setattr(sars, 'get_sars_dir', lambda match_type: str(data_dir) + os.sep)
+    monkeypatch.setattr(sars_archive, 'ARCHIVE_DIR', str(tmpdir))
+    monkeypatch.setattr(sars_archive, '_archives', {})
+    monkeypatch.setattr(sars_archive, '_last_checked', {})
+
+    checks = []
+    is_stale = sars_archive.SARSArchive.isStale
+    def count_stale(self):
+        checks.append(1)
+        return is_stale(self)
+    monkeypatch.setattr(sars_archive.SARSArchive, 'isStale', count_stale)
+
+    archive = sars_archive.get_archive('supercell')
+    num_checks = len(checks)
+    for i in range(5):
+        assert sars_archive.get_archive('supercell') is archive
+    assert len(checks) == num_checks
+
+    sars_archive._last_checked['supercell'] -= sars_archive.STALE_CHECK_INTERVAL
+    assert sars_archive.get_archive('supercell') is archive
+    assert len(checks) == num_checks + 1
+
 #test_sars_hail()
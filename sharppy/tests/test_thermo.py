@@ -295,6 +295,15 @@ def test_satlift():
     npt.assert_almost_equal(returned_t, correct_t)
 
 
+def test_gridded_satlift():
+    import sharppy.sharptab.gridded as gridded
+    input_p = np.array([850., 500., 1000., 200.])
+    input_thetam = np.array([20., 25., 18., 30.])
+    correct_t = [ thermo.satlift(p, thm) for p, thm in zip(input_p, input_thetam) ]
+    returned_t = gridded.satlift(input_p, input_thetam)
+    npt.assert_almost_equal(returned_t, correct_t)
+
+
 def test_wetlift():
     input_p = 700
     input_t = 15
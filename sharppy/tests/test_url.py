@@ -40,3 +40,152 @@ def test_url():
     
     print(new_prof.mupcl.bplus)
 
+
+def start_server(files, log):
+    """
+    Serves the files (a dict of path -> bytes) on localhost with an ETag for each one.
+    Each request is added to log as (client port, path, If-None-Match header).
+    """
+    import threading
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            log.append((self.client_address[1], self.path, self.headers.get('If-None-Match')))
+            if self.path not in files:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            etag = '"%d"' % hash(files[self.path])
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(files[self.path])))
+            self.end_headers()
+            self.wfile.write(files[self.path])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+def test_http_cache(tmpdir):
+    import sharppy.io.http_cache as http_cache
+
+    body = open('examples/data/14061619.OAX', 'rb').read()
+    requests = []
+    server, base_url = start_server({'/14061619.OAX': body}, requests)
+    url = base_url + '/14061619.OAX'
+
+    try:
+        cache = http_cache.HTTPCache(str(tmpdir), default_ttl=0)
+        assert cache.fetch(url) == body
+        # Past the TTL, the cached body is revalidated instead of downloaded again
+        assert cache.fetch(url) == body
+        etags = [ etag for port, path, etag in requests ]
+        assert etags[0] is None and etags[1] is not None
+
+        cache.setTTL(base_url, 3600)
+        assert cache.fetch(url) == body
+        assert len(requests) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # The server is gone, but the cached copy is still served
+    cache.setTTL(base_url, 0)
+    assert cache.fetch(url) == body
+    cache.setOffline(True)
+    assert cache.fetch(url) == body
+    try:
+        cache.fetch(url + '.missing')
+        assert False
+    except IOError:
+        pass
+
+    # Offline mode can expire by itself
+    cache.setOffline(True, ttl=0)
+    assert not cache.isOffline()
+    cache.setOffline(True, ttl=3600)
+    assert cache.isOffline()
+    cache.setOffline(False)
+
+    cache.evict(max_size=0)
+    assert not cache.isCached(url)
+    assert cache.getSize() == 0
+
+def test_fetch_many(tmpdir):
+    import sharppy.io.http_cache as http_cache
+    import sharppy.io.downloads as downloads
+    from sharppy.io.spc_decoder import SPCDecoder
+    import threading
+    import warnings
+    import gc
+
+    with open('examples/data/14061619.OAX', 'rb') as f:
+        body = f.read()
+    files = dict( ('/%02d.OAX' % i, body) for i in range(6) )
+    requests = []
+    server, base_url = start_server(files, requests)
+    urls = [ base_url + path for path in sorted(files.keys()) ] + [ base_url + '/missing' ]
+
+    progress = {}
+    def report(url, nread, total):
+        progress[url] = (nread, total)
+
+    try:
+        manager = downloads.DownloadManager(max_workers=2, backoff=0.01,
+            cache=http_cache.HTTPCache(str(tmpdir), default_ttl=0))
+        bodies = manager.fetchMany(urls, progress=report)
+        # The 2 workers reuse their connections
+        assert len(set( port for port, path, etag in requests )) <= 2
+
+        futures = manager.fetchMany(urls[:2], futures=True)
+        assert [ fut.result() for fut in futures ] == [ body, body ]
+
+        # Cancelling a batch doesn't stop the next one
+        cancel = threading.Event()
+        cancel.set()
+        assert isinstance(manager.fetchMany(urls[:1], cancel=cancel)[0], downloads.DownloadCancelled)
+        manager.cancel()
+        assert manager.fetchMany(urls[:1]) == [ body ]
+
+        # Closing the manager closes its connections
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            manager.close()
+            gc.collect()
+        assert not [ w for w in caught if issubclass(w.category, ResourceWarning) ]
+        assert len(manager._conns) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert bodies[:-1] == [ body ] * 6
+    assert isinstance(bodies[-1], IOError)
+    assert progress[urls[0]] == (len(body), len(body))
+
+    dec = SPCDecoder(urls[0], file_data=bodies[0])
+    assert dec.getStnId() == 'OAX'
+
+    # A cancelled download isn't turned into a plain IOError by the cache
+    def cancelled_get(url, headers):
+        raise downloads.DownloadCancelled("The download of '%s' was cancelled" % url)
+
+    try:
+        http_cache.HTTPCache(str(tmpdir)).fetch(base_url + '/not_cached', get=cancelled_get)
+        assert False
+    except downloads.DownloadCancelled:
+        pass
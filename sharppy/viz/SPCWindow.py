@@ -604,7 +604,8 @@ class SPCWidget(QWidget):
 
             cur_dt = self.prof_collections[self.pc_idx].getCurrentDate()
         else:
-            cur_dt = prof_col.advanceTime(direction)
+            # While the profiles are being computed in the background, only step to the ones that are ready
+            cur_dt = prof_col.advanceTime(direction, ready_only=prof_col.isCopying())
 
         for prof_col in self.prof_collections:
             if not prof_col.getMeta('observed'):
@@ -749,6 +750,7 @@ class SPCWidget(QWidget):
 
 class SPCWindow(QMainWindow):
     closed = Signal()
+    copy_progress = Signal(int, int)
 
     def __init__(self, **kwargs):
         parent = kwargs.get('parent', None)
@@ -767,9 +769,10 @@ class SPCWindow(QMainWindow):
         self.createMenuBar()
 
         logging.debug("Determining system platform to resize the window.")
-        title = 'SHARPpy: Sounding and Hodograph Analysis and Research Program '
-        title += 'in Python'
-        self.setWindowTitle(title)
+        self.title = 'SHARPpy: Sounding and Hodograph Analysis and Research Program '
+        self.title += 'in Python'
+        self.setWindowTitle(self.title)
+        self.copy_progress.connect(self.setCopyProgress)
 
         bg_hex = self.spc_widget.config['preferences', 'bg_color']
         self.setStyleSheet("QMainWindow { background-color: " + bg_hex + "; }")
@@ -783,6 +786,20 @@ class SPCWindow(QMainWindow):
         self.show()
         self.raise_()
 
+    def conversionHooks(self):
+        """
+        Returns the callback and progress functions to pass to ProfCollection.setAsync().
+        They're called from the background thread, so they go through a signal.
+        """
+        return None, self.copy_progress.emit
+
+    @Slot(int, int)
+    def setCopyProgress(self, done, total):
+        title = self.title
+        if done < total:
+            title += ' (computing profiles: %d of %d)' % (done, total)
+        self.setWindowTitle(title)
+
     def createMenuBar(self):
         logging.debug("Creating the SPCWindow Menu Bar.")
         bar = self.menuBar()
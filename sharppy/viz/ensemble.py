@@ -284,16 +284,13 @@ class plotENS(backgroundENS):
         cur_dt = self.prof_collections[self.pc_idx].getCurrentDate()
         bc_idx = 0
         for idx, prof_coll in enumerate(self.prof_collections):
-            # Draw all unhighlighed ensemble members
+            # Draw all unhighlighed ensemble members. The indices for all the members are
+            # computed at once, so the members don't need to be made into full profiles.
             if prof_coll.getCurrentDate() == cur_dt:
-                proflist = list(prof_coll.getCurrentProfs().values())
-
-                if idx == self.pc_idx:
-                    for prof in proflist:
-                        self.draw_ensemble_point(qp, prof)
-                else:
-                    for prof in proflist:
-                        self.draw_ensemble_point(qp, prof)
+                members, indices = prof_coll.getIndexArrays(['pblh', 'sbcape'], current=True)
+                for pbl_h, sbcape in zip(indices['pblh'], indices['sbcape']):
+                    if np.isfinite(pbl_h) and np.isfinite(sbcape):
+                        self.draw_point(qp, pbl_h, sbcape)
                     #%bc_idx = (bc_idx + 1) % len(self.background_colors)
 
         bc_idx = 0
@@ -311,13 +308,17 @@ class plotENS(backgroundENS):
             setattr(prof, 'pbl_h', interp.to_agl(prof, interp.hght(prof, ppbl_top)))
         if 'sfcpcl' not in dir(prof): # Make sure a surface parcel has been lifted in the profile object
             setattr(prof, 'sfcpcl', params.parcelx(prof, flag=1 ))
+        self.draw_point(qp, prof.pbl_h, prof.sfcpcl.bplus)
+
+    def draw_point(self, qp, pbl_h, sbcape):
+        # Plot a PBL height and surface-based CAPE on the scatter plot
         #x = self.x_to_xpix()
         #y = self.y_to_ypix()
         color = QtCore.Qt.red
         qp.setPen(QtGui.QPen(color))
         qp.setBrush(QtGui.QBrush(color))
-        x = self.x_to_xpix(prof.pbl_h) - 50 / 2.
-        y = self.y_to_ypix(prof.sfcpcl.bplus) - (self.fsize-1) / 2
+        x = self.x_to_xpix(pbl_h) - 50 / 2.
+        y = self.y_to_ypix(sbcape) - (self.fsize-1) / 2
         qp.drawEllipse(x, y, 3, 3)
 
         return